@@ -1,27 +1,39 @@
-from flask import Flask, render_template, request, url_for, flash, redirect, session, jsonify
+from flask import Flask, Response, render_template, request, url_for, flash, redirect, session, jsonify, g, has_app_context, has_request_context, stream_with_context
 from flask_mysqldb import MySQL
+from flask.sessions import SessionInterface, SessionMixin, TaggedJSONSerializer
 from flask_compress import Compress
+from itsdangerous import BadSignature, Signer
+from werkzeug.middleware.proxy_fix import ProxyFix
 # from flask_session import Session  # Disabled due to compatibility issues
 import redis
+import MySQLdb
+import dns.exception
+import dns.resolver
 # Using XAMPP MySQL - no SQLite fallback needed
 USE_SQLITE = False
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 from functools import wraps
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import os
+import time
 import uuid
 import hashlib
 import secrets
 import requests
+import urllib3
 import json
+import queue
 import base64
+import math
+import random
 import bcrypt
 import re
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from dotenv import load_dotenv
-from threading import Lock, Thread
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread
 # from pay import PayClass as ExternalPayClass
 # Google OAuth imports
 import pathlib
@@ -45,10 +57,190 @@ app.config['SESSION_COOKIE_SECURE'] = PRODUCTION_MODE  # True in production
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
+# Render/Railway terminate TLS in a proxy in front of gunicorn. Trust that many X-Forwarded-* hops so
+# request.remote_addr is the shopper's address (rate limits and login throttling are keyed on it)
+# rather than the proxy's. 0 disables it, e.g. when gunicorn is exposed directly.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 1))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS, x_host=TRUSTED_PROXY_HOPS)
+
 # Performance: Enable GZIP Compression
 compress = Compress()
 compress.init_app(app)
 
+# ============================================
+# Outbound HTTP
+# ============================================
+# Every call to a third party (MoMo, Brevo, Twilio, geocoders) goes through one OutboundHTTPClient per
+# provider instead of module-level requests.get/post: a Session keeps TLS connections alive per host,
+# every call has a connect and a read timeout, transient failures are retried with jittered backoff,
+# and a per-process circuit breaker makes calls to a provider that keeps failing fail fast instead of
+# tying up gunicorn threads on timeouts.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_BREAKER_FAILURES = int(os.environ.get('HTTP_BREAKER_FAILURES', 5))
+HTTP_BREAKER_RESET = float(os.environ.get('HTTP_BREAKER_RESET', 30))
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling a provider whose circuit is open (existing ConnectionError handlers apply)."""
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failures; once `reset_timeout` has passed
+    a single trial call is let through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            return 'half_open' if time.monotonic() - self._opened_at >= self.reset_timeout else 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print(f"[HTTP] {self.name} circuit closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def abandon_trial(self):
+        """The trial call ended without telling us anything; let the next caller try"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or (self._opened_at is None and self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    print(f"[HTTP] {self.name} circuit opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+def _request_not_sent(exc):
+    """True when the request provably never reached the server, so even a POST can be retried"""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class OutboundHTTPClient:
+    """
+    Pooled, keep-alive HTTP client for one provider.
+
+    Idempotent methods (and calls made with idempotent=True) are retried on network errors and
+    502/503/504; other calls are only retried when the request never left this process. Retries
+    use full-jitter exponential backoff.
+    """
+
+    def __init__(self, name, read_timeout, retries=2, backoff=0.25, backoff_cap=2.0, pool_maxsize=10,
+                 connect_timeout=None):
+        self.name = name
+        self.timeout = (connect_timeout or HTTP_CONNECT_TIMEOUT, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.breaker = CircuitBreaker(name, HTTP_BREAKER_FAILURES, HTTP_BREAKER_RESET)
+        self.session = requests.Session()
+        # Retries are handled here (with the breaker in the loop), not by urllib3
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._stats = defaultdict(int)
+
+    def _sleep_before_retry(self, attempt):
+        self._stats['retries'] += 1
+        time.sleep(random.uniform(0, min(self.backoff_cap, self.backoff * 2 ** (attempt - 1))))
+
+    def request(self, method, url, idempotent=None, timeout=None, **kwargs):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            # A single number overrides the read timeout only
+            timeout = (self.timeout[0], timeout)
+
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._stats['short_circuited'] += 1
+                raise CircuitOpenError(f"{self.name} circuit open, not calling {url.split('?')[0]}")
+            self._stats['requests'] += 1
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._stats['errors'] += 1
+                self.breaker.record_failure()
+                if attempt < self.retries and (idempotent or _request_not_sent(e)):
+                    attempt += 1
+                    self._sleep_before_retry(attempt)
+                    continue
+                raise
+            except requests.exceptions.RequestException:
+                # Broken chunking/encoding, redirect loops, ... count against the provider too
+                self._stats['errors'] += 1
+                self.breaker.record_failure()
+                raise
+            except BaseException:
+                # Not the provider's fault, but a half-open trial must not stay claimed forever
+                self.breaker.abandon_trial()
+                raise
+
+            if response.status_code >= 500:
+                self._stats['server_errors'] += 1
+                self.breaker.record_failure()
+                if idempotent and response.status_code in RETRY_STATUSES and attempt < self.retries:
+                    attempt += 1
+                    response.close()
+                    self._sleep_before_retry(attempt)
+                    continue
+            else:
+                self.breaker.record_success()
+            return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        return dict(self._stats, state=self.breaker.state, timeout=list(self.timeout), max_retries=self.retries)
+
+
+momo_http = OutboundHTTPClient('momo', read_timeout=float(os.environ.get('MOMO_HTTP_TIMEOUT', 15)))
+# Sends are not idempotent; the email outbox owns retries for Brevo, so only unsent requests are retried here
+brevo_http = OutboundHTTPClient('brevo', read_timeout=10, retries=1)
+twilio_http = OutboundHTTPClient('twilio', read_timeout=10, retries=1)
+geocode_http = OutboundHTTPClient('geocode', read_timeout=5, retries=1)
+HTTP_CLIENTS = {client.name: client for client in (momo_http, brevo_http, twilio_http, geocode_http)}
+
 # ============================================
 # Email Sending Function (Gmail SMTP - Production)
 # ============================================
@@ -113,11 +305,10 @@ Thank you for shopping with CiTiPlug! 🛒
             "Body": message_body
         }
         
-        response = requests.post(
+        response = twilio_http.post(
             url,
             data=data,
-            auth=(twilio_account_sid, twilio_auth_token),
-            timeout=10
+            auth=(twilio_account_sid, twilio_auth_token)
         )
         
         if response.status_code in [200, 201]:
@@ -138,64 +329,109 @@ Thank you for shopping with CiTiPlug! 🛒
         traceback.print_exc()
         return False
 
-def send_email_async(recipient_email, subject, html_content):
+class EmailDeliveryError(Exception):
+    """A provider call failed; `retryable` is False when resending the same message cannot succeed."""
+
+    def __init__(self, message, retryable=True, recipient_rejected=False):
+        super().__init__(message)
+        self.retryable = retryable
+        # The provider refused the recipient address itself (not the sender, key or payload)
+        self.recipient_rejected = recipient_rejected
+
+
+# Point at brevo_stub_server.py (e.g. http://localhost:8025/v3) to exercise sends locally
+BREVO_API_URL = os.environ.get('BREVO_API_URL', 'https://api.brevo.com/v3').rstrip('/')
+# Brevo accepts up to 1000 messageVersions per call
+BREVO_MAX_BATCH = 1000
+
+
+def _brevo_send(data, timeout=10):
+    """POST one /smtp/email payload; raises EmailDeliveryError (retryable for 429, 5xx and network errors)"""
+    brevo_api_key = os.environ.get('BREVO_API_KEY')
+    if not brevo_api_key:
+        raise EmailDeliveryError("Brevo API key not configured")
+
+    headers = {
+        "accept": "application/json",
+        "api-key": brevo_api_key,
+        "content-type": "application/json"
+    }
+    data = dict(data, sender={"email": os.environ.get('SENDER_EMAIL', 'noreply@citiplus.com')})
+
+    try:
+        response = brevo_http.post(f"{BREVO_API_URL}/smtp/email", json=data, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        raise EmailDeliveryError(f"Request error: {e}")
+
+    if response.status_code in [200, 201]:
+        return True
+    retryable = response.status_code == 429 or response.status_code >= 500
+    recipient_rejected = False
+    if response.status_code == 400:
+        try:
+            message = str(response.json().get('message', '')).lower()
+        except ValueError:
+            message = ''
+        recipient_rejected = 'email' in message and 'sender' not in message
+    raise EmailDeliveryError(f"Brevo API error: {response.status_code} - {response.text[:500]}",
+                             retryable=retryable, recipient_rejected=recipient_rejected)
+
+
+def deliver_email_brevo(recipient_email, subject, html_content):
     """
-    Send an email using Brevo (Sendinblue) HTTP API.
+    Send one email through the Brevo (Sendinblue) HTTP API.
     Free tier: 300 emails/day, no card required.
     Works on Render free tier (HTTP allowed, SMTP blocked).
-    
-    Args:
-        recipient_email: Email address to send to
-        subject: Email subject
-        html_content: HTML content of the email
-    
+
+    Raises EmailDeliveryError on failure. Throttling (429), server errors and network
+    problems are retryable; any other 4xx means Brevo rejected the message itself.
+    """
+    return _brevo_send({
+        "to": [{"email": recipient_email}],
+        "subject": subject,
+        "htmlContent": html_content
+    })
+
+
+def deliver_email_brevo_batch(recipient_emails, subject, html_content):
+    """
+    Send the same email to up to BREVO_MAX_BATCH recipients in one Brevo call
+    (one messageVersion per recipient, so nobody sees the other addresses).
+    """
+    if len(recipient_emails) > BREVO_MAX_BATCH:
+        raise ValueError(f"Brevo batches are limited to {BREVO_MAX_BATCH} recipients")
+    return _brevo_send({
+        "subject": subject,
+        "htmlContent": html_content,
+        "messageVersions": [{"to": [{"email": email}]} for email in recipient_emails]
+    }, timeout=30)
+
+
+# Outbox providers: name -> callable(recipient_email, subject, html_content)
+EMAIL_PROVIDERS = {
+    'brevo': deliver_email_brevo,
+}
+# Campaign providers: name -> callable(recipient_emails, subject, html_content)
+EMAIL_BATCH_PROVIDERS = {
+    'brevo': deliver_email_brevo_batch,
+}
+EMAIL_DEFAULT_PROVIDER = 'brevo'
+
+
+def send_email_async(recipient_email, subject, html_content):
+    """
+    Send an email right away through the default provider (blocking).
+    Used by the outbox worker and as a last resort when the outbox is unavailable.
+
     Returns:
         True if successful, False otherwise
     """
-    print(f"[THREAD] Email thread started for {recipient_email}")
     try:
-        # Get Brevo API key from environment
-        brevo_api_key = os.environ.get('BREVO_API_KEY')
-        sender_email = os.environ.get('SENDER_EMAIL', 'noreply@citiplus.com')
-        
-        print(f"[DEBUG] Email function called")
-        print(f"[DEBUG] BREVO_API_KEY set: {bool(brevo_api_key)}")
-        
-        if not brevo_api_key:
-            print("[WARNING] Brevo API key not configured. Email not sent.")
-            return False
-        
-        print(f"[DEBUG] Sending via Brevo HTTP API...")
-        
-        # Use Brevo API v3
-        url = "https://api.brevo.com/v3/smtp/email"
-        headers = {
-            "accept": "application/json",
-            "api-key": brevo_api_key,
-            "content-type": "application/json"
-        }
-        
-        data = {
-            "sender": {"email": sender_email},
-            "to": [{"email": recipient_email}],
-            "subject": subject,
-            "htmlContent": html_content
-        }
-        
-        print(f"[DEBUG] Making HTTP request to Brevo API...")
-        response = requests.post(url, json=data, headers=headers, timeout=10)
-        
-        if response.status_code in [200, 201]:
-            print(f"[OK] Email sent to {recipient_email} via Brevo API (status: {response.status_code})")
-            return True
-        else:
-            print(f"[ERROR] Brevo API error: {response.status_code} - {response.text}")
-            return False
-            
-    except requests.exceptions.RequestException as e:
-        print(f"[ERROR] Request error sending email: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        EMAIL_PROVIDERS[EMAIL_DEFAULT_PROVIDER](recipient_email, subject, html_content)
+        print(f"[OK] Email sent to {recipient_email} via {EMAIL_DEFAULT_PROVIDER}")
+        return True
+    except EmailDeliveryError as e:
+        print(f"[ERROR] Failed to send email to {recipient_email}: {e}")
         return False
     except Exception as e:
         print(f"[ERROR] Failed to send email to {recipient_email}: {str(e)}")
@@ -203,63 +439,231 @@ def send_email_async(recipient_email, subject, html_content):
         traceback.print_exc()
         return False
 
+# ============================================
+# Email Outbox
+# ============================================
+# send_email() only inserts a row into email_outbox (migrations/0003_email_outbox.py); email_worker.py,
+# a separate process, claims pending rows and delivers them with a fixed-size pool, retrying with
+# backoff and dead-lettering rows that keep failing. Web requests never wait on the provider and a
+# restart loses nothing that was queued. A Redis list is nudged after each insert so an idle worker
+# wakes up immediately instead of at its next poll.
+EMAIL_OUTBOX_WAKEUP_KEY = "email_outbox:wakeup"
+
+
+def queue_emails(messages, provider=None):
+    """
+    Insert (recipient_email, subject, html_content) tuples into the outbox in one transaction.
+    Returns the number of rows queued; raises if the outbox cannot be written.
+    """
+    rows = [(provider or EMAIL_DEFAULT_PROVIDER, recipient, subject, html)
+            for recipient, subject, html in messages if recipient]
+    if not rows:
+        return 0
+    # Own connection + commit, so queueing never commits (or is rolled back with) the caller's transaction
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.executemany("""
+                INSERT INTO email_outbox (provider, recipient, subject, html_content, status, next_attempt_at)
+                VALUES (%s, %s, %s, %s, 'pending', NOW())
+            """, rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    if REDIS_AVAILABLE:
+        try:
+            pipe = redis_client.pipeline()
+            pipe.lpush(EMAIL_OUTBOX_WAKEUP_KEY, 1)
+            pipe.ltrim(EMAIL_OUTBOX_WAKEUP_KEY, 0, 0)
+            pipe.execute()
+        except Exception as e:
+            print(f"[OUTBOX] Wakeup error: {e}")
+    return len(rows)
+
+
 def send_email(recipient_email, subject, html_content):
     """
-    Send an email asynchronously (non-blocking).
-    Spawns a background thread to avoid blocking the main request.
+    Queue an email for the outbox worker (non-blocking).
+    Falls back to a one-off background thread if the outbox cannot be written.
     """
+    try:
+        return queue_emails([(recipient_email, subject, html_content)]) == 1
+    except Exception as e:
+        print(f"[OUTBOX] Queue failed, sending directly: {e}")
     thread = Thread(target=send_email_async, args=(recipient_email, subject, html_content), daemon=True)
     thread.start()
-    return True  # Return immediately, email sends in background
+    return True
+
+# ============================================
+# Email Campaigns
+# ============================================
+# A promotion to all active users is a row in email_campaigns (migrations/0004_email_campaigns.py),
+# not one outbox row per user. email_worker.py walks the users table in id order, EMAIL_CAMPAIGN_BATCH_SIZE
+# rows at a time, sends each chunk with a single provider batch call and stores the last user id it
+# reached, so memory stays flat and a paused or interrupted campaign resumes where it stopped.
+# A chunk the provider rejects outright (e.g. one malformed address) is handed to the outbox as one
+# message per recipient (outbox_count), so the rest of the chunk still goes out.
+EMAIL_CAMPAIGN_BATCH_SIZE = min(int(os.environ.get('EMAIL_CAMPAIGN_BATCH_SIZE', 500)), BREVO_MAX_BATCH)
+CAMPAIGN_COLUMNS = ('id', 'subject', 'status', 'total_recipients', 'sent_count', 'outbox_count',
+                    'last_user_id', 'last_error', 'created_at', 'started_at', 'completed_at')
+
+
+def create_email_campaign(cur, subject, html_content, created_by=None):
+    """Queue a campaign to every active user; the caller commits. Returns the campaign id, or None
+    (and queues nothing) when there are no active users."""
+    cur.execute("SELECT COUNT(*) FROM users WHERE is_active = TRUE")
+    total = cur.fetchone()[0]
+    if not total:
+        return None
+    cur.execute("""
+        INSERT INTO email_campaigns (subject, html_content, provider, status, total_recipients, created_by)
+        VALUES (%s, %s, %s, 'queued', %s, %s)
+    """, (subject, html_content, EMAIL_DEFAULT_PROVIDER, total, created_by))
+    return cur.lastrowid
+
+
+def get_email_campaign(cur, campaign_id):
+    cur.execute(f"SELECT {', '.join(CAMPAIGN_COLUMNS)} FROM email_campaigns WHERE id = %s", (campaign_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    campaign = dict(zip(CAMPAIGN_COLUMNS, row))
+    for key in ('created_at', 'started_at', 'completed_at'):
+        if campaign[key]:
+            campaign[key] = campaign[key].isoformat()
+    return campaign
 
-def validate_email_sendable(email):
+
+def set_email_campaign_status(cur, campaign_id, status):
     """
-    Test if an email address can receive emails.
-    Returns True if email is valid and can receive, False otherwise.
+    Pause (queued/running -> paused) or resume (paused -> queued) a campaign; the caller commits.
+    A running worker notices a pause before its next chunk. Returns False if the transition is not allowed.
     """
-    if not email or not isinstance(email, str):
-        return False
-    
-    # Basic email format validation
-    if not re.match(r'^[^@]+@[^@]+\.[^@]+$', email):
+    allowed_from = {'paused': ('queued', 'running'), 'queued': ('paused',)}[status]
+    cur.execute(f"""
+        UPDATE email_campaigns SET status = %s
+        WHERE id = %s AND status IN ({', '.join(['%s'] * len(allowed_from))})
+    """, (status, campaign_id) + allowed_from)
+    return cur.rowcount == 1
+
+
+# ============================================
+# Email Deliverability
+# ============================================
+# Checkout only asks "is this address worth sending to?" and answers locally: syntax, then the
+# domain's MX records (cached per domain), then any verdict the outbox worker recorded for the
+# address itself after the provider rejected it. Nothing here sends mail or calls the provider;
+# the real delivery attempt happens asynchronously in email_worker.py. Address verdicts are facts
+# learned from the provider, not derived data, so they live in their own Redis keys outside the
+# cache: clear_cache() and tag invalidation never forget a bounced address.
+EMAIL_ADDRESS_RE = re.compile(
+    r"^[A-Za-z0-9.!#$%&'*+/=?^_`{|}~-]+@"
+    r"(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+[A-Za-z]{2,63}$"
+)
+EMAIL_DNS_TIMEOUT = float(os.environ.get('EMAIL_DNS_TIMEOUT', 2))
+EMAIL_DOMAIN_OK_TTL = 7 * 24 * 3600
+EMAIL_DOMAIN_BAD_TTL = 3600
+EMAIL_DOMAIN_UNKNOWN_TTL = 300
+EMAIL_ADDRESS_VERDICT_TTL = 30 * 24 * 3600
+
+
+def normalize_email(email):
+    return email.strip().lower() if isinstance(email, str) else ''
+
+
+def check_email_syntax(email):
+    """Local-only syntax check (RFC 5321 length limits, dotted domain with an alphabetic TLD)"""
+    if not email or len(email) > 254 or not EMAIL_ADDRESS_RE.match(email):
         return False
-    
-    # Try to send a test email
+    local = email.rsplit('@', 1)[0]
+    return len(local) <= 64 and not local.startswith('.') and not local.endswith('.') and '..' not in local
+
+
+def lookup_domain_mail_verdict(domain):
+    """
+    'ok' if the domain accepts mail (MX, or an A/AAAA record as the implicit MX), 'bad' if it
+    provably does not (NXDOMAIN, no records, null MX), 'unknown' if DNS could not tell us in time.
+    """
+    resolver = dns.resolver.Resolver()
+    resolver.lifetime = EMAIL_DNS_TIMEOUT
     try:
-        brevo_api_key = os.environ.get('BREVO_API_KEY')
-        sender_email = os.environ.get('SENDER_EMAIL', 'noreply@citiplus.com')
-        
-        if not brevo_api_key:
-            print(f"[WARNING] Cannot validate email - Brevo API key not configured")
-            return False
-        
-        # Send a simple test email
-        url = "https://api.brevo.com/v3/smtp/email"
-        headers = {
-            "accept": "application/json",
-            "api-key": brevo_api_key,
-            "content-type": "application/json"
-        }
-        
-        data = {
-            "sender": {"email": sender_email},
-            "to": [{"email": email}],
-            "subject": "Email Verification - CiTiPlug",
-            "htmlContent": "<p>This is a test email to verify your email address works.</p>"
-        }
-        
-        response = requests.post(url, json=data, headers=headers, timeout=5)
-        
-        if response.status_code in [200, 201]:
-            print(f"[OK] Email validation successful for {email}")
-            return True
-        else:
-            print(f"[ERROR] Email validation failed for {email}: {response.status_code} - {response.text}")
-            return False
-            
+        answers = resolver.resolve(domain, 'MX')
+        hosts = [str(r.exchange).rstrip('.') for r in answers]
+        # RFC 7505 null MX: "0 ." means the domain accepts no mail
+        return 'ok' if any(hosts) else 'bad'
+    except dns.resolver.NXDOMAIN:
+        return 'bad'
+    except dns.resolver.NoAnswer:
+        pass
+    except dns.exception.DNSException as e:
+        print(f"[EMAIL] MX lookup for {domain} failed: {e}")
+        return 'unknown'
+    for rdtype in ('A', 'AAAA'):
+        try:
+            resolver.resolve(domain, rdtype)
+            return 'ok'
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            continue
+        except dns.exception.DNSException as e:
+            print(f"[EMAIL] {rdtype} lookup for {domain} failed: {e}")
+            return 'unknown'
+    return 'bad'
+
+
+def get_domain_mail_verdict(domain):
+    """Cached lookup_domain_mail_verdict(); good domains are remembered for a week, failures briefly"""
+    cache_key = f"email_domain:{domain}"
+    verdict = get_cached_data(cache_key)
+    if verdict is None:
+        verdict = lookup_domain_mail_verdict(domain)
+        ttl = {'ok': EMAIL_DOMAIN_OK_TTL, 'bad': EMAIL_DOMAIN_BAD_TTL}.get(verdict, EMAIL_DOMAIN_UNKNOWN_TTL)
+        cache_data(cache_key, verdict, ttl=ttl)
+    return verdict
+
+
+def _email_verdict_key(email):
+    return f"email_verdict:{hashlib.sha1(email.encode()).hexdigest()}"
+
+
+def mark_email_undeliverable(email, reason):
+    """Remember that the provider rejected this address (called by the outbox worker)"""
+    email = normalize_email(email)
+    if not email or not REDIS_AVAILABLE:
+        return
+    try:
+        redis_client.setex(_email_verdict_key(email), EMAIL_ADDRESS_VERDICT_TTL,
+                           json.dumps({'deliverable': False, 'reason': reason[:200]}))
+    except Exception as e:
+        print(f"[EMAIL] Verdict write error: {e}")
+
+
+def get_email_verdict(email):
+    """Verdict recorded for a normalized address, or None"""
+    if not REDIS_AVAILABLE:
+        return None
+    try:
+        verdict = redis_client.get(_email_verdict_key(email))
+        return json.loads(verdict) if verdict else None
     except Exception as e:
-        print(f"[ERROR] Email validation error for {email}: {str(e)}")
+        print(f"[EMAIL] Verdict read error: {e}")
+        return None
+
+
+def is_email_deliverable(email):
+    """
+    Fast, local deliverability check for order/account emails. Fails open when DNS is unavailable:
+    a slow resolver must not block checkout, and the outbox will find out for real.
+    """
+    email = normalize_email(email)
+    if not check_email_syntax(email):
         return False
+    verdict = get_email_verdict(email)
+    if isinstance(verdict, dict) and verdict.get('deliverable') is False:
+        return False
+    return get_domain_mail_verdict(email.rsplit('@', 1)[1]) != 'bad'
 
 def send_welcome_email(email, first_name):
     """Send a welcome email to a new user."""
@@ -434,8 +838,8 @@ def send_admin_notification_email(admin_email, order_id, customer_name, customer
     """
     return send_email(admin_email, f"🎉 New Order #{order_id} - CiTiPlug", html_content)
 
-def send_promotional_email(recipient_emails, subject, promo_title, promo_description, promo_code=None, discount_percent=None, valid_until=None):
-    """Send promotional/newsletter email to multiple users."""
+def render_promotional_email(promo_title, promo_description, promo_code=None, discount_percent=None, valid_until=None):
+    """HTML body shared by every recipient of a promotion."""
     promo_code_html = f"<p style='color: #333; font-size: 18px; font-weight: bold; text-align: center; background: #f0f0f0; padding: 15px; border-radius: 8px; margin: 20px 0;'>Use Code: <span style='color: #10b981;'>{promo_code}</span></p>" if promo_code else ""
     discount_html = f"<p style='color: #ef4444; font-size: 24px; font-weight: bold; text-align: center;'>{discount_percent}% OFF</p>" if discount_percent else ""
     valid_until_html = f"<p style='color: #999; font-size: 12px; text-align: center;'>Valid until: {valid_until}</p>" if valid_until else ""
@@ -459,14 +863,18 @@ def send_promotional_email(recipient_emails, subject, promo_title, promo_descrip
         </body>
     </html>
     """
-    
-    # Send to all recipients
-    success_count = 0
-    for email in recipient_emails:
-        if send_email(email, subject, html_content):
-            success_count += 1
-    
-    return success_count == len(recipient_emails)
+    return html_content
+
+def send_promotional_email(recipient_emails, subject, promo_title, promo_description, promo_code=None, discount_percent=None, valid_until=None):
+    """Send promotional/newsletter email to a given list of users (use create_email_campaign for everyone)."""
+    html_content = render_promotional_email(promo_title, promo_description, promo_code, discount_percent, valid_until)
+    # Queue all recipients in one insert; the outbox worker paces the actual sends
+    try:
+        queued = queue_emails([(email, subject, html_content) for email in recipient_emails])
+    except Exception as e:
+        print(f"[OUTBOX] Promotional queue failed: {e}")
+        return False
+    return queued == len(recipient_emails)
 
 # ============================================
 # WhatsApp Link Generator (Simple & Free)
@@ -512,9 +920,190 @@ app.config['MYSQL_PASSWORD'] = os.environ.get('MYSQL_PASSWORD', '')
 app.config['MYSQL_DB'] = os.environ.get('MYSQL_DB', 'ecommerce')
 app.config['MYSQL_PORT'] = int(os.environ.get('MYSQL_PORT', 3306))
 
+# Connection pool sizing (per gunicorn worker process, shared by its threads)
+app.config['MYSQL_POOL_SIZE'] = int(os.environ.get('MYSQL_POOL_SIZE', 5))
+app.config['MYSQL_POOL_MAX_OVERFLOW'] = int(os.environ.get('MYSQL_POOL_MAX_OVERFLOW', 5))
+app.config['MYSQL_POOL_TIMEOUT'] = float(os.environ.get('MYSQL_POOL_TIMEOUT', 10))
+app.config['MYSQL_POOL_RECYCLE'] = int(os.environ.get('MYSQL_POOL_RECYCLE', 1800))
+app.config['MYSQL_POOL_PING_INTERVAL'] = int(os.environ.get('MYSQL_POOL_PING_INTERVAL', 30))
+
 # Force MySQL usage (disable SQLite fallback for XAMPP)
 USE_SQLITE = False
-mysql = MySQL(app)
+
+
+# ============================================
+# MySQL Connection Pool
+# ============================================
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free within the pool timeout."""
+
+
+class MySQLConnectionPool:
+    """
+    Thread-safe pool of MySQLdb connections shared by all threads of a worker.
+
+    - Keeps up to `size` idle connections open between requests.
+    - Allows `max_overflow` extra connections under bursts; they are closed on release.
+    - When all size + max_overflow connections are busy, callers wait (FIFO-ish on a
+      Condition) for up to `timeout` seconds before PoolTimeout is raised.
+    - Connections older than `recycle` seconds are closed instead of reused.
+    - Connections idle for more than `ping_interval` seconds are pinged before reuse.
+    """
+
+    def __init__(self, connect, size=5, max_overflow=5, timeout=10, recycle=1800, ping_interval=30):
+        self._connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self._cond = Condition(Lock())
+        self._idle = []          # LIFO stack of (conn, last_used)
+        self._created_at = {}    # id(conn) -> creation time
+        self._checked_out = 0
+        self._stats = defaultdict(int)
+
+    def _open(self):
+        conn = self._connect()
+        self._created_at[id(conn)] = time.monotonic()
+        self._stats['created'] += 1
+        return conn
+
+    def _discard(self, conn, reason):
+        self._created_at.pop(id(conn), None)
+        self._stats[reason] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _expired(self, conn):
+        created_at = self._created_at.get(id(conn), 0)
+        return self.recycle > 0 and time.monotonic() - created_at > self.recycle
+
+    def acquire(self):
+        """Borrow a healthy connection, waiting up to `timeout` seconds for a free slot."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            last_used = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        self._checked_out += 1
+                        break
+                    if self._checked_out < self.size + self.max_overflow:
+                        self._checked_out += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            f"No MySQL connection available after {self.timeout}s "
+                            f"(size={self.size}, max_overflow={self.max_overflow})"
+                        )
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+
+            # Health checks and connects happen outside the lock
+            try:
+                if conn is None:
+                    conn = self._open()
+                elif self._expired(conn):
+                    self._discard(conn, 'recycled')
+                    conn = self._open()
+                elif time.monotonic() - last_used > self.ping_interval:
+                    try:
+                        conn.ping()
+                    except Exception:
+                        self._discard(conn, 'failed_pings')
+                        conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._checked_out -= 1
+                    self._cond.notify()
+                raise
+            self._stats['checkouts'] += 1
+            return conn
+
+    def release(self, conn):
+        """Return a connection; any open transaction is rolled back so no snapshot leaks."""
+        healthy = True
+        try:
+            conn.rollback()
+        except Exception:
+            healthy = False
+        with self._cond:
+            self._checked_out -= 1
+            if not healthy:
+                self._discard(conn, 'broken')
+            elif self._expired(conn):
+                self._discard(conn, 'recycled')
+            elif len(self._idle) >= self.size:
+                self._discard(conn, 'overflow_closed')
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection outside of a Flask request (scripts, workers)."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data.update({
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'timeout': self.timeout,
+                'recycle': self.recycle,
+                'in_use': self._checked_out,
+                'idle': len(self._idle),
+                'open': self._checked_out + len(self._idle),
+            })
+        return data
+
+
+class PooledMySQL(MySQL):
+    """flask_mysqldb drop-in whose per-request `connection` is borrowed from db_pool."""
+
+    @property
+    def connection(self):
+        if not has_app_context():
+            return None
+        if 'mysql_db' not in g:
+            g.mysql_db = db_pool.acquire()
+        return g.mysql_db
+
+    def teardown(self, exception):
+        conn = g.pop('mysql_db', None)
+        if conn is not None:
+            db_pool.release(conn)
+
+
+mysql = PooledMySQL(app)
+
+
+def _mysql_connect():
+    # Reuse flask_mysqldb's config handling; it reads current_app.config
+    with app.app_context():
+        return mysql.connect
+
+
+db_pool = MySQLConnectionPool(
+    _mysql_connect,
+    size=app.config['MYSQL_POOL_SIZE'],
+    max_overflow=app.config['MYSQL_POOL_MAX_OVERFLOW'],
+    timeout=app.config['MYSQL_POOL_TIMEOUT'],
+    recycle=app.config['MYSQL_POOL_RECYCLE'],
+    ping_interval=app.config['MYSQL_POOL_PING_INTERVAL'],
+)
 
 # Redis Configuration for Sessions and Caching
 # In production, set REDIS_HOST, REDIS_PORT, REDIS_PASSWORD in environment variables
@@ -544,15 +1133,205 @@ except Exception as e:
     print("[INFO] Falling back to Flask default sessions")
     REDIS_AVAILABLE = False
 
-# Note: Flask-Session disabled due to compatibility issues
-# Using Redis only for cart storage and caching
-# Sessions handled by Flask's default secure cookie-based sessions
 if REDIS_AVAILABLE:
     print("[OK] Redis available for cart storage and caching")
-    print("[INFO] Using Flask secure cookie-based sessions")
 else:
     print("[INFO] Using Flask default sessions and in-memory storage")
 
+# ============================================
+# Server-side Sessions
+# ============================================
+# The session cookie only carries a signed session id; the payload (cart id, pending order, payment
+# refs, ...) lives in a SessionStore. The payload is fetched only when a request actually touches the
+# session, and written back only when it was modified - unmodified sessions just get their TTL bumped.
+# SESSION_BACKEND: 'redis' (default when Redis is up), 'memory' (single process - tests/dev) or
+# 'cookie' (Flask's signed-cookie sessions, the fallback when Redis is unavailable).
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'redis' if REDIS_AVAILABLE else 'cookie')
+session_serializer = TaggedJSONSerializer()
+
+
+class RedisSessionStore:
+    prefix = "session:"
+
+    def load(self, sid):
+        data = redis_client.get(self.prefix + sid)
+        return session_serializer.loads(data) if data else None
+
+    def save(self, sid, data, ttl):
+        redis_client.setex(self.prefix + sid, ttl, session_serializer.dumps(data))
+
+    def touch(self, sid, ttl):
+        redis_client.expire(self.prefix + sid, ttl)
+
+    def delete(self, sid):
+        redis_client.delete(self.prefix + sid)
+
+
+class MemorySessionStore:
+    """Per-process store for tests and single-worker development"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = Lock()
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+            if entry is None or entry[1] <= time.time():
+                self._data.pop(sid, None)
+                return None
+            return session_serializer.loads(entry[0])
+
+    def save(self, sid, data, ttl):
+        with self._lock:
+            self._data[sid] = (session_serializer.dumps(data), time.time() + ttl)
+
+    def touch(self, sid, ttl):
+        with self._lock:
+            if sid in self._data:
+                self._data[sid] = (self._data[sid][0], time.time() + ttl)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+
+class ServerSideSession(SessionMixin):
+    """Session whose payload is loaded from the store on first access"""
+
+    def __init__(self, sid, store, new=False):
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        self.rotated_from = None
+        self._store = store
+        self._data = {} if new else None
+
+    def _load(self):
+        if self._data is None:
+            try:
+                self._data = self._store.load(self.sid) or {}
+            except Exception as e:
+                print(f"Session load error: {e}")
+                self._data = {}
+        self.accessed = True
+        return self._data
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del self._load()[key]
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def clear(self):
+        if self._load():
+            self._data.clear()
+            self.modified = True
+
+    def rotate(self):
+        """Move the payload to a fresh session id (session fixation protection)"""
+        self._load()
+        if self.rotated_from is None and not self.new:
+            self.rotated_from = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-side-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+                return ServerSideSession(sid, self.store)
+            except BadSignature:
+                pass
+        return ServerSideSession(secrets.token_urlsafe(32), self.store, new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        
+        if session.accessed:
+            response.vary.add('Cookie')
+        if not session.loaded:
+            # Never touched during this request - nothing to read, nothing to write
+            return
+        if not session.permanent and 'cart_id' in session:
+            # A guest session carries the id of their cart; keep it as long as the cart itself
+            ttl = max(ttl, CART_TTL)
+        
+        try:
+            if session.rotated_from:
+                self.store.delete(session.rotated_from)
+            if not session:
+                # Emptied (or never used): drop it instead of storing an empty payload
+                if not session.new:
+                    self.store.delete(session.sid)
+                    response.delete_cookie(name, domain=domain, path=path,
+                                           secure=self.get_cookie_secure(app), httponly=self.get_cookie_httponly(app))
+                return
+            if not session.modified:
+                self.store.touch(session.sid, ttl)
+                return
+            self.store.save(session.sid, dict(session), ttl)
+        except Exception as e:
+            print(f"Session save error: {e}")
+            return
+        
+        if session.new or session.permanent:
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid).decode(),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+if SESSION_BACKEND == 'redis' and REDIS_AVAILABLE:
+    app.session_interface = ServerSideSessionInterface(RedisSessionStore())
+    print("[OK] Using server-side sessions in Redis")
+elif SESSION_BACKEND == 'memory':
+    app.session_interface = ServerSideSessionInterface(MemorySessionStore())
+    print("[INFO] Using in-memory server-side sessions (single process only)")
+else:
+    print("[INFO] Using Flask secure cookie-based sessions")
+
 # ============================================
 # Google OAuth Configuration
 # ============================================
@@ -636,77 +1415,328 @@ def get_db_cursor():
         return None
 
 
-# Redis Helper Functions
+# ============================================
+# Cart Service
+# ============================================
+# Carts live in Redis, not in the session cookie - the cookie only carries an opaque cart_id.
+# Guests shop on cart:guest:<cart_id>; once logged in the cart is cart:user:<user_id>, so it follows
+# the user across devices. Login folds the guest cart into the user's (merge_guest_cart_into_user).
+# Each cart is two hashes keyed by cart line (e.g. "12", "12_img7_drop3"):
+#   cart:<owner>        -> quantity (so quantities change atomically with HINCRBY)
+#   cart:<owner>:lines  -> JSON line details (product_id, name, price, variations, img/dropdown ids)
+# Without Redis the same functions fall back to session['cart'].
+CART_TTL = 60 * 60 * 24 * 30  # 30 days, refreshed on every write
+
+
+def get_cart_id():
+    """Opaque per-browser cart id stored in the session"""
+    if 'cart_id' not in session:
+        session['cart_id'] = uuid.uuid4().hex
+        session.modified = True
+    return session['cart_id']
+
+
 def get_redis_cart_key(user_id=None):
-    """Generate Redis key for cart storage"""
+    """Generate Redis key for cart storage (the logged-in user's cart by default)"""
+    user_id = user_id or session.get('user_id')
     if user_id:
         return f"cart:user:{user_id}"
-    else:
-        # Use session ID for guest users
-        if 'session_id' not in session:
-            session['session_id'] = str(uuid.uuid4())
-            session.modified = True  # Important: save session_id to cookie
-        return f"cart:guest:{session['session_id']}"
+    return f"cart:guest:{get_cart_id()}"
 
 
-def save_cart_to_redis(cart_data, user_id=None):
-    """Save cart data to Redis with fallback to Flask session"""
-    if not REDIS_AVAILABLE:
-        session['cart'] = cart_data
-        return True
-    
-    try:
-        cart_key = get_redis_cart_key(user_id)
-        redis_client.setex(cart_key, 7200, json.dumps(cart_data))  # 2 hours TTL
-        return True
+def _session_cart():
+    if 'cart' not in session:
+        session['cart'] = {}
+    return session['cart']
+
+
+# Folds the guest hashes into the user's in one atomic step: quantities are summed and clamped to the
+# per-line stock limits passed in ARGV[2]; line details already on the user's cart win.
+MERGE_CART_SCRIPT = """
+local limits = cjson.decode(ARGV[2])
+local guest = redis.call('HGETALL', KEYS[1])
+for i = 1, #guest, 2 do
+    local line = guest[i]
+    local total = tonumber(guest[i + 1]) + tonumber(redis.call('HGET', KEYS[3], line) or '0')
+    local limit = limits[line]
+    if limit ~= nil and total > limit then
+        total = limit
+    end
+    if total > 0 then
+        redis.call('HSET', KEYS[3], line, total)
+        local details = redis.call('HGET', KEYS[2], line)
+        if details then
+            redis.call('HSETNX', KEYS[4], line, details)
+        end
+    else
+        redis.call('HDEL', KEYS[3], line)
+        redis.call('HDEL', KEYS[4], line)
+    end
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('EXPIRE', KEYS[3], tonumber(ARGV[1]))
+redis.call('EXPIRE', KEYS[4], tonumber(ARGV[1]))
+return #guest / 2
+"""
+merge_cart_script = redis_client.register_script(MERGE_CART_SCRIPT) if REDIS_AVAILABLE else None
+
+
+def parse_cart_line_key(line_key):
+    """'12_img7_drop3' -> ('12', '7', '3'); missing parts are ''"""
+    parts = str(line_key).split('_')
+    img_var_id = next((p[3:] for p in parts[1:] if p.startswith('img')), '')
+    dropdown_var_id = next((p[4:] for p in parts[1:] if p.startswith('drop')), '')
+    return parts[0], img_var_id, dropdown_var_id
+
+
+def get_cart_line_stock(cur, line_keys):
+    """Available stock per cart line (dropdown variation, else image variation, else product)"""
+    parsed = {key: parse_cart_line_key(key) for key in line_keys}
+    
+    def lookup(table, ids):
+        ids = sorted({i for i in ids if i})
+        if not ids:
+            return {}
+        cur.execute(f"SELECT id, stock FROM {table} WHERE id IN ({','.join(['%s'] * len(ids))})", ids)
+        return {str(row[0]): row[1] or 0 for row in cur.fetchall()}
+    
+    products = lookup('products', [p[0] for p in parsed.values()])
+    images = lookup('image_variations', [p[1] for p in parsed.values()])
+    dropdowns = lookup('dropdown_variation', [p[2] for p in parsed.values()])
+    
+    stock = {}
+    for key, (product_id, img_var_id, dropdown_var_id) in parsed.items():
+        if dropdown_var_id:
+            stock[key] = dropdowns.get(dropdown_var_id, 0)
+        elif img_var_id:
+            stock[key] = images.get(img_var_id, 0)
+        else:
+            stock[key] = products.get(product_id, 0)
+    return stock
+
+
+def merge_guest_cart_into_user(cur, user_id):
+    """On login, move this browser's guest cart into the user's cart. Returns the number of lines merged."""
+    if not REDIS_AVAILABLE or 'cart_id' not in session:
+        return 0
+    
+    guest_key = f"cart:guest:{session['cart_id']}"
+    user_key = get_redis_cart_key(user_id)
+    try:
+        line_keys = redis_client.hkeys(guest_key)
+        if not line_keys:
+            return 0
+        limits = get_cart_line_stock(cur, line_keys)
+        return merge_cart_script(
+            keys=[guest_key, f"{guest_key}:lines", user_key, f"{user_key}:lines"],
+            args=[CART_TTL, json.dumps(limits)]
+        )
     except Exception as e:
-        print(f"Redis cart save error: {e}")
-        # Fallback to session
-        session['cart'] = cart_data
-        return False
+        print(f"Cart merge error: {e}")
+        return 0
 
 
 def get_cart_from_redis(user_id=None):
-    """Get cart data from Redis with fallback to Flask session"""
+    """Current cart as {cart_key: {product_id, name, price, quantity, variations, img_var_id, dropdown_var_id}}"""
     if not REDIS_AVAILABLE:
         return session.get('cart', {})
     
     try:
         cart_key = get_redis_cart_key(user_id)
-        cart_data = redis_client.get(cart_key)
-        if cart_data:
-            return json.loads(cart_data)
-        return {}
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(cart_key)
+        pipe.hgetall(f"{cart_key}:lines")
+        quantities, lines = pipe.execute()
+        cart = {}
+        orphans = []
+        for line_key, qty in quantities.items():
+            qty = int(qty)
+            if qty <= 0:
+                continue
+            if line_key not in lines:
+                # Line details expired or never written: without name and price the line is unusable
+                orphans.append(line_key)
+                continue
+            line = json.loads(lines[line_key])
+            line['quantity'] = qty
+            cart[line_key] = line
+        if orphans:
+            redis_client.hdel(cart_key, *orphans)
+        return cart
     except Exception as e:
         print(f"Redis cart get error: {e}")
-        # Fallback to session
-        return session.get('cart', {})
+        return {}
+
+
+def add_cart_line(line_key, line, quantity, max_quantity=None, user_id=None):
+    """Add quantity to a cart line (created from `line` if new), clamped to max_quantity. Returns the new quantity."""
+    if not REDIS_AVAILABLE:
+        cart = _session_cart()
+        if line_key in cart:
+            cart[line_key]['quantity'] += quantity
+        else:
+            cart[line_key] = dict(line, quantity=quantity)
+        if max_quantity is not None and cart[line_key]['quantity'] > max_quantity:
+            cart[line_key]['quantity'] = max_quantity
+        session.modified = True
+        return cart[line_key]['quantity']
+    
+    cart_key = get_redis_cart_key(user_id)
+    pipe = redis_client.pipeline()
+    pipe.hsetnx(f"{cart_key}:lines", line_key, json.dumps(line))
+    pipe.hincrby(cart_key, line_key, quantity)
+    pipe.expire(cart_key, CART_TTL)
+    pipe.expire(f"{cart_key}:lines", CART_TTL)
+    new_qty = pipe.execute()[1]
+    if max_quantity is not None and new_qty > max_quantity:
+        # Give back the excess atomically rather than overwrite a concurrent change
+        new_qty = redis_client.hincrby(cart_key, line_key, max_quantity - new_qty)
+    return new_qty
+
+
+def set_cart_line_quantity(line_key, quantity, user_id=None):
+    """Set an existing cart line's quantity (removes the line when quantity <= 0)"""
+    if quantity <= 0:
+        return remove_cart_line(line_key, user_id)
+    if not REDIS_AVAILABLE:
+        cart = _session_cart()
+        if line_key in cart:
+            cart[line_key]['quantity'] = quantity
+            session.modified = True
+        return True
+    
+    cart_key = get_redis_cart_key(user_id)
+    pipe = redis_client.pipeline()
+    pipe.hset(cart_key, line_key, quantity)
+    pipe.expire(cart_key, CART_TTL)
+    pipe.expire(f"{cart_key}:lines", CART_TTL)
+    pipe.execute()
+    return True
+
+
+def remove_cart_line(line_key, user_id=None):
+    if not REDIS_AVAILABLE:
+        _session_cart().pop(line_key, None)
+        session.modified = True
+        return True
+    
+    cart_key = get_redis_cart_key(user_id)
+    pipe = redis_client.pipeline()
+    pipe.hdel(cart_key, line_key)
+    pipe.hdel(f"{cart_key}:lines", line_key)
+    pipe.execute()
+    return True
+
+
+def cart_item_count(user_id=None):
+    """Total number of items in the cart"""
+    if not REDIS_AVAILABLE:
+        return sum(item['quantity'] for item in session.get('cart', {}).values())
+    
+    try:
+        return sum(max(int(q), 0) for q in redis_client.hvals(get_redis_cart_key(user_id)))
+    except Exception as e:
+        print(f"Redis cart count error: {e}")
+        return 0
 
 
 def clear_cart_from_redis(user_id=None):
-    """Clear cart data from Redis with fallback to Flask session"""
+    """Empty the cart"""
     if not REDIS_AVAILABLE:
-        session.pop('cart', None)
+        session['cart'] = {}
+        session.modified = True
         return True
     
     try:
         cart_key = get_redis_cart_key(user_id)
-        redis_client.delete(cart_key)
+        redis_client.delete(cart_key, f"{cart_key}:lines")
         return True
     except Exception as e:
         print(f"Redis cart clear error: {e}")
-        # Fallback to session
-        session.pop('cart', None)
         return False
 
 
-def cache_data(key, data, ttl=3600):
-    """Cache data in Redis with TTL (default 1 hour)"""
+# Two-tier cache: a small per-worker LRU in front of Redis.
+# Entries are stamped with generation counters kept in Redis: one per key (cachever:<key>) and one per
+# tag the entry depends on (cachetag:<tag>, e.g. product:12, category:3, catalog). Bumping a counter
+# with invalidate_cache()/invalidate_tags() is O(1) and makes every dependent entry - in Redis and in
+# every worker's LRU - stale at once, without scanning the keyspace. A local entry is trusted for
+# CACHE_LOCAL_TTL seconds, then revalidated with one MGET of its counters instead of a payload read.
+CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get('CACHE_LOCAL_MAX_ENTRIES', 512))
+CACHE_LOCAL_TTL = int(os.environ.get('CACHE_LOCAL_TTL', 30))
+CACHE_TAG_ALL = 'all'  # implicit on every entry; bumped by clear_cache()
+
+
+class LocalLRUCache:
+    """Bounded, thread-safe LRU of key -> (value, stamp, tags, checked_at, expires_at)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[4] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, stamp, tags, expires_at):
+        with self._lock:
+            self._entries[key] = (value, stamp, tags, time.time(), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def touch(self, key):
+        """Mark an entry as revalidated now"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = entry[:3] + (time.time(), entry[4])
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def delete_tagged(self, tag):
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if tag in entry[2]]:
+                del self._entries[key]
+
+
+local_cache = LocalLRUCache(CACHE_LOCAL_MAX_ENTRIES)
+
+
+def _stamp_keys(key, tags):
+    return [f"cachever:{key}"] + [f"cachetag:{tag}" for tag in tags]
+
+
+def _cache_stamp(key, tags):
+    """Current generation counters of a key and its tags (all 0 without Redis)"""
     if not REDIS_AVAILABLE:
-        return False
+        return [0] * (len(tags) + 1)
+    return [int(v or 0) for v in redis_client.mget(_stamp_keys(key, tags))]
+
+
+def cache_data(key, data, ttl=3600, tags=()):
+    """Cache data in both tiers with TTL (default 1 hour), dependent on the given tags.
+    Cached values are shared between requests - treat them as read-only."""
+    tags = [CACHE_TAG_ALL] + [t for t in tags if t != CACHE_TAG_ALL]
+    expires_at = time.time() + ttl
+    if not REDIS_AVAILABLE:
+        local_cache.set(key, data, None, tags, expires_at)
+        return True
     
     try:
-        redis_client.setex(f"cache:{key}", ttl, json.dumps(data))
+        stamp = _cache_stamp(key, tags)
+        redis_client.setex(f"cache:{key}", ttl, json.dumps({'s': stamp, 't': tags, 'd': data}))
+        local_cache.set(key, data, stamp, tags, expires_at)
         return True
     except Exception as e:
         print(f"Redis cache set error: {e}")
@@ -714,53 +1744,240 @@ def cache_data(key, data, ttl=3600):
 
 
 def get_cached_data(key):
-    """Get cached data from Redis"""
+    """Get cached data from the local LRU, falling back to Redis"""
+    entry = local_cache.get(key)
+    if entry is not None:
+        value, stamp, tags, checked_at, _ = entry
+        if not REDIS_AVAILABLE or time.time() - checked_at < CACHE_LOCAL_TTL:
+            return value
+        try:
+            if _cache_stamp(key, tags) == stamp:
+                local_cache.touch(key)
+                return value
+        except Exception as e:
+            print(f"Redis cache version error: {e}")
+            return value
+        local_cache.delete(key)
+    
     if not REDIS_AVAILABLE:
         return None
     
     try:
-        cached_data = redis_client.get(f"cache:{key}")
-        if cached_data:
-            return json.loads(cached_data)
-        return None
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(f"cache:{key}")
+        pipe.ttl(f"cache:{key}")
+        cached_data, ttl = pipe.execute()
+        if not cached_data:
+            return None
+        envelope = json.loads(cached_data)
+        if not isinstance(envelope, dict) or 's' not in envelope:
+            return None
+        if _cache_stamp(key, envelope['t']) != envelope['s']:
+            return None
+        local_cache.set(key, envelope['d'], envelope['s'], envelope['t'], time.time() + max(ttl, 1))
+        return envelope['d']
     except Exception as e:
         print(f"Redis cache get error: {e}")
         return None
 
 
-def clear_cache(pattern="*"):
-    """Clear cache with optional pattern"""
+def invalidate_cache(key):
+    """Invalidate one key in every worker's local tier and in Redis (O(1))"""
+    local_cache.delete(key)
     if not REDIS_AVAILABLE:
+        return True
+    
+    try:
+        redis_client.incr(f"cachever:{key}")
+        return True
+    except Exception as e:
+        print(f"Redis cache invalidate error: {e}")
         return False
+
+
+def invalidate_tags(*tags):
+    """Invalidate every entry depending on any of the tags, in both tiers (O(1) per tag)"""
+    for tag in tags:
+        local_cache.delete_tagged(tag)
+    if not REDIS_AVAILABLE or not tags:
+        return True
     
     try:
-        keys = redis_client.keys(f"cache:{pattern}")
-        if keys:
-            redis_client.delete(*keys)
+        pipe = redis_client.pipeline(transaction=False)
+        for tag in tags:
+            pipe.incr(f"cachetag:{tag}")
+        pipe.execute()
         return True
     except Exception as e:
-        print(f"Redis cache clear error: {e}")
+        print(f"Redis cache invalidate error: {e}")
         return False
 
 
-def get_cached_categories():
-    """Get categories from cache or database"""
-    cache_key = "categories"
-    cached_categories = get_cached_data(cache_key)
+def clear_cache():
+    """Invalidate the whole cache without scanning Redis (bumps the tag every entry carries)"""
+    return invalidate_tags(CACHE_TAG_ALL)
+
+
+def category_cache_tag(category_id):
+    """Tag for entries that depend on the products of one category ('uncategorized' for none)"""
+    return f"category:{category_id or 'uncategorized'}"
+
+
+def note_product_changed(cur, product_id):
+    """Record that a product's price/stock/rating changed. Inside a request the dependent cache
+    entries are invalidated after the request (so after its commit); elsewhere immediately."""
+    note_products_changed(cur, [product_id])
+
+
+def note_products_changed(cur, product_ids, changed_tags=None):
+    """note_product_changed() for several products, with one category lookup. Callers outside a
+    request that commit later pass a changed_tags set and invalidate_changed_tags() it after committing."""
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        return
+    tags = {f"product:{product_id}" for product_id in product_ids}
+    try:
+        cur.execute(f"SELECT id, category_id FROM products WHERE id IN ({','.join(['%s'] * len(product_ids))})",
+                    product_ids)
+        categories = {row[1] for row in cur.fetchall()}
+        tags.add('products')
+        tags.update(category_cache_tag(category_id) for category_id in categories or {None})
+    except Exception as e:
+        print(f"Cache tag lookup error: {e}")
+        tags.add(CACHE_TAG_ALL)
+    if changed_tags is not None:
+        changed_tags.update(tags)
+    elif has_request_context():
+        g.setdefault('changed_cache_tags', set()).update(tags)
+    else:
+        invalidate_changed_tags(tags)
+
+
+def invalidate_changed_tags(tags):
+    if tags:
+        invalidate_tags(*tags)
+        # Stock, price and rating feed the home sections too
+        mark_home_sections_stale()
+
+
+@app.teardown_request
+def flush_changed_cache_tags(exception=None):
+    invalidate_changed_tags(g.pop('changed_cache_tags', None))
+
+
+def tracks_product_change(f):
+    """For helpers taking (cur, product_id, ...) that modify a product row"""
+    @wraps(f)
+    def wrapper(cur, product_id, *args, **kwargs):
+        result = f(cur, product_id, *args, **kwargs)
+        note_product_changed(cur, product_id)
+        return result
+    return wrapper
+
+
+# Stampede protection for expensive cache misses.
+# Values are stored with a logical expiry and kept readable for a grace period past it. When an entry
+# goes stale (or is picked for an early refresh) exactly one caller recomputes it - guarded by a
+# Redis lock across workers and a per-key lock within one - while everyone else keeps serving the
+# stale value. With nothing cached at all, the losers wait briefly for the winner's result.
+# Early refresh follows the XFetch rule: recompute when now - delta * beta * ln(rand()) >= expiry,
+# so the most expensive keys start refreshing a little before they expire, staggered per caller.
+CACHE_STALE_GRACE = int(os.environ.get('CACHE_STALE_GRACE', 300))
+CACHE_EARLY_REFRESH_BETA = 1.0
+CACHE_LOCK_TIMEOUT = 30
+CACHE_MISS_WAIT = 2.0
+
+# Keys this worker is recomputing right now. An entry only exists while its computation runs, so
+# arbitrary keys (e.g. filter digests) never pile up and unrelated keys never block each other.
+_computing_keys = set()
+_computing_keys_lock = Lock()
+
+
+def _acquire_compute_lock(key):
+    """Returns a release callback if this caller should recompute `key`, else None"""
+    with _computing_keys_lock:
+        if key in _computing_keys:
+            return None
+        _computing_keys.add(key)
+    
+    def release_local():
+        with _computing_keys_lock:
+            _computing_keys.discard(key)
     
-    if cached_categories:
-        return cached_categories
+    if not REDIS_AVAILABLE:
+        return release_local
     
+    token = secrets.token_hex(8)
     try:
+        if not redis_client.set(f"lock:cache:{key}", token, nx=True, ex=CACHE_LOCK_TIMEOUT):
+            release_local()
+            return None
+    except Exception as e:
+        print(f"Redis cache lock error: {e}")
+        return release_local
+    
+    def release():
+        try:
+            # Only delete the lock if it is still ours
+            if redis_client.get(f"lock:cache:{key}") == token:
+                redis_client.delete(f"lock:cache:{key}")
+        except Exception:
+            pass
+        release_local()
+    return release
+
+
+def _should_refresh_early(entry, now):
+    delta = entry.get('delta') or 0
+    return now - delta * CACHE_EARLY_REFRESH_BETA * math.log(random.random() or 1e-12) >= entry['expires']
+
+
+def get_or_compute(key, compute, ttl, tags=()):
+    """Cached value of compute() with single-flight recomputation, stale-serve and early refresh"""
+    entry = get_cached_data(key)
+    if not (isinstance(entry, dict) and 'expires' in entry):
+        entry = None
+    now = time.time()
+    if entry is not None and now < entry['expires'] and not _should_refresh_early(entry, now):
+        return entry['value']
+    
+    release = _acquire_compute_lock(key)
+    if release is None:
+        if entry is not None:
+            # Someone else is refreshing; the stale value is good enough meanwhile
+            return entry['value']
+        deadline = time.time() + CACHE_MISS_WAIT
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = get_cached_data(key)
+            if isinstance(entry, dict) and 'expires' in entry:
+                return entry['value']
+        # The winner is slow or gone - compute without caching rather than fail the request
+        return compute()
+    
+    try:
+        started = time.time()
+        value = compute()
+        finished = time.time()
+        cache_data(key, {'value': value, 'expires': finished + ttl, 'delta': finished - started},
+                   ttl + CACHE_STALE_GRACE, tags=tags)
+        return value
+    finally:
+        release()
+
+
+def get_cached_categories():
+    """Get categories from cache or database"""
+    def load():
         cur = mysql.connection.cursor()
         cur.execute("SELECT * FROM categories")
         categories_data = cur.fetchall()
-        categories = [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
         cur.close()
-        
+        return [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
+    
+    try:
         # Cache for 1 hour
-        cache_data(cache_key, categories, 3600)
-        return categories
+        return get_or_compute("categories", load, 3600, tags=['catalog', 'categories'])
     except Exception as e:
         print(f"Error fetching categories: {e}")
         return []
@@ -768,13 +1985,7 @@ def get_cached_categories():
 
 def get_cached_products(category_id=None, limit=None):
     """Get products from cache or database"""
-    cache_key = f"products_cat_{category_id}_limit_{limit}"
-    cached_products = get_cached_data(cache_key)
-    
-    if cached_products:
-        return cached_products
-    
-    try:
+    def load():
         cur = mysql.connection.cursor()
         if category_id:
             if limit:
@@ -794,191 +2005,429 @@ def get_cached_products(category_id=None, limit=None):
             if product:
                 products.append(product)
         cur.close()
-        
-        # Cache for 30 minutes
-        cache_data(cache_key, products, 1800)
         return products
+    
+    try:
+        # Cache for 30 minutes
+        tags = ['catalog', category_cache_tag(category_id) if category_id else 'products']
+        return get_or_compute(f"products_cat_{category_id}_limit_{limit}", load, 1800, tags=tags)
     except Exception as e:
         print(f"Error fetching products: {e}")
         return []
 
 
-def deduct_stock_smartly(cur, product_id, quantity, variations_string):
-    """
-    Deduct stock from the appropriate level based on variations.
-    Uses the hierarchy: dropdown_variation -> image_variation -> product
-    Your triggers will cascade the updates automatically.
-    """
+# ============================================
+# Random Product Sampling
+# ============================================
+# "Random picks" are sampled in Python from a cached {category_id: [product ids]} map and then only
+# the chosen rows are fetched by primary key, instead of ORDER BY RAND() sorting a whole category.
+PRODUCT_IDS_CACHE_KEY = "product_ids_by_category"
+PRODUCT_IDS_TTL = 1800
+
+
+def get_product_ids_by_category(cur):
+    """{str(category_id): [product ids]} for the whole catalog (cache, then MySQL)"""
+    def load():
+        cur.execute("SELECT id, category_id FROM products")
+        ids_by_category = {}
+        for prod_id, category_id in cur.fetchall():
+            ids_by_category.setdefault(str(category_id), []).append(prod_id)
+        return ids_by_category
+    
+    return get_or_compute(PRODUCT_IDS_CACHE_KEY, load, PRODUCT_IDS_TTL, tags=['catalog'])
+
+
+def invalidate_product_ids():
+    invalidate_cache(PRODUCT_IDS_CACHE_KEY)
+
+
+def fetch_products_by_ids(cur, product_ids):
+    """Product dicts (with discount) for the given ids, keeping their order"""
+    if not product_ids:
+        return []
+    placeholders = ','.join(['%s'] * len(product_ids))
+    cur.execute(f"SELECT * FROM products WHERE id IN ({placeholders})", list(product_ids))
+    rows_by_id = {row[0]: row for row in cur.fetchall()}
+    products = []
+    for prod_id in product_ids:
+        product = get_product_with_discount(rows_by_id.get(prod_id))
+        if product:
+            products.append(product)
+    return products
+
+
+def sample_category_products(cur, category_id, count, exclude_id=None):
+    """Up to `count` random products from a category, fetched in one primary-key query"""
+    ids = [i for i in get_product_ids_by_category(cur).get(str(category_id), []) if i != exclude_id]
+    return fetch_products_by_ids(cur, random.sample(ids, min(count, len(ids))))
+
+
+def sample_diverse_product_ids(cur, count):
+    """Random product ids spread across categories: one per category per round until `count`"""
+    pools = [random.sample(ids, len(ids)) for ids in get_product_ids_by_category(cur).values() if ids]
+    random.shuffle(pools)
+    picked = []
+    while pools and len(picked) < count:
+        for pool in list(pools):
+            if len(picked) >= count:
+                break
+            picked.append(pool.pop())
+            if not pool:
+                pools.remove(pool)
+    return picked
+
+
+# ============================================
+# Home Page Sections (prebuilt)
+# ============================================
+# The curated sections on / are built off the request path by a background refresher, published to
+# Redis for all workers and mirrored in process. Requests only read the prebuilt structure.
+# Catalog and stock changes bump a generation counter in Redis; every worker's refresher checks it
+# every few seconds and adopts (or rebuilds) sections built at the current generation.
+HOME_SECTIONS_REFRESH_INTERVAL = int(os.environ.get('HOME_SECTIONS_REFRESH_INTERVAL', 300))
+HOME_SECTIONS_POLL_INTERVAL = 5
+HOME_SECTIONS_CACHE_KEY = "home_sections"
+HOME_SECTIONS_LOCK_KEY = "lock:home_sections_refresh"
+HOME_SECTIONS_GENERATION_KEY = "home_sections:generation"
+EXPLORE_MORE_COUNT = 12
+EXPLORE_POOL_SIZE = 48
+
+_home_sections = {'data': None, 'loaded_at': 0}
+_home_sections_lock = Lock()
+_home_refresher_started = False
+_home_refresh_event = None
+
+
+def build_home_sections(cur):
+    """Run the catalog queries behind the home page and return a JSON-serializable payload"""
+    cur.execute("SELECT * FROM categories")
+    categories = [{'id': cat[0], 'name': cat[1]} for cat in cur.fetchall()]
+    
+    products_sections = {}
+    
+    # 1. Top Selling - 8 products (prioritize rated products, then show any products)
+    cur.execute("""
+        SELECT * FROM products 
+        WHERE stock > 0
+        ORDER BY COALESCE(rate, 0) DESC, id DESC
+        LIMIT 8
+    """)
+    top_selling = [p for p in (get_product_with_discount(row) for row in cur.fetchall()) if p]
+    if top_selling:
+        products_sections['top_selling'] = {'name': 'Top Selling', 'products': top_selling, 'order': 1}
+    
+    # 2. New Arrivals - 8 newest products
+    cur.execute("""
+        SELECT * FROM products 
+        WHERE stock > 0
+        ORDER BY id DESC
+        LIMIT 8
+    """)
+    new_arrivals = [p for p in (get_product_with_discount(row) for row in cur.fetchall()) if p]
+    if new_arrivals:
+        products_sections['new_arrivals'] = {'name': 'New Arrivals', 'products': new_arrivals, 'order': 2}
+    
+    # 3. On Sale - 8 products with highest discount
+    cur.execute("""
+        SELECT * FROM products 
+        WHERE discount > 0
+        ORDER BY discount DESC
+        LIMIT 8
+    """)
+    on_sale = [p for p in (get_product_with_discount(row) for row in cur.fetchall()) if p]
+    if on_sale:
+        products_sections['on_sale'] = {'name': 'On Sale', 'products': on_sale, 'order': 3}
+    
+    # 4. Explore More - a pool of random products spread across categories; each visit
+    # shows a fresh sample of it (see explore_more_section), so no ORDER BY RAND() here
     try:
-        print(f"STOCK DEDUCTION: product_id={product_id}, qty={quantity}, variations='{variations_string}'")
-        
-        if not variations_string or variations_string.strip() == '':
-            # No variations - deduct from product directly
-            print("STOCK DEDUCTION: No variations, updating product stock")
-            cur.execute("UPDATE products SET stock = stock - %s WHERE id = %s", (quantity, product_id))
-            return "product"
-        
-        # Parse variations string (format: "color:Red, size:41" or "color:Red")
-        variations = {}
-        for part in variations_string.split(','):
-            if ':' in part:
-                key, value = part.split(':', 1)
-                variations[key.strip().lower()] = value.strip()
-        
-        print(f"STOCK DEDUCTION: Parsed variations: {variations}")
-        
-        # Check if we have both color/style AND size (dropdown variation)
-        has_color_or_style = any(k in variations for k in ['color', 'style'])
-        has_size = 'size' in variations
-        
-        if has_color_or_style and has_size:
-            # Try to find specific dropdown variation
-            color_or_style = variations.get('color') or variations.get('style')
-            size_value = variations.get('size')
-            
-            # First find the image_variation ID
-            cur.execute("""
-                SELECT id FROM image_variations 
-                WHERE prod_id = %s AND (
-                    (type = 'color' AND name = %s) OR 
-                    (type = 'style' AND name = %s)
-                )
-            """, (product_id, color_or_style, color_or_style))
-            
-            img_var_result = cur.fetchone()
-            if img_var_result:
-                img_var_id = img_var_result[0]
-                
-                # Now find the dropdown variation
-                cur.execute("""
-                    SELECT id FROM dropdown_variation 
-                    WHERE prod_id = %s AND img_var_id = %s AND attr_value = %s
-                """, (product_id, img_var_id, size_value))
-                
-                dropdown_result = cur.fetchone()
-                if dropdown_result:
-                    dropdown_id = dropdown_result[0]
-                    print(f"STOCK DEDUCTION: Updating dropdown_variation id={dropdown_id}")
-                    cur.execute("UPDATE dropdown_variation SET stock = stock - %s WHERE id = %s", (quantity, dropdown_id))
-                    return "dropdown"
-        
-        # If no dropdown found, try image variation only
-        if has_color_or_style:
-            color_or_style = variations.get('color') or variations.get('style')
-            cur.execute("""
-                SELECT id FROM image_variations 
-                WHERE prod_id = %s AND (
-                    (type = 'color' AND name = %s) OR 
-                    (type = 'style' AND name = %s)
-                )
-            """, (product_id, color_or_style, color_or_style))
-            
-            img_var_result = cur.fetchone()
-            if img_var_result:
-                img_var_id = img_var_result[0]
-                print(f"STOCK DEDUCTION: Updating image_variation id={img_var_id}")
-                cur.execute("UPDATE image_variations SET stock = stock - %s WHERE id = %s", (quantity, img_var_id))
-                return "image"
-        
-        # Fallback to product level
-        print("STOCK DEDUCTION: Fallback to product stock")
-        cur.execute("UPDATE products SET stock = stock - %s WHERE id = %s", (quantity, product_id))
-        return "product"
-        
+        explore_pool = fetch_products_by_ids(cur, sample_diverse_product_ids(cur, EXPLORE_POOL_SIZE))
     except Exception as e:
-        print(f"STOCK DEDUCTION ERROR: {e}")
-        # Fallback to product level on any error
-        cur.execute("UPDATE products SET stock = stock - %s WHERE id = %s", (quantity, product_id))
-        return "product_fallback"
+        print(f"[HOME] Explore pool error: {e}")
+        explore_pool = []
+    
+    # Sort sections by order field; a list keeps the order through JSON
+    ordered = sorted(products_sections.items(), key=lambda x: x[1].get('order', 999))
+    return {'categories': categories, 'products_sections': ordered, 'explore_pool': explore_pool, 'built_at': time.time()}
 
 
-def restore_stock_smartly(cur, product_id, quantity, variations_string):
-    """
-    Restore stock to the appropriate level based on variations (opposite of deduct_stock_smartly).
-    Uses the hierarchy: dropdown_variation -> image_variation -> product
-    Your triggers will cascade the updates automatically.
-    """
+def explore_more_section(explore_pool):
+    """Per-visit 'Explore More' section sampled from the prebuilt pool"""
+    if not explore_pool:
+        return None
+    return {
+        'name': 'Explore More',
+        'products': random.sample(explore_pool, min(EXPLORE_MORE_COUNT, len(explore_pool))),
+        'order': 99
+    }
+
+
+def _store_home_sections(payload):
+    with _home_sections_lock:
+        _home_sections['data'] = payload
+        _home_sections['loaded_at'] = time.time()
+
+
+def catalog_generation():
+    """Current catalog generation (0 without Redis, None if Redis can't be read)"""
+    if not REDIS_AVAILABLE:
+        return 0
     try:
-        print(f"STOCK RESTORATION: product_id={product_id}, qty={quantity}, variations='{variations_string}'")
-        
-        if not variations_string or variations_string.strip() == '':
-            # No variations - restore to product directly
-            print("STOCK RESTORATION: No variations, updating product stock")
-            cur.execute("UPDATE products SET stock = stock + %s WHERE id = %s", (quantity, product_id))
-            return "product"
-        
-        # Parse variations string (format: "color:Red, size:41" or "color:Red")
-        variations = {}
-        for part in variations_string.split(','):
-            if ':' in part:
-                key, value = part.split(':', 1)
-                variations[key.strip().lower()] = value.strip()
-        
-        print(f"STOCK RESTORATION: Parsed variations: {variations}")
-        
-        # Check if we have both color/style AND size (dropdown variation)
-        has_color_or_style = any(k in variations for k in ['color', 'style'])
-        has_size = 'size' in variations
-        
-        if has_color_or_style and has_size:
-            # Try to find specific dropdown variation
-            color_or_style = variations.get('color') or variations.get('style')
-            size_value = variations.get('size')
-            
-            # First find the image_variation ID
-            cur.execute("""
-                SELECT id FROM image_variations 
-                WHERE prod_id = %s AND (
-                    (type = 'color' AND name = %s) OR 
-                    (type = 'style' AND name = %s)
-                )
-            """, (product_id, color_or_style, color_or_style))
-            
-            img_var_result = cur.fetchone()
-            if img_var_result:
-                img_var_id = img_var_result[0]
-                
-                # Now find the dropdown variation
-                cur.execute("""
-                    SELECT id FROM dropdown_variation 
-                    WHERE prod_id = %s AND img_var_id = %s AND attr_value = %s
-                """, (product_id, img_var_id, size_value))
-                
-                dropdown_result = cur.fetchone()
-                if dropdown_result:
-                    dropdown_id = dropdown_result[0]
-                    print(f"STOCK RESTORATION: Updating dropdown_variation id={dropdown_id}")
-                    cur.execute("UPDATE dropdown_variation SET stock = stock + %s WHERE id = %s", (quantity, dropdown_id))
-                    return "dropdown"
-        
-        # If no dropdown found, try image variation only
-        if has_color_or_style:
-            color_or_style = variations.get('color') or variations.get('style')
-            cur.execute("""
-                SELECT id FROM image_variations 
-                WHERE prod_id = %s AND (
-                    (type = 'color' AND name = %s) OR 
-                    (type = 'style' AND name = %s)
-                )
-            """, (product_id, color_or_style, color_or_style))
-            
-            img_var_result = cur.fetchone()
-            if img_var_result:
-                img_var_id = img_var_result[0]
-                print(f"STOCK RESTORATION: Updating image_variation id={img_var_id}")
-                cur.execute("UPDATE image_variations SET stock = stock + %s WHERE id = %s", (quantity, img_var_id))
-                return "image"
-        
-        # Fallback to product level
-        print("STOCK RESTORATION: Fallback to product stock")
-        cur.execute("UPDATE products SET stock = stock + %s WHERE id = %s", (quantity, product_id))
-        return "product"
-        
+        return int(redis_client.get(HOME_SECTIONS_GENERATION_KEY) or 0)
     except Exception as e:
-        print(f"STOCK RESTORATION ERROR: {e}")
-        # Fallback to product level on any error
-        cur.execute("UPDATE products SET stock = stock + %s WHERE id = %s", (quantity, product_id))
-        return "product_fallback"
+        print(f"[HOME] Generation read error: {e}")
+        return None
+
+
+def refresh_home_sections(generation=0):
+    """Rebuild the home sections from MySQL and publish them. Only one worker rebuilds at a time."""
+    if REDIS_AVAILABLE:
+        try:
+            if not redis_client.set(HOME_SECTIONS_LOCK_KEY, '1', nx=True, ex=60):
+                # Another worker is rebuilding; pick up its result on the next read
+                return False
+        except Exception as e:
+            print(f"[HOME] Refresh lock error: {e}")
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            try:
+                payload = build_home_sections(cur)
+            finally:
+                cur.close()
+        payload['generation'] = generation
+        _store_home_sections(payload)
+        # Keep it in Redis well past the interval so a stalled refresher never empties the home page
+        cache_data(HOME_SECTIONS_CACHE_KEY, payload, ttl=HOME_SECTIONS_REFRESH_INTERVAL * 12, tags=['catalog'])
+        return True
+    except Exception as e:
+        print(f"[HOME] Refresh failed: {e}")
+        return False
+    finally:
+        if REDIS_AVAILABLE:
+            try:
+                redis_client.delete(HOME_SECTIONS_LOCK_KEY)
+            except Exception:
+                pass
+
+
+def sync_home_sections():
+    """Bring this worker's copy up to date: adopt sections another worker published for the current
+    generation, else rebuild them"""
+    generation = catalog_generation()
+    with _home_sections_lock:
+        data = _home_sections['data']
+        stale = data is None or time.time() - _home_sections['loaded_at'] >= HOME_SECTIONS_REFRESH_INTERVAL
+    if generation is None:
+        generation = data.get('generation', 0) if data else 0
+    elif not stale and data.get('generation') != generation:
+        stale = True
+    if not stale:
+        return
+    cached = get_cached_data(HOME_SECTIONS_CACHE_KEY)
+    if (cached and cached.get('generation') == generation
+            and time.time() - cached.get('built_at', 0) < HOME_SECTIONS_REFRESH_INTERVAL):
+        _store_home_sections(cached)
+        return
+    refresh_home_sections(generation)
+
+
+def _home_refresher_loop():
+    while True:
+        try:
+            sync_home_sections()
+        except Exception as e:
+            print(f"[HOME] Refresher error: {e}")
+        # Wake on this worker's own catalog changes, else poll the shared generation
+        _home_refresh_event.wait(HOME_SECTIONS_POLL_INTERVAL)
+        _home_refresh_event.clear()
+
+
+def start_home_refresher():
+    """Start this worker's background refresher (idempotent)"""
+    global _home_refresher_started, _home_refresh_event
+    with _home_sections_lock:
+        if _home_refresher_started:
+            return
+        _home_refresher_started = True
+        _home_refresh_event = Event()
+    Thread(target=_home_refresher_loop, name='home-sections-refresher', daemon=True).start()
+
+
+def mark_catalog_changed():
+    """Call after creating, deleting or re-categorising products, or changing categories"""
+    invalidate_tags('catalog')
+    invalidate_product_ids()
+    mark_home_sections_stale()
+
+
+def mark_home_sections_stale():
+    """Have every worker rebuild its home sections promptly (stock, price or rating changed)"""
+    if REDIS_AVAILABLE:
+        try:
+            redis_client.incr(HOME_SECTIONS_GENERATION_KEY)
+        except Exception as e:
+            print(f"[HOME] Generation bump error: {e}")
+    with _home_sections_lock:
+        _home_sections['loaded_at'] = 0
+    if _home_refresh_event is not None:
+        _home_refresh_event.set()
+
+
+def get_home_sections():
+    """Prebuilt home payload: in-process copy, then Redis, then (cold start only) a synchronous build"""
+    start_home_refresher()
+    with _home_sections_lock:
+        data = _home_sections['data']
+        fresh = data is not None and time.time() - _home_sections['loaded_at'] < HOME_SECTIONS_REFRESH_INTERVAL
+    if fresh:
+        return data
+    
+    cached = get_cached_data(HOME_SECTIONS_CACHE_KEY)
+    if cached:
+        _store_home_sections(cached)
+        return cached
+    if data is not None:
+        # Redis unavailable or not yet repopulated - the previous copy beats querying inline
+        return data
+    
+    cur = get_db_cursor()
+    if not cur:
+        return None
+    try:
+        payload = build_home_sections(cur)
+    finally:
+        cur.close()
+    _store_home_sections(payload)
+    return payload
+
+
+# ============================================
+# Stock Engine
+# ============================================
+# Order lines name the exact row their stock lives in: the dropdown variation if the shopper picked
+# one, else the image variation, else the product (the same rule get_cart_line_stock() uses). Cart
+# lines carry img_var_id/dropdown_var_id from add-to-cart through to order_items, so applying an
+# order is one UPDATE per level for the whole order instead of lookups and an UPDATE per line.
+# Deductions only touch rows with stock >= qty, and the rowcount must match: a short row raises
+# InsufficientStockError and the caller rolls the order back. The database triggers still cascade
+# each change up to image_variations and products.
+STOCK_TABLES = {'dropdown': 'dropdown_variation', 'image': 'image_variations', 'product': 'products'}
+
+
+class InsufficientStockError(Exception):
+    """Raised when an order line asks for more stock than its row has left"""
+
+
+def lookup_variation_ids(cur, product_id, variations_string):
+    """
+    (img_var_id, dropdown_var_id) for a line stored without them, from its variations string
+    ("color:Red, size:41"). Only lines saved before the ids were recorded need this.
+    """
+    variations = {}
+    for part in (variations_string or '').split(','):
+        if ':' in part:
+            key, value = part.split(':', 1)
+            variations[key.strip().lower()] = value.strip()
+    color_or_style = variations.get('color') or variations.get('style')
+    if not color_or_style:
+        return None, None
+    cur.execute("""
+        SELECT id FROM image_variations
+        WHERE prod_id = %s AND (
+            (type = 'color' AND name = %s) OR
+            (type = 'style' AND name = %s)
+        )
+    """, (product_id, color_or_style, color_or_style))
+    row = cur.fetchone()
+    if not row:
+        return None, None
+    img_var_id = row[0]
+    if 'size' not in variations:
+        return img_var_id, None
+    cur.execute("""
+        SELECT id FROM dropdown_variation
+        WHERE prod_id = %s AND img_var_id = %s AND attr_value = %s
+    """, (product_id, img_var_id, variations['size']))
+    row = cur.fetchone()
+    return img_var_id, row[0] if row else None
+
+
+def stock_targets(cur, lines):
+    """
+    Sum order lines into {level: {row_id: (product_id, qty)}}. Each line is a dict with
+    product_id (or id), quantity, and optionally img_var_id, dropdown_var_id and variations.
+    """
+    targets = {level: {} for level in STOCK_TABLES}
+    for line in lines:
+        quantity = int(line['quantity'])
+        if quantity <= 0:
+            continue
+        product_id = int(line.get('product_id', line.get('id')))
+        img_var_id = line.get('img_var_id')
+        dropdown_var_id = line.get('dropdown_var_id')
+        if 'img_var_id' not in line and 'dropdown_var_id' not in line and line.get('variations'):
+            img_var_id, dropdown_var_id = lookup_variation_ids(cur, product_id, line['variations'])
+        if dropdown_var_id:
+            level, row_id = 'dropdown', int(dropdown_var_id)
+        elif img_var_id:
+            level, row_id = 'image', int(img_var_id)
+        else:
+            level, row_id = 'product', product_id
+        owner, total = targets[level].get(row_id, (product_id, 0))
+        targets[level][row_id] = (owner, total + quantity)
+    return targets
+
+
+def _apply_stock(cur, targets, sign):
+    """
+    Lock then update each level's rows; returns {level: rows changed}. A multi-row UPDATE locks
+    rows in whatever order its plan visits them, so the rows are first locked with an explicit
+    ORDER BY id FOR UPDATE. Levels always go in STOCK_TABLES order, so concurrent orders sharing
+    rows queue behind each other instead of deadlocking.
+    """
+    changed = {}
+    for level, rows in targets.items():
+        if not rows:
+            continue
+        table = STOCK_TABLES[level]
+        owner = 't.id' if level == 'product' else 't.prod_id'
+        ordered = sorted(rows.items())
+        placeholders = ', '.join(['%s'] * len(ordered))
+        cur.execute(f"SELECT id FROM {table} WHERE id IN ({placeholders}) ORDER BY id FOR UPDATE",
+                    [row_id for row_id, _ in ordered])
+        cur.fetchall()
+        derived = ' UNION ALL '.join(['SELECT %s AS id, %s AS product_id, %s AS qty'] * len(ordered))
+        params = [value for row_id, (product_id, qty) in ordered for value in (row_id, product_id, qty)]
+        guard = ' WHERE t.stock >= d.qty' if sign < 0 else ''
+        cur.execute(f"""
+            UPDATE {table} t
+            JOIN ({derived}) d ON d.id = t.id AND d.product_id = {owner}
+            SET t.stock = t.stock {'-' if sign < 0 else '+'} d.qty{guard}
+        """, params)
+        changed[level] = cur.rowcount
+    return changed
+
+
+def deduct_order_stock(cur, lines, changed_tags=None):
+    """Take an order's stock in one statement per level; raises InsufficientStockError (caller rolls back)"""
+    targets = stock_targets(cur, lines)
+    changed = _apply_stock(cur, targets, -1)
+    for level, rows in targets.items():
+        if rows and changed.get(level, 0) != len(rows):
+            raise InsufficientStockError(
+                f"{len(rows) - changed.get(level, 0)} {STOCK_TABLES[level]} row(s) short of stock")
+    note_products_changed(cur, {product_id for rows in targets.values() for product_id, _ in rows.values()},
+                          changed_tags)
+    return changed
+
+
+def restore_order_stock(cur, lines):
+    """Give an order's stock back (cancellation); rows deleted since are skipped"""
+    targets = stock_targets(cur, lines)
+    changed = _apply_stock(cur, targets, +1)
+    note_products_changed(cur, {product_id for rows in targets.values() for product_id, _ in rows.values()})
+    return changed
 
 # MTN MoMo PayClass
 class PayClass:
@@ -988,6 +2437,10 @@ class PayClass:
         raise RuntimeError("MOMO_COLLECTIONS_SUBKEY must be set in environment variables")
     environment_mode = os.environ.get('MOMO_ENV_MODE', 'sandbox')
     accurl = "https://sandbox.momodeveloper.mtn.com" if environment_mode == "sandbox" else "https://proxy.momoapi.mtn.com"
+    # MOMO_API_URL points the client elsewhere, e.g. momo_stub_server.py for local testing
+    accurl = os.environ.get('MOMO_API_URL', accurl).rstrip('/')
+    # Public base URL MTN calls back when a request-to-pay resolves (optional; payments are polled anyway)
+    callback_url = os.environ.get('MOMO_CALLBACK_URL', '').rstrip('/')
     collections_apiuser = None
     api_key_collections = None
     basic_authorisation_collections = None
@@ -1020,14 +2473,14 @@ class PayClass:
                 'Content-Type': 'application/json',
                 'Ocp-Apim-Subscription-Key': cls.collections_subkey
             }
-            response = requests.post(url, headers=headers, data=payload)
+            response = momo_http.post(url, headers=headers, data=payload)
             print(f"DEBUG: API user creation response: {response.status_code}")
             if response.status_code not in [200, 201]:
                 raise Exception(f"Failed to create API user: {response.text}")
 
             url = f"{cls.accurl}/v1_0/apiuser/{cls.collections_apiuser}/apikey"
             headers = {'Ocp-Apim-Subscription-Key': cls.collections_subkey}
-            response = requests.post(url, headers=headers)
+            response = momo_http.post(url, headers=headers)
             print(f"DEBUG: API key creation response: {response.status_code}")
             if response.status_code != 201:
                 raise Exception(f"Failed to create API key: {response.text}")
@@ -1046,14 +2499,16 @@ class PayClass:
             raise
 
     @classmethod
-    def momotoken(cls):
+    def fetch_momo_token(cls):
+        """Ask MTN for a new access token (uncached - use momotoken())"""
         try:
             url = f"{cls.accurl}/collection/token/"
             headers = {
                 'Ocp-Apim-Subscription-Key': cls.collections_subkey,
                 'Authorization': cls.basic_authorisation_collections
             }
-            response = requests.post(url, headers=headers)
+            # Asking for a token twice is harmless, so it may be retried like a GET
+            response = momo_http.post(url, headers=headers, idempotent=True)
             if response.status_code == 200:
                 return response.json()
             print(f"Token error: {response.text}")
@@ -1062,6 +2517,11 @@ class PayClass:
             print(f"Token generation error: {e}")
             return {"access_token": None}
 
+    @classmethod
+    def momotoken(cls):
+        """Current access token, shared by all threads and workers until shortly before it expires"""
+        return {"access_token": momo_tokens.get()}
+
     @classmethod
     def momopay(cls, amount, currency, txt_ref, phone_number, payermessage):
         print(f"DEBUG: momopay called with amount={amount}, phone={phone_number}, currency={currency}")
@@ -1097,7 +2557,11 @@ class PayClass:
                 'Content-Type': 'application/json',
                 'Authorization': f"Bearer {token}"
             }
-            response = requests.post(url, headers=headers, data=payload)
+            if cls.callback_url:
+                headers['X-Callback-Url'] = f"{cls.callback_url}/payments/momo/callback/{uuidgen}"
+            response = momo_http.post(url, headers=headers, data=payload)
+            if response.status_code == 401:
+                momo_tokens.invalidate(token)
             
             if response.status_code in [200, 202]:
                 return {"response": response.status_code, "ref": uuidgen, "error": None}
@@ -1168,34 +2632,573 @@ class PayClass:
             "user_message": user_messages.get(status_code, "Payment failed. Please try again or contact support.")
         }
 
-    @classmethod
-    def verifymomo(cls, txn):
+    @classmethod
+    def verifymomo(cls, txn):
+        try:
+            token = cls.momotoken().get('access_token')
+            if not token:
+                return {"status": "ERROR", "reason": "Failed to obtain access token"}
+            url = f"{cls.accurl}/collection/v1_0/requesttopay/{txn}"
+            headers = {
+                'Ocp-Apim-Subscription-Key': cls.collections_subkey,
+                'Authorization': f"Bearer {token}",
+                'X-Target-Environment': cls.environment_mode
+            }
+            response = momo_http.get(url, headers=headers)
+            if response.status_code == 401:
+                momo_tokens.invalidate(token)
+            if response.status_code == 200:
+                return response.json()
+            return {"status": "ERROR", "reason": response.text}
+        except Exception as e:
+            print(f"Verify MoMo error: {e}")
+            return {"status": "ERROR", "reason": str(e)}
+
+# ============================================
+# MoMo Access Tokens
+# ============================================
+# MTN tokens live for about an hour, so momopay()/verifymomo() reuse one instead of fetching a new
+# token per call. The token is kept in-process and in Redis (shared by all workers) and renewed
+# MOMO_TOKEN_REFRESH_AHEAD seconds before it expires by a single caller; everyone else keeps using
+# the current token meanwhile, or briefly waits for the renewal when there is none.
+MOMO_TOKEN_REFRESH_AHEAD = int(os.environ.get('MOMO_TOKEN_REFRESH_AHEAD', 300))
+MOMO_TOKEN_WAIT = 3.0
+
+
+class MomoTokenManager:
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self._entry = None
+
+    @property
+    def redis_key(self):
+        # Tokens belong to one API user in one environment
+        return f"momo:token:{PayClass.environment_mode}:{PayClass.collections_apiuser}"
+
+    def _load_shared(self):
+        if not REDIS_AVAILABLE:
+            return None
+        try:
+            data = redis_client.get(self.redis_key)
+            return json.loads(data) if data else None
+        except Exception as e:
+            print(f"[MOMO] Token cache read error: {e}")
+            return None
+
+    def _usable(self, entry, margin):
+        return entry is not None and time.time() < entry['expires_at'] - margin
+
+    def _renew(self):
+        data = self.fetch()
+        token = data.get('access_token')
+        if not token:
+            return None
+        expires_in = int(data.get('expires_in') or 3600)
+        entry = {'token': token, 'expires_at': time.time() + expires_in}
+        self._entry = entry
+        if REDIS_AVAILABLE:
+            try:
+                redis_client.setex(self.redis_key, expires_in, json.dumps(entry))
+            except Exception as e:
+                print(f"[MOMO] Token cache write error: {e}")
+        return token
+
+    def get(self):
+        """A valid access token, or None if MTN would not issue one"""
+        if self._usable(self._entry, MOMO_TOKEN_REFRESH_AHEAD):
+            return self._entry['token']
+        shared = self._load_shared()
+        if self._usable(shared, MOMO_TOKEN_REFRESH_AHEAD):
+            self._entry = shared
+            return shared['token']
+        current = shared if self._usable(shared, 0) else self._entry
+
+        release = _acquire_compute_lock(self.redis_key)
+        if release is None:
+            # Someone else is renewing: keep using the current token if it has a little life left...
+            if self._usable(current, 30):
+                return current['token']
+            # ...or wait for theirs, and only fetch our own if they are slow
+            deadline = time.time() + MOMO_TOKEN_WAIT
+            while time.time() < deadline:
+                time.sleep(0.1)
+                shared = self._load_shared() if REDIS_AVAILABLE else self._entry
+                if self._usable(shared, 30):
+                    self._entry = shared
+                    return shared['token']
+            return self._renew()
+        try:
+            # It may have been renewed while we waited for the lock
+            shared = self._load_shared()
+            if self._usable(shared, MOMO_TOKEN_REFRESH_AHEAD):
+                self._entry = shared
+                return shared['token']
+            token = self._renew()
+            if token is None and self._usable(current, 0):
+                # MTN refused or failed; the old token is still valid for a while
+                return current['token']
+            return token
+        finally:
+            release()
+
+    def invalidate(self, token):
+        """Forget `token` after MTN rejected it (401), unless it was already replaced"""
+        if self._entry and self._entry['token'] == token:
+            self._entry = None
+        if REDIS_AVAILABLE:
+            try:
+                shared = self._load_shared()
+                if shared and shared['token'] == token:
+                    redis_client.delete(self.redis_key)
+            except Exception as e:
+                print(f"[MOMO] Token cache invalidate error: {e}")
+
+
+momo_tokens = MomoTokenManager(PayClass.fetch_momo_token)
+
+# Initialize PayClass (use internal implementation with better error handling)
+try:
+    # Use the internal PayClass implementation which has superior error handling
+    PayClass.initialize_api_user()
+    print("MTN MoMo PayClass initialized successfully")
+except Exception as e:
+    print(f"PayClass initialization failed: {e}")
+    print("Warning: Payment functionality may be limited")
+
+# ============================================
+# Order Creation
+# ============================================
+# Every order - COD from checkout() or /pay/cod, mobile money from resolve_payment_intent() - goes
+# through create_order(), once per idempotency key: "momo:<reference>" for a paid intent and
+# "cod:<order_token>" for the token rendered into the checkout form. The key is a unique column on
+# orders (migrations/0006_order_idempotency.py), so a retry, double click or concurrent verify gets
+# the existing order back instead of a second order and a second stock deduction. Redis remembers
+# key -> order id for a day, so replays of a committed order are answered without rebuilding the cart.
+ORDER_KEY_TTL = 24 * 3600
+ORDER_TOKEN_RE = re.compile(r'^[0-9a-f]{32}$')
+MYSQL_DUP_ENTRY = 1062
+
+
+def cod_order_key(order_token):
+    """Idempotency key for a COD checkout; a missing or malformed token gets a one-off key"""
+    if not order_token or not ORDER_TOKEN_RE.match(order_token):
+        order_token = uuid.uuid4().hex
+    return f"cod:{order_token}"
+
+
+def cached_order_for_key(idempotency_key):
+    """Order id already committed under this key according to Redis, or None"""
+    if not REDIS_AVAILABLE:
+        return None
+    try:
+        order_id = redis_client.get(f"order:key:{idempotency_key}")
+        return int(order_id) if order_id else None
+    except Exception as e:
+        print(f"[ORDERS] Key cache read error: {e}")
+        return None
+
+
+def remember_order_key(idempotency_key, order_id):
+    """Record key -> order id once the order has committed"""
+    if not REDIS_AVAILABLE:
+        return
+    try:
+        redis_client.setex(f"order:key:{idempotency_key}", ORDER_KEY_TTL, order_id)
+    except Exception as e:
+        print(f"[ORDERS] Key cache write error: {e}")
+
+
+def find_order_by_key(cur, idempotency_key, locking=False):
+    cur.execute("SELECT id FROM orders WHERE idempotency_key = %s" + (" LOCK IN SHARE MODE" if locking else ""),
+                (idempotency_key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def create_order(cur, idempotency_key, order_data, status, payment_status, momo_transaction_id=None,
+                 changed_tags=None):
+    """
+    Insert an order and its items and deduct their stock, unless an order already exists for
+    idempotency_key. Returns (order_id, created); the caller owns the transaction.
+    changed_tags: see note_products_changed().
+    """
+    order_id = find_order_by_key(cur, idempotency_key)
+    if order_id:
+        return order_id, False
+    try:
+        cur.execute(
+            "INSERT INTO orders (user_id, guest_email, full_name, address_line, city, delivery_phone, provider, momo_number, notes, latitude, longitude, total_amount, status, momo_transaction_id, payment_status, idempotency_key) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            (
+                order_data.get('user_id'),
+                order_data.get('guest_email'),
+                order_data['full_name'],
+                order_data['address_line'],
+                order_data['city'],
+                order_data['delivery_phone'],
+                order_data.get('provider'),
+                order_data.get('momo_number'),
+                order_data.get('notes'),
+                order_data.get('latitude'),
+                order_data.get('longitude'),
+                order_data['total_amount'],
+                status,
+                momo_transaction_id,
+                payment_status,
+                idempotency_key
+            )
+        )
+    except MySQLdb.IntegrityError as e:
+        if e.args[0] != MYSQL_DUP_ENTRY:
+            raise
+        # A concurrent request got there first; a locking read sees its row once it has committed
+        order_id = find_order_by_key(cur, idempotency_key, locking=True)
+        if order_id is None:
+            raise
+        return order_id, False
+    order_id = cur.lastrowid
+    cur.executemany(
+        "INSERT INTO order_items (order_id, product_id, product_name, price, quantity, subtotal, VARIATIONS, img_var_id, dropdown_var_id) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        [(order_id, item.get('product_id', item.get('id')), item['name'], float(item['price']), int(item['quantity']),
+          float(item['price']) * int(item['quantity']), item.get('variations', ''),
+          item.get('img_var_id') or None, item.get('dropdown_var_id') or None)
+         for item in order_data['cart_items']]
+    )
+    # Raises InsufficientStockError if any line is short, rolling the whole order back
+    deduct_order_stock(cur, order_data['cart_items'], changed_tags)
+    return order_id, True
+
+
+def place_cod_order(cur, idempotency_key, order_data, email):
+    """Create and commit a Cash on Delivery order; the confirmation email goes out only the first time"""
+    try:
+        order_id, created = create_order(cur, idempotency_key, order_data, 'pending', 'pending')
+        mysql.connection.commit()
+    except Exception:
+        mysql.connection.rollback()
+        raise
+    remember_order_key(idempotency_key, order_id)
+    if not created:
+        print(f"[ORDERS] Replayed COD checkout {idempotency_key} -> order #{order_id}")
+    elif email:
+        send_order_confirmation_email(email, order_id, order_data['full_name'],
+                                      order_data['total_amount'], order_data['cart_items'])
+    else:
+        print(f"[WARNING] No email address found for order {order_id}")
+    return order_id
+
+
+# ============================================
+# Payment Intents
+# ============================================
+# A mobile money checkout records a payment_intents row (migrations/0005_payment_intents.py) with
+# everything needed to build the order, and returns straight away. payment_worker.py polls MTN for
+# due intents with backoff, and creates the order the first time a request-to-pay is SUCCESSFUL.
+# MTN's callback only moves an intent's next check forward - the outcome always comes from our own
+# verifymomo() call, never from the callback body. Browsers poll /pay/status/<ref>, which reads the
+# intent row and never calls MTN.
+PAYMENT_INTENT_TIMEOUT = int(os.environ.get('PAYMENT_INTENT_TIMEOUT', 900))
+# An intent only expires on a definite PENDING from MTN. While MTN can't be asked (token failures,
+# errors, open circuit) it keeps being checked, and is parked as UNVERIFIED for support only after
+# this many seconds past its timeout - the shopper may well have approved it.
+PAYMENT_UNVERIFIED_AFTER = int(os.environ.get('PAYMENT_UNVERIFIED_AFTER', 24 * 3600))
+PAYMENT_POLL_BASE = 5
+PAYMENT_POLL_MAX = 60
+PAYMENT_WAKEUP_KEY = "payments:wakeup"
+MOMO_FAILED_STATUSES = ('FAILED', 'REJECTED', 'EXPIRED')
+PAYMENT_INTENT_COLUMNS = ('id', 'reference', 'external_id', 'user_id', 'email', 'amount', 'currency', 'provider',
+                          'payer_number', 'cart_key', 'order_payload', 'status', 'reason', 'order_id', 'checks')
+
+
+def payment_poll_delay(checks):
+    """Seconds until the next status check: 5s, 7.5s, 11s, ... capped at a minute, with jitter"""
+    delay = min(PAYMENT_POLL_MAX, PAYMENT_POLL_BASE * 1.5 ** checks)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def wake_payment_reconciler():
+    """Nudge an idle payment_worker.py to look at due intents now"""
+    if REDIS_AVAILABLE:
+        try:
+            pipe = redis_client.pipeline()
+            pipe.lpush(PAYMENT_WAKEUP_KEY, 1)
+            pipe.ltrim(PAYMENT_WAKEUP_KEY, 0, 0)
+            pipe.execute()
+        except Exception as e:
+            print(f"[PAYMENTS] Wakeup error: {e}")
+
+
+def create_payment_intent(cur, reference, external_id, order_data, amount, email=None, cart_key=None):
+    """Record a request-to-pay awaiting confirmation; the caller commits"""
+    cur.execute("""
+        INSERT INTO payment_intents (reference, external_id, user_id, email, amount, currency, provider,
+                                     payer_number, cart_key, order_payload, next_check_at, expires_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                NOW() + INTERVAL %s SECOND, NOW() + INTERVAL %s SECOND)
+    """, (reference, external_id, order_data.get('user_id'), email, float(amount), order_data['currency'],
+          order_data.get('provider'), order_data.get('momo_number'), cart_key,
+          json.dumps(order_data, default=str), PAYMENT_POLL_BASE, PAYMENT_INTENT_TIMEOUT))
+    return cur.lastrowid
+
+
+def get_payment_intent(cur, reference, for_update=False):
+    cur.execute(f"SELECT {', '.join(PAYMENT_INTENT_COLUMNS)} FROM payment_intents WHERE reference = %s"
+                + (" FOR UPDATE" if for_update else ""), (reference,))
+    row = cur.fetchone()
+    return dict(zip(PAYMENT_INTENT_COLUMNS, row)) if row else None
+
+
+def payment_intent_view(intent):
+    """What the shopper's browser is told about an intent"""
+    status = intent['status']
+    view = {'ref': intent['reference'], 'order_id': intent['order_id']}
+    if status == 'SUCCESSFUL':
+        view.update(status='successful', message=f"Payment successful! Order #{intent['order_id']} confirmed.")
+    elif status == 'ORDER_FAILED':
+        view.update(status='error', message='Payment succeeded but order creation failed. Contact support.')
+    elif status == 'UNVERIFIED':
+        view.update(status='error', message=f"We could not confirm this payment with MTN. If you were charged, "
+                                            f"contact support with reference {intent['reference']}.")
+    elif status in MOMO_FAILED_STATUSES:
+        view.update(status='failed', message=f"Payment {status.lower()}: {intent['reason'] or 'Please try again.'}")
+    else:
+        view.update(status='pending', message='Payment initiated. Please approve on your phone.')
+    return view
+
+
+def log_payment(cur, order_id, reference, amount, currency, status, provider, payer_number, raw):
+    cur.execute("""
+        INSERT INTO payments (order_id, momo_transaction_id, amount, currency, status, provider, payer_number, raw_response)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, (order_id, reference, amount, currency, status, provider, payer_number, json.dumps(raw, default=str)))
+
+
+def _finish_paid_intent(intent, order_data, order_id):
+    """Side effects after a paid order commits: confirmation email and emptying the shopper's cart"""
+    if intent['email']:
+        send_order_confirmation_email(intent['email'], order_id, order_data['full_name'],
+                                      order_data['total_amount'], order_data['cart_items'])
+    if REDIS_AVAILABLE and intent['cart_key']:
+        try:
+            redis_client.delete(intent['cart_key'], f"{intent['cart_key']}:lines")
+        except Exception as e:
+            print(f"[PAYMENTS] Cart clear error for {intent['reference']}: {e}")
+
+
+def resolve_payment_intent(reference, verify):
+    """
+    Apply a verifymomo() result to a pending intent, exactly once: the row is locked, and anything
+    already resolved is returned untouched. Returns the intent as it stands afterwards.
+    """
+    status = verify.get('status') if isinstance(verify, dict) else None
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            intent = get_payment_intent(cur, reference, for_update=True)
+            if intent is None or intent['status'] != 'PENDING' or (
+                    status != 'SUCCESSFUL' and status not in MOMO_FAILED_STATUSES):
+                conn.commit()
+                return intent
+
+            order_data = json.loads(intent['order_payload'])
+            amount = float(order_data['total_amount'])
+            if status == 'SUCCESSFUL':
+                # Stock caches are invalidated only once the order is committed, so nothing can
+                # rebuild them from the pre-order stock in between
+                changed_tags = set()
+                try:
+                    order_id, _ = create_order(cur, f"momo:{reference}", order_data, 'SUCCESSFUL', 'paid',
+                                               momo_transaction_id=reference, changed_tags=changed_tags)
+                    log_payment(cur, order_id, reference, amount, intent['currency'], 'SUCCESSFUL',
+                                intent['provider'], intent['payer_number'], {'verify': verify})
+                    cur.execute("""
+                        UPDATE payment_intents
+                        SET status = 'SUCCESSFUL', order_id = %s, resolved_at = NOW(), claim_token = NULL
+                        WHERE id = %s
+                    """, (order_id, intent['id']))
+                    conn.commit()
+                except Exception as e:
+                    # The shopper has paid: park it for support instead of retrying a broken order forever
+                    conn.rollback()
+                    print(f"[PAYMENTS] Order creation failed for paid intent {reference}: {e}")
+                    current = get_payment_intent(cur, reference, for_update=True)
+                    if current['status'] != 'PENDING':
+                        conn.commit()
+                        return current
+                    log_payment(cur, None, reference, amount, intent['currency'], 'SUCCESSFUL',
+                                intent['provider'], intent['payer_number'], {'verify': verify, 'order_error': str(e)})
+                    cur.execute("""
+                        UPDATE payment_intents
+                        SET status = 'ORDER_FAILED', reason = %s, resolved_at = NOW(), claim_token = NULL
+                        WHERE id = %s
+                    """, (str(e)[:255], intent['id']))
+                    conn.commit()
+                    intent.update(status='ORDER_FAILED', reason=str(e)[:255])
+                    publish_payment_status(intent)
+                    return intent
+                invalidate_changed_tags(changed_tags)
+                intent.update(status='SUCCESSFUL', order_id=order_id)
+                print(f"[PAYMENTS] {reference} SUCCESSFUL -> order #{order_id}")
+                publish_payment_status(intent)
+                _finish_paid_intent(intent, order_data, order_id)
+                return intent
+
+            reason = str(verify.get('reason') or status)[:255]
+            log_payment(cur, None, reference, amount, intent['currency'], status,
+                        intent['provider'], intent['payer_number'], {'verify': verify})
+            cur.execute("""
+                UPDATE payment_intents
+                SET status = %s, reason = %s, resolved_at = NOW(), claim_token = NULL
+                WHERE id = %s
+            """, (status, reason, intent['id']))
+            conn.commit()
+            intent.update(status=status, reason=reason)
+            print(f"[PAYMENTS] {reference} {status}: {reason}")
+            publish_payment_status(intent)
+            return intent
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+
+# ============================================
+# Payment Status Stream
+# ============================================
+# Shoppers waiting on a mobile money approval hold an SSE stream (/pay/status/<ref>/stream) instead
+# of polling. resolve_payment_intent() publishes the outcome on payments:status:<ref>; each worker has
+# a single pattern subscription that hands messages to the streams waiting in that worker, so a
+# waiting shopper costs no Redis or MySQL traffic until something happens. Under gunicorn's threaded
+# workers an open stream still occupies a thread, so streams are time-bounded (EventSource reconnects
+# by itself) and capped per worker; past the cap the browser falls back to polling /pay/status/<ref>.
+# Polling is cheap too: every status change (including the new intent) is also written to
+# payments:view:<ref>, which /pay/status and the streams read instead of MySQL.
+PAYMENT_STATUS_CHANNEL = "payments:status:"
+PAYMENT_VIEW_KEY = "payments:view:"
+PAYMENT_VIEW_TTL = PAYMENT_INTENT_TIMEOUT + PAYMENT_UNVERIFIED_AFTER + 3600
+PAYMENT_STREAM_SECONDS = int(os.environ.get('PAYMENT_STREAM_SECONDS', 30))
+PAYMENT_STREAM_SLOTS = int(os.environ.get('PAYMENT_STREAM_SLOTS', 2))
+_payment_stream_slots = BoundedSemaphore(PAYMENT_STREAM_SLOTS)
+
+
+def publish_payment_status(intent):
+    """Store the intent's browser view for status reads and push it to waiting streams"""
+    if not REDIS_AVAILABLE:
+        return
+    view = payment_intent_view(intent)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.setex(PAYMENT_VIEW_KEY + intent['reference'], PAYMENT_VIEW_TTL,
+                   json.dumps({'user_id': intent.get('user_id'), 'view': view}))
+        pipe.publish(PAYMENT_STATUS_CHANNEL + intent['reference'], json.dumps(view))
+        pipe.execute()
+    except Exception as e:
+        print(f"[PAYMENTS] Status publish error for {intent['reference']}: {e}")
+
+
+def publish_new_payment_intent(reference, user_id):
+    """Seed the stored view of an intent that was just committed"""
+    publish_payment_status({'reference': reference, 'user_id': user_id, 'status': 'PENDING',
+                            'order_id': None, 'reason': None})
+
+
+class PaymentStatusDispatcher:
+    """This worker's one Redis subscription, fanned out to the streams waiting in it"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._waiters = defaultdict(set)
+        self._started = False
+
+    def subscribe(self, reference):
+        waiter = queue.Queue()
+        with self._lock:
+            self._waiters[reference].add(waiter)
+            if not self._started:
+                self._started = True
+                Thread(target=self._listen, name='payment-status-listener', daemon=True).start()
+        return waiter
+
+    def unsubscribe(self, reference, waiter):
+        with self._lock:
+            waiters = self._waiters.get(reference)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[reference]
+
+    def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(PAYMENT_STATUS_CHANNEL + '*')
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message or message.get('type') != 'pmessage':
+                        continue
+                    reference = message['channel'][len(PAYMENT_STATUS_CHANNEL):]
+                    with self._lock:
+                        waiters = list(self._waiters.get(reference, ()))
+                    if waiters:
+                        view = json.loads(message['data'])
+                        for waiter in waiters:
+                            waiter.put(view)
+            except Exception as e:
+                print(f"[PAYMENTS] Status listener error, reconnecting: {e}")
+                time.sleep(1)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+
+payment_status_dispatcher = PaymentStatusDispatcher()
+
+
+def sse_event(data, event='status'):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def park_unverified_payment_intent(reference, reason):
+    """Close a pending intent MTN never gave a definite answer for, leaving it to support"""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
         try:
-            token = cls.momotoken().get('access_token')
-            if not token:
-                return {"status": "ERROR", "reason": "Failed to obtain access token"}
-            url = f"{cls.accurl}/collection/v1_0/requesttopay/{txn}"
-            headers = {
-                'Ocp-Apim-Subscription-Key': cls.collections_subkey,
-                'Authorization': f"Bearer {token}",
-                'X-Target-Environment': cls.environment_mode
-            }
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                return response.json()
-            return {"status": "ERROR", "reason": response.text}
-        except Exception as e:
-            print(f"Verify MoMo error: {e}")
-            return {"status": "ERROR", "reason": str(e)}
+            intent = get_payment_intent(cur, reference, for_update=True)
+            if intent is None or intent['status'] != 'PENDING':
+                conn.commit()
+                return intent
+            reason = str(reason or 'MTN status unavailable')[:255]
+            cur.execute("""
+                UPDATE payment_intents
+                SET status = 'UNVERIFIED', reason = %s, resolved_at = NOW(), claim_token = NULL
+                WHERE id = %s
+            """, (reason, intent['id']))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    intent.update(status='UNVERIFIED', reason=reason)
+    print(f"[PAYMENTS] {reference} UNVERIFIED: {reason}")
+    publish_payment_status(intent)
+    return intent
+
+
+def expedite_payment_intent(cur, reference):
+    """Schedule a pending intent's next check for now (callbacks); the caller commits"""
+    cur.execute("""
+        UPDATE payment_intents SET next_check_at = NOW()
+        WHERE reference = %s AND status = 'PENDING'
+    """, (reference,))
+    return cur.rowcount == 1
 
-# Initialize PayClass (use internal implementation with better error handling)
-try:
-    # Use the internal PayClass implementation which has superior error handling
-    PayClass.initialize_api_user()
-    print("MTN MoMo PayClass initialized successfully")
-except Exception as e:
-    print(f"PayClass initialization failed: {e}")
-    print("Warning: Payment functionality may be limited")
 
 # HTTPS redirect middleware
 @app.before_request
@@ -1248,7 +3251,7 @@ def geocode_proxy():
             'User-Agent': 'eMarket/1.0 (contact: support@example.com)'
         }
         try:
-            r = requests.get('https://nominatim.openstreetmap.org/search', params=params, headers=headers, timeout=5)
+            r = geocode_http.get('https://nominatim.openstreetmap.org/search', params=params, headers=headers)
             if r.ok:
                 items = r.json()
                 if isinstance(items, list) and len(items) > 0:
@@ -1258,7 +3261,7 @@ def geocode_proxy():
 
         # Photon fallback
         try:
-            r2 = requests.get('https://photon.komoot.io/api/', params={'q': q, 'limit': limit}, timeout=5)
+            r2 = geocode_http.get('https://photon.komoot.io/api/', params={'q': q, 'limit': limit})
             if r2.ok:
                 data = r2.json()
                 features = data.get('features', []) if isinstance(data, dict) else []
@@ -1285,10 +3288,12 @@ def geocode_proxy():
         return jsonify({'error': str(e)}), 500
 
 # CSRF protection
-def _ensure_csrf_token():
-    if 'csrf_token' not in session:
-        session['csrf_token'] = secrets.token_urlsafe(32)
-        session.modified = True
+def csrf_token():
+    """This session's CSRF token, created the first time a form needs one"""
+    token = session.get('csrf_token')
+    if not token:
+        token = session['csrf_token'] = secrets.token_urlsafe(32)
+    return token
 
 def validate_csrf():
     """Validate CSRF token"""
@@ -1303,48 +3308,69 @@ def calculate_discounted_price(original_price, discount_percent):
     return original_price
 
 def build_cart_items_from_session(cur, session_cart):
-    """Build cart items list from session, fetching variation images from database"""
-    cart_items = []
+    """Build cart items list from session in a constant number of queries.
+    All products come from one get_cart_products_bulk() call and all variation
+    images from one IN (...) query, however many lines the cart has.
+    """
+    if not session_cart:
+        return []
+
+    lines = []
     for cart_key, item in session_cart.items():
         # Extract actual product_id from cart item
         actual_product_id = item.get('product_id', cart_key.split('_')[0] if '_' in cart_key else cart_key)
-        img_var_id = item.get('img_var_id', '')
-        
-        cur.execute("SELECT * FROM products WHERE id = %s", (actual_product_id,))
-        product_data = cur.fetchone()
-        if product_data:
-            product = get_product_with_discount(product_data)
-            if product:
-                qty = min(item['quantity'], product['stock'])
-                if qty > 0:
-                    # Fetch image from database based on variation
-                    image_url = product['image']
-                    img_var_name = ''
-                    img_var_description = ''
-                    if img_var_id and str(img_var_id).strip():
-                        try:
-                            cur.execute("SELECT img_url, name, description FROM image_variations WHERE id = %s", (img_var_id,))
-                            result = cur.fetchone()
-                            if result and result[0]:
-                                image_url = resolve_image_url(result[0])
-                                img_var_name = result[1] if len(result) > 1 else ''
-                                img_var_description = result[2] if len(result) > 2 else ''
-                        except Exception:
-                            pass
-                    
-                    cart_items.append({
-                        'id': cart_key,
-                        'product_id': actual_product_id,
-                        'name': item['name'],
-                        'price': item['price'],
-                        'image': image_url,
-                        'quantity': qty,
-                        'stock': product['stock'],
-                        'variations': item.get('variations', ''),
-                        'is_new': False,
-                        'img_var_name': img_var_name,
-                        'img_var_description': img_var_description
-                    })
+        img_var_id = str(item.get('img_var_id') or '').strip()
+        lines.append((cart_key, item, actual_product_id, img_var_id))
+
+    products = get_cart_products_bulk(list({str(line[2]) for line in lines}))
+
+    variation_rows = {}
+    img_var_ids = list({line[3] for line in lines if line[3]})
+    if img_var_ids:
+        try:
+            placeholders = ','.join(['%s'] * len(img_var_ids))
+            cur.execute(f"SELECT id, img_url, name, description FROM image_variations WHERE id IN ({placeholders})",
+                        tuple(img_var_ids))
+            for row in cur.fetchall():
+                variation_rows[str(row[0])] = row
+        except Exception:
+            pass
+
+    cart_items = []
+    for cart_key, item, actual_product_id, img_var_id in lines:
+        product = products.get(str(actual_product_id))
+        if not product:
+            continue
+        qty = min(item['quantity'], product['stock'])
+        if qty <= 0:
+            continue
+        # Variation image overrides the product image when available
+        image_url = product['image']
+        img_var_name = ''
+        img_var_description = ''
+        variation = variation_rows.get(img_var_id)
+        if variation and variation[1]:
+            image_url = resolve_image_url(variation[1])
+            img_var_name = variation[2] or ''
+            img_var_description = variation[3] or ''
+
+        cart_items.append({
+            'id': cart_key,
+            'product_id': actual_product_id,
+            'name': item['name'],
+            'price': item['price'],
+            'original_price': product['original_price'],
+            'discount': product['discount'],
+            'image': image_url,
+            'quantity': qty,
+            'stock': product['stock'],
+            'variations': item.get('variations', ''),
+            'img_var_id': item.get('img_var_id', ''),
+            'dropdown_var_id': item.get('dropdown_var_id', ''),
+            'is_new': False,
+            'img_var_name': img_var_name,
+            'img_var_description': img_var_description
+        })
     return cart_items
 
 def resolve_image_url(image_value):
@@ -1477,10 +3503,93 @@ def hash_password(password):
 def verify_password(password, hashed):
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-# Rate limiting - expanded to multiple endpoints
-login_attempts = {}
-registration_attempts = {}
-checkout_attempts = {}
+# Rate limiting - sliding windows shared by all workers through Redis.
+# Each (scope, identity) pair is a sorted set of attempt timestamps; one Lua script prunes the
+# window, counts and optionally records atomically. Without Redis a bounded in-process table is
+# used instead (LRU-capped, expired windows swept periodically).
+RATE_LIMIT_MAX_LOCAL_KEYS = 10000
+RATE_LIMIT_SWEEP_INTERVAL = 60
+
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local mode = ARGV[4]
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+if mode == 'record' or (mode == 'hit' and count < limit) then
+    redis.call('ZADD', KEYS[1], now, ARGV[5])
+    redis.call('PEXPIRE', KEYS[1], window)
+end
+return count
+"""
+rate_limit_script = redis_client.register_script(RATE_LIMIT_SCRIPT) if REDIS_AVAILABLE else None
+
+_local_rate_windows = OrderedDict()
+_local_rate_lock = Lock()
+_local_rate_last_sweep = [0.0]
+
+
+def _local_rate_limit(key, limit, window, mode):
+    now = time.time()
+    with _local_rate_lock:
+        if now - _local_rate_last_sweep[0] > RATE_LIMIT_SWEEP_INTERVAL:
+            for stale_key in [k for k, (stamps, w) in _local_rate_windows.items() if not stamps or stamps[-1] <= now - w]:
+                del _local_rate_windows[stale_key]
+            _local_rate_last_sweep[0] = now
+        stamps, _ = _local_rate_windows.get(key, (deque(), window))
+        while stamps and stamps[0] <= now - window:
+            stamps.popleft()
+        count = len(stamps)
+        if mode == 'record' or (mode == 'hit' and count < limit):
+            stamps.append(now)
+        _local_rate_windows[key] = (stamps, window)
+        _local_rate_windows.move_to_end(key)
+        while len(_local_rate_windows) > RATE_LIMIT_MAX_LOCAL_KEYS:
+            _local_rate_windows.popitem(last=False)
+        return count
+
+
+def rate_limit(scope, identity, limit, window_seconds, mode='check'):
+    """Attempts by `identity` in `scope` within the window, counted before this call.
+    mode='check' only counts, 'record' always adds an attempt, 'hit' adds one only if under the limit."""
+    key = f"ratelimit:{scope}:{identity}"
+    if REDIS_AVAILABLE:
+        try:
+            now_ms = int(time.time() * 1000)
+            return rate_limit_script(keys=[key], args=[now_ms, window_seconds * 1000, limit, mode, f"{now_ms}-{uuid.uuid4().hex[:8]}"])
+        except Exception as e:
+            print(f"Redis rate limit error: {e}")
+    return _local_rate_limit(key, limit, window_seconds, mode)
+
+
+def is_rate_limited(ip_address, scope='login', max_attempts=5, window_minutes=15):
+    """Generic rate limiting function"""
+    return rate_limit(scope, ip_address, max_attempts, window_minutes * 60) >= max_attempts
+
+
+def record_attempt(ip_address, scope='login', window_minutes=15):
+    """Generic attempt recording"""
+    rate_limit(scope, ip_address, 0, window_minutes * 60, mode='record')
+
+
+def rate_limited(scope, limit, window_seconds, key_func=None, methods=('POST',)):
+    """Route decorator: allow `limit` requests per window per client IP (or key_func())"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method in methods:
+                identity = key_func() if key_func else request.remote_addr
+                if rate_limit(scope, identity, limit, window_seconds, mode='hit') < limit:
+                    return f(*args, **kwargs)
+                message = 'Too many requests. Please wait a moment and try again.'
+                if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json or request.path.startswith(('/api/', '/pay/')):
+                    return jsonify({'status': 'error', 'message': message}), 429
+                flash(message, 'error')
+                return redirect(request.referrer or url_for('home'))
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
 
 # Jinja filter: floatformat
 @app.template_filter('floatformat')
@@ -1543,33 +3652,13 @@ def fmtdate(value, fmt='%b %d, %Y • %H:%M'):
     except Exception:
         return value
 
-def is_rate_limited(ip_address, attempt_dict=None, max_attempts=5, window_minutes=15):
-    """Generic rate limiting function"""
-    if attempt_dict is None:
-        attempt_dict = login_attempts
-    now = datetime.now()
-    if ip_address in attempt_dict:
-        attempts = attempt_dict[ip_address]
-        attempts = [attempt for attempt in attempts if now - attempt < timedelta(minutes=window_minutes)]
-        attempt_dict[ip_address] = attempts
-        return len(attempts) >= max_attempts
-    return False
-
-def record_attempt(ip_address, attempt_dict=None):
-    """Generic attempt recording"""
-    if attempt_dict is None:
-        attempt_dict = login_attempts
-    now = datetime.now()
-    if ip_address not in attempt_dict:
-        attempt_dict[ip_address] = []
-    attempt_dict[ip_address].append(now)
-
 def regenerate_session():
     """Regenerate session ID to prevent session fixation attacks"""
     # Store data we want to keep
     user_id = session.get('user_id')
     username = session.get('username')
-    cart = session.get('cart', {})  # Always preserve cart
+    cart_id = session.get('cart_id')  # Always preserve cart (Redis carts are keyed by cart_id)
+    cart = session.get('cart', {})
     csrf_token = session.get('csrf_token')
     
     # Clear and regenerate
@@ -1580,12 +3669,17 @@ def regenerate_session():
         session['user_id'] = user_id
     if username:
         session['username'] = username
+    if cart_id:
+        session['cart_id'] = cart_id
     if cart:
         session['cart'] = cart
     
     # Generate new CSRF token if none existed
     session['csrf_token'] = csrf_token or secrets.token_urlsafe(32)
     session.modified = True
+    # Server-side sessions also move the payload to a new session id
+    if hasattr(session, 'rotate'):
+        session.rotate()
 
 def safe_error_log(error, context=""):
     """Log errors safely - verbose in dev, generic in production"""
@@ -1601,11 +3695,7 @@ def safe_error_log(error, context=""):
 # Cached helper functions for performance # Cache for 10 minutes
 def get_all_categories():
     """Cached category fetching - reduces DB load by 90%"""
-    cur = mysql.connection.cursor()
-    cur.execute("SELECT * FROM categories")
-    categories_data = cur.fetchall()
-    cur.close()
-    return [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
+    return get_cached_categories()
 
 
 def get_product_by_id(product_id):
@@ -1636,185 +3726,12 @@ def get_cart_products_bulk(product_ids):
             products_dict[str(product['id'])] = product
     return products_dict
 
-# DB initialization
-_db_init_lock = Lock()
-_db_init_done = False
-
-def ensure_db_initialized():
-    global _db_init_done
-    if _db_init_done:
-        return
-    with _db_init_lock:
-        if _db_init_done:
-            return
-        try:
-            cur = mysql.connection.cursor()
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    email VARCHAR(120) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    first_name VARCHAR(50) NOT NULL,
-                    last_name VARCHAR(50) NOT NULL,
-                    phone VARCHAR(20) NOT NULL,
-                    city VARCHAR(100) NOT NULL,
-                    address VARCHAR(255),
-                    is_active BOOLEAN DEFAULT TRUE,
-                    failed_login_attempts INT DEFAULT 0,
-                    locked_until DATETIME NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS categories (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    name VARCHAR(100) NOT NULL
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS products (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    name VARCHAR(255) NOT NULL,
-                    price DECIMAL(10,2) NOT NULL,
-                    image VARCHAR(255),
-                    category_id INT,
-                    stock INT DEFAULT 0,
-                    FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE SET NULL
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """)
-            # Optional description column, safely added at the end to avoid breaking index-based reads
-            try:
-                cur.execute("ALTER TABLE products ADD COLUMN description TEXT NULL AFTER stock")
-            except Exception:
-                pass
-            
-            # Add OAuth columns to users table for Google login
-            try:
-                cur.execute("ALTER TABLE users ADD COLUMN oauth_provider VARCHAR(50) NULL AFTER created_at")
-            except Exception:
-                pass
-            try:
-                cur.execute("ALTER TABLE users ADD COLUMN oauth_id VARCHAR(255) NULL AFTER oauth_provider")
-            except Exception:
-                pass
-            # Optional discount column for percentage discounts
-            try:
-                cur.execute("ALTER TABLE products ADD COLUMN discount DECIMAL(5,2) DEFAULT 0.00 AFTER description")
-            except Exception:
-                pass
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS orders (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id INT NULL,
-                    guest_email VARCHAR(120) NULL,
-                    full_name VARCHAR(120) NOT NULL,
-                    address_line VARCHAR(255) NOT NULL,
-                    city VARCHAR(100) NOT NULL,
-                    delivery_phone VARCHAR(20) NOT NULL,
-                    provider VARCHAR(20),
-                    momo_number VARCHAR(20),
-                    notes VARCHAR(255),
-                    latitude DECIMAL(10,7) NULL,
-                    longitude DECIMAL(10,7) NULL,
-                    total_amount DECIMAL(10,2) NOT NULL,
-                    status VARCHAR(30) DEFAULT 'PENDING',
-                    momo_transaction_id VARCHAR(36),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS order_items (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    order_id INT NOT NULL,
-                    product_id INT,
-                    product_name VARCHAR(255) NOT NULL,
-                    price DECIMAL(10,2) NOT NULL,
-                    quantity INT NOT NULL,
-                    subtotal DECIMAL(10,2) NOT NULL,
-                    FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
-                    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE SET NULL
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """)
-            # Payments table for transaction logging
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS payments (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    order_id INT NULL,
-                    momo_transaction_id VARCHAR(64),
-                    amount DECIMAL(10,2) NOT NULL,
-                    currency VARCHAR(10) NOT NULL,
-                    status VARCHAR(30) NOT NULL,
-                    provider VARCHAR(30) NULL,
-                    payer_number VARCHAR(32) NULL,
-                    raw_response TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX (order_id),
-                    INDEX (momo_transaction_id)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """)
-            # Wishlist table
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS wishlist (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id INT NOT NULL,
-                    product_id INT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-                    FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE,
-                    UNIQUE KEY unique_wishlist (user_id, product_id)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """)
-
-            # Password reset tokens table (for forgot/reset password flow)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS password_resets (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id INT NOT NULL,
-                    email VARCHAR(255) NOT NULL,
-                    reset_code VARCHAR(255) NOT NULL UNIQUE,
-                    used BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-                    INDEX idx_reset_code (reset_code),
-                    INDEX idx_user_id (user_id)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """)
-            # Best-effort: add uniqueness and FK constraints (ignore if already exist)
-            try:
-                cur.execute("ALTER TABLE orders ADD UNIQUE KEY uniq_orders_momo (momo_transaction_id)")
-            except Exception as _:
-                pass
-            # Ensure latitude/longitude columns exist in orders (for map picker)
-            try:
-                cur.execute("ALTER TABLE orders ADD COLUMN latitude DECIMAL(10,7) NULL AFTER notes")
-            except Exception as _:
-                pass
-            try:
-                cur.execute("ALTER TABLE orders ADD COLUMN longitude DECIMAL(10,7) NULL AFTER latitude")
-            except Exception as _:
-                pass
-            try:
-                cur.execute("ALTER TABLE payments ADD UNIQUE KEY uniq_payments_momo (momo_transaction_id)")
-            except Exception as _:
-                pass
-            try:
-                cur.execute("ALTER TABLE payments ADD CONSTRAINT fk_payments_order FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE SET NULL")
-            except Exception as _:
-                pass
-            mysql.connection.commit()
-            cur.close()
-        except Exception as e:
-            print(f"DB init error: {e}")
-        finally:
-            _db_init_done = True
-
 @app.before_request
 def initialize_cart():
-    ensure_db_initialized()
-    _ensure_csrf_token()
+    # Schema changes are applied at deploy time by migrate.py, never on the request path
+    if request.endpoint == 'static':
+        # Static files never need the session - don't load it
+        return
     # Note: Cart is stored in Redis when available, otherwise in session
     # Session itself is always Flask's cookie-based session
     if not REDIS_AVAILABLE:
@@ -1823,44 +3740,90 @@ def initialize_cart():
             session['cart'] = {}
             session.modified = True
 
+# ============================================
+# Current User Loader
+# ============================================
+# The logged-in user's profile is resolved at most once per request (memoized on g) and usually
+# from a short-lived cache entry, which profile updates invalidate. The cached profile never
+# contains the password hash.
+USER_PROFILE_TTL = 300
+
+ANONYMOUS_USER = {
+    'id': None,
+    'username': '',
+    'email': '',
+    'first_name': '',
+    'last_name': '',
+    'phone': '',
+    'city': '',
+    'address': '',
+}
+
+
+def load_user_profile(user_id):
+    """Profile fields of a user (cached), or None if the user doesn't exist"""
+    cache_key = f"user_profile:{user_id}"
+    cached = get_cached_data(cache_key)
+    if cached is not None:
+        return cached
+    
+    cur = mysql.connection.cursor()
+    cur.execute(
+        "SELECT id, username, email, first_name, last_name, phone, city, address, is_active FROM users WHERE id = %s",
+        (user_id,)
+    )
+    row = cur.fetchone()
+    cur.close()
+    if not row:
+        return None
+    profile = {
+        'id': row[0],
+        'username': row[1],
+        'email': row[2],
+        'first_name': row[3],
+        'last_name': row[4],
+        'phone': row[5],
+        'city': row[6],
+        'address': row[7],
+        'is_active': row[8],
+    }
+    cache_data(cache_key, profile, USER_PROFILE_TTL, tags=[f"user:{user_id}"])
+    return profile
+
+
+def get_current_user():
+    """The logged-in user's profile for this request, or None for guests. Treat it as read-only."""
+    if 'current_user' not in g:
+        user = None
+        if 'user_id' in session:
+            try:
+                user = load_user_profile(session['user_id'])
+            except Exception as e:
+                print(f"User lookup error: {e}")
+        g.current_user = user
+    return g.current_user
+
+
+def invalidate_user_profile(user_id):
+    """Call after updating a user's row"""
+    invalidate_cache(f"user_profile:{user_id}")
+    g.pop('current_user', None)
+
+
 # Provide a safe 'user' object to all templates
 @app.context_processor
 def inject_user():
-    user = None
-    try:
-        if 'user_id' in session:
-            cur = mysql.connection.cursor()
-            cur.execute(
-                "SELECT id, username, email, first_name, last_name, phone, city, address FROM users WHERE id = %s",
-                (session['user_id'],)
-            )
-            row = cur.fetchone()
-            cur.close()
-            if row:
-                user = {
-                    'id': row[0],
-                    'username': row[1],
-                    'email': row[2],
-                    'first_name': row[3],
-                    'last_name': row[4],
-                    'phone': row[5],
-                    'city': row[6],
-                    'address': row[7],
-                }
-    except Exception:
-        user = None
-    if user is None:
-        user = {
-            'id': None,
-            'username': '',
-            'email': '',
-            'first_name': '',
-            'last_name': '',
-            'phone': '',
-            'city': '',
-            'address': '',
-        }
-    return {'user': user}
+    return {'user': get_current_user() or dict(ANONYMOUS_USER)}
+
+# Cart badge count, looked up only when a template renders it
+@app.context_processor
+def inject_cart_count():
+    return {'cart_count': cart_item_count}
+
+# CSRF token, created (and the session with it) only when a template renders a form
+@app.context_processor
+def inject_csrf_token():
+    return {'csrf_token': csrf_token}
 
 # Authentication routes
 @app.route('/login', methods=['GET', 'POST'])
@@ -1868,10 +3831,8 @@ def login():
     categories = []
     cart_items = []
     cur = mysql.connection.cursor()
-    cur.execute("SELECT * FROM categories")
-    categories_data = cur.fetchall()
-    categories = [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
-    cart_items = build_cart_items_from_session(cur, session.get('cart', {}))
+    categories = get_cached_categories()
+    cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
     cur.close()
 
     if request.method == 'POST':
@@ -1882,7 +3843,7 @@ def login():
         password = request.form.get('password', '')
         ip_address = request.remote_addr
 
-        if is_rate_limited(ip_address, login_attempts):
+        if is_rate_limited(ip_address, 'login'):
             flash('Too many login attempts. Please try again in 15 minutes.', 'error')
             return render_template('login.html', categories=categories, cart_items=cart_items)
 
@@ -1909,18 +3870,12 @@ def login():
                 return render_template('login.html', categories=categories, cart_items=cart_items)
 
             if verify_password(password, password_hash):
-                # Preserve cart before session regeneration
-                old_cart = session.get('cart', {})
-                
-                # Regenerate session to prevent session fixation
+                # Regenerate session to prevent session fixation (keeps the cart)
                 session['user_id'] = user_id
                 session['username'] = db_username
                 session.permanent = True
                 regenerate_session()
-                
-                # Restore cart after session regeneration
-                session['cart'] = old_cart
-                session.modified = True
+                merge_guest_cart_into_user(cur, user_id)
                 
                 cur.execute("UPDATE users SET failed_login_attempts = 0, locked_until = NULL WHERE id = %s", (user_id,))
                 mysql.connection.commit()
@@ -1929,7 +3884,7 @@ def login():
                 cur.close()
                 return redirect(next_page or url_for('home'))
             else:
-                record_attempt(ip_address, login_attempts)
+                record_attempt(ip_address, 'login')
                 failed_attempts += 1
                 if failed_attempts >= 5:
                     lock_time = datetime.now() + timedelta(minutes=30)
@@ -1941,7 +3896,7 @@ def login():
                     flash(f'Invalid credentials. {5 - failed_attempts} attempts remaining.', 'error')
                 mysql.connection.commit()
         else:
-            record_attempt(ip_address, login_attempts)
+            record_attempt(ip_address, 'login')
             flash('Invalid username or password.', 'error')
         cur.close()
     return render_template('login.html', categories=categories, cart_items=cart_items)
@@ -1953,10 +3908,8 @@ def register():
     cart_items = []
     try:
         cur = mysql.connection.cursor()
-        cur.execute("SELECT * FROM categories")
-        categories_data = cur.fetchall()
-        categories = [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
-        cart_items = build_cart_items_from_session(cur, session.get('cart', {}))
+        categories = get_cached_categories()
+        cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
         cur.close()
     except Exception:
         pass
@@ -1976,6 +3929,10 @@ def register():
         address = request.form.get('address', '').strip()
         ip_address = request.remote_addr
 
+        if is_rate_limited(ip_address, 'registration', max_attempts=10):
+            flash('Too many registration attempts. Please try again in 15 minutes.', 'error')
+            return render_template('login.html', categories=categories, cart_items=cart_items)
+
         errors = []
         if not username or len(username) < 3:
             errors.append('Username must be at least 3 characters long.')
@@ -1996,7 +3953,7 @@ def register():
             errors.append('Passwords do not match.')
 
         if errors:
-            record_attempt(ip_address, registration_attempts)
+            record_attempt(ip_address, 'registration')
             for error in errors:
                 flash(error, 'error')
             return render_template('login.html', categories=categories, cart_items=cart_items)
@@ -2004,7 +3961,7 @@ def register():
         cur = mysql.connection.cursor()
         cur.execute("SELECT id FROM users WHERE username = %s OR email = %s", (username, email))
         if cur.fetchone():
-            record_attempt(ip_address, registration_attempts)
+            record_attempt(ip_address, 'registration')
             flash('Username or email already exists.', 'error')
             cur.close()
             return render_template('login.html', categories=categories, cart_items=cart_items)
@@ -2024,16 +3981,14 @@ def register():
         # Send welcome email
         send_welcome_email(email, first_name)
         
-        # Regenerate session after successful registration
-        old_cart = session.get('cart', {})
+        # Regenerate session after successful registration (keeps the cart)
         session['user_id'] = user_id
         session['username'] = username
         session.permanent = True
         regenerate_session()
-        
-        # Restore cart after session regeneration
-        session['cart'] = old_cart
-        session.modified = True
+        cur = mysql.connection.cursor()
+        merge_guest_cart_into_user(cur, user_id)
+        cur.close()
         
         if linked_orders > 0:
             flash(f'Account created successfully! Welcome, {first_name}! We\'ve linked {linked_orders} previous order(s) to your account.', 'success')
@@ -2045,14 +4000,20 @@ def register():
 @app.route('/logout')
 def logout():
     username = session.get('username', 'User')
-    cart = session.get('cart', {})  # Preserve cart on logout
+    cart_id = session.get('cart_id')  # The user's cart stays on their account; keep the browser's guest cart id
+    cart = session.get('cart', {})
     
     session.clear()
     
     # Restore cart for guest shopping
-    session['cart'] = cart
+    if cart_id:
+        session['cart_id'] = cart_id
+    if cart:
+        session['cart'] = cart
     session['csrf_token'] = secrets.token_urlsafe(32)
     session.modified = True
+    if hasattr(session, 'rotate'):
+        session.rotate()
     
     flash(f'Goodbye, {username}! You have been logged out.', 'info')
     return redirect(url_for('home'))
@@ -2061,12 +4022,13 @@ def logout():
 # Forgot Password Routes
 # ============================================
 @app.route('/forgot-password', methods=['GET', 'POST'])
+@rate_limited('forgot_password', 5, 15 * 60)
 def forgot_password():
     """Request password reset - sends code to email"""
     categories = get_all_categories()
     # Build cart items for template
     cur = mysql.connection.cursor()
-    cart_items = build_cart_items_from_session(cur, session.get('cart', {}))
+    cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
     cur.close()
     
     if request.method == 'POST':
@@ -2174,7 +4136,7 @@ def reset_password():
     categories = get_all_categories()
     # Build cart items for template
     cur = mysql.connection.cursor()
-    cart_items = build_cart_items_from_session(cur, session.get('cart', {}))
+    cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
     cur.close()
     
     if request.method == 'POST':
@@ -2295,9 +4257,6 @@ def google_callback():
         first_name = name_parts[0] if name_parts else "User"
         last_name = name_parts[1] if len(name_parts) > 1 else ""
         
-        # Preserve cart before processing
-        old_cart = session.get('cart', {})
-        
         # Check if user exists
         cur = mysql.connection.cursor()
         cur.execute("SELECT id, username, first_name, last_name FROM users WHERE email = %s", (email,))
@@ -2320,10 +4279,7 @@ def google_callback():
             session['username'] = username
             session.permanent = True
             regenerate_session()
-            
-            # Restore cart
-            session['cart'] = old_cart
-            session.modified = True
+            merge_guest_cart_into_user(cur, user_id)
             
             flash(f'Welcome back, {db_first_name}!', 'success')
             cur.close()
@@ -2363,10 +4319,7 @@ def google_callback():
             session['username'] = username
             session.permanent = True
             regenerate_session()
-            
-            # Restore cart
-            session['cart'] = old_cart
-            session.modified = True
+            merge_guest_cart_into_user(cur, user_id)
             
             flash(f'Welcome to CiTiPlug, {first_name}! Your account has been created.', 'success')
             cur.close()
@@ -2379,64 +4332,104 @@ def google_callback():
 
 # Guest registration route removed - using existing login/register page instead
 
+ORDERS_PER_PAGE = 20
+
+def fetch_user_orders(cur, user_id, page=1, per_page=ORDERS_PER_PAGE):
+    """Fetch one page of a user's orders with their items in two queries.
+    Returns (orders, has_more).
+    """
+    offset = (max(page, 1) - 1) * per_page
+    cur.execute(
+        """
+        SELECT id, total_amount, status, provider, momo_number, created_at, payment_status, momo_transaction_id, address_line, city, delivered
+        FROM orders
+        WHERE user_id = %s
+        ORDER BY id DESC
+        LIMIT %s OFFSET %s
+        """,
+        (user_id, per_page + 1, offset)
+    )
+    order_rows = cur.fetchall()
+    has_more = len(order_rows) > per_page
+    orders = []
+    for o in order_rows[:per_page]:
+        orders.append({
+            'id': o[0],
+            'total_amount': float(o[1]) if o[1] is not None else 0.0,
+            'status': o[2],
+            'provider': o[3],
+            'momo_number': o[4],
+            'created_at': o[5],
+            'payment_status': o[6],
+            'momo_transaction_id': o[7],
+            'address_line': o[8] if len(o) > 8 else '',
+            'city': o[9] if len(o) > 9 else '',
+            'delivered': (o[10] if len(o) > 10 else None) or '',
+            'items': []
+        })
+    if not orders:
+        return orders, has_more
+
+    # All items for the page in one query, grouped by order in Python
+    orders_by_id = {order['id']: order for order in orders}
+    try:
+        placeholders = ','.join(['%s'] * len(orders_by_id))
+        cur.execute(
+            f"""
+            SELECT oi.order_id, oi.product_id, oi.product_name, oi.price, oi.quantity, oi.subtotal, p.image, oi.VARIATIONS
+            FROM order_items oi
+            LEFT JOIN products p ON p.id = oi.product_id
+            WHERE oi.order_id IN ({placeholders})
+            ORDER BY oi.order_id, oi.id ASC
+            """,
+            tuple(orders_by_id.keys())
+        )
+        for it in cur.fetchall():
+            order = orders_by_id.get(it[0])
+            if order is None:
+                continue
+            order['items'].append({
+                'product_id': it[1],
+                'name': it[2],
+                'price': float(it[3]) if it[3] is not None else 0.0,
+                'quantity': int(it[4]) if it[4] is not None else 0,
+                'subtotal': float(it[5]) if it[5] is not None else 0.0,
+                'image': resolve_image_url(it[6]) if len(it) > 6 else None,
+                'variations': it[7] if len(it) > 7 else ''
+            })
+    except Exception:
+        pass
+    return orders, has_more
+
+@app.route('/profile/orders')
+@login_required
+def profile_orders():
+    """'Load more' endpoint for the profile order history (rendered order cards as JSON)"""
+    page = request.args.get('page', 2, type=int)
+    try:
+        cur = mysql.connection.cursor()
+        orders, has_more = fetch_user_orders(cur, session['user_id'], page=page)
+        cur.close()
+        html = ''.join(render_template('order_card.html', order=order) for order in orders)
+        return jsonify({'success': True, 'html': html, 'count': len(orders), 'has_more': has_more, 'next_page': page + 1})
+    except Exception as e:
+        print(f"Error loading orders page {page}: {e}")
+        return jsonify({'success': False, 'error': 'Could not load orders'}), 500
+
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     user_id = session['user_id']
     cur = mysql.connection.cursor()
-    cur.execute("SELECT * FROM categories")
-    categories_data = cur.fetchall()
-    categories = [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
-    cur.execute("SELECT id, username, email, password_hash, first_name, last_name, phone, city, address, is_active FROM users WHERE id = %s", (user_id,))
-    row = cur.fetchone()
-    if not row:
+    categories = get_cached_categories()
+    current_user = get_current_user()
+    if not current_user:
         cur.close()
         flash('User not found.', 'error')
         return redirect(url_for('home'))
-    # Build user object defensively in case some columns are missing in schema
-    user = {
-        'id': row[0] if len(row) > 0 else user_id,
-        'username': row[1] if len(row) > 1 else '',
-        'email': row[2] if len(row) > 2 else '',
-        'password_hash': row[3] if len(row) > 3 else '',
-        'first_name': row[4] if len(row) > 4 else '',
-        'last_name': row[5] if len(row) > 5 else '',
-        'phone': row[6] if len(row) > 6 else '',
-        'city': row[7] if len(row) > 7 else '',
-        'address': row[8] if len(row) > 8 else '',
-        'is_active': row[9] if len(row) > 9 else 1
-    }
-    cart_items = []
-    for product_id, item in session.get('cart', {}).items():
-        # product_id in session is stored as string; cast to int for DB lookup
-        pid = None
-        try:
-            pid = int(product_id)
-        except Exception:
-            pid = product_id
-        cur.execute("SELECT * FROM products WHERE id = %s", (pid,))
-        product_data = cur.fetchone()
-        if product_data:
-            product = {
-                'id': product_data[0],
-                'name': product_data[1],
-                'price': float(product_data[2]),
-                'image': product_data[3],
-                'category_id': product_data[4],
-                'stock': product_data[5] if len(product_data) > 5 else 999
-            }
-            item['quantity'] = min(item['quantity'], product['stock'])
-            if item['quantity'] > 0:
-                cart_items.append({
-                    'id': product_id,
-                    'name': item['name'],
-                    'price': item['price'],
-                    'image': product['image'],
-                    'quantity': item['quantity'],
-                    'stock': product['stock'],
-                    'variations': item.get('variations', ''),  # Include variations
-                    'is_new': False
-                })
+    # Copy: the cached profile is shared and the form handlers below edit this one
+    user = dict(current_user)
+    cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
     
     # Fetch wishlist items (resilient)
     wishlist_items = []
@@ -2456,67 +4449,19 @@ def profile():
         # If wishlist table/columns are missing or any error occurs, fail soft
         wishlist_items = []
 
-    # Fetch this user's orders with items (resilient)
-    user_orders = []
+    # Fetch the first page of this user's orders with items (resilient)
     try:
-        cur.execute(
-            """
-            SELECT id, total_amount, status, provider, momo_number, created_at, payment_status, momo_transaction_id, address_line, city, delivered
-            FROM orders
-            WHERE user_id = %s
-            ORDER BY id DESC, created_at DESC
-            """,
-            (user_id,)
-        )
-        order_rows = cur.fetchall()
-        for o in order_rows:
-            order = {
-                'id': o[0],
-                'total_amount': float(o[1]) if o[1] is not None else 0.0,
-                'status': o[2],
-                'provider': o[3],
-                'momo_number': o[4],
-                'created_at': o[5],
-                'payment_status': o[6],
-                'momo_transaction_id': o[7],
-                'address_line': o[8] if len(o) > 8 else '',
-                'city': o[9] if len(o) > 9 else '',
-                'delivered': (o[10] if len(o) > 10 else None) or '',
-                'items': []
-            }
-            try:
-                cur2 = mysql.connection.cursor()
-                cur2.execute(
-                    """
-                    SELECT oi.product_id, oi.product_name, oi.price, oi.quantity, oi.subtotal, p.image, oi.VARIATIONS
-                    FROM order_items oi
-                    LEFT JOIN products p ON p.id = oi.product_id
-                    WHERE oi.order_id = %s
-                    ORDER BY oi.id ASC
-                    """,
-                    (order['id'],)
-                )
-                for it in cur2.fetchall():
-                    order['items'].append({
-                        'product_id': it[0],
-                        'name': it[1],
-                        'price': float(it[2]) if it[2] is not None else 0.0,
-                        'quantity': int(it[3]) if it[3] is not None else 0,
-                        'subtotal': float(it[4]) if it[4] is not None else 0.0,
-                        'image': resolve_image_url(it[5]) if len(it) > 5 else None,
-                        'variations': it[6] if len(it) > 6 else ''
-                    })
-                cur2.close()
-            except Exception:
-                pass
-            user_orders.append(order)
+        user_orders, orders_has_more = fetch_user_orders(cur, user_id, page=1)
+        cur.execute("SELECT COUNT(*) FROM orders WHERE user_id = %s", (user_id,))
+        orders_total = cur.fetchone()[0]
     except Exception:
-        user_orders = []
+        user_orders, orders_has_more, orders_total = [], False, 0
+    orders_context = {'orders_has_more': orders_has_more, 'orders_total': orders_total}
     
     if request.method == 'POST':
         if not validate_csrf():
             flash('Invalid session. Please refresh and try again.', 'error')
-            return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders)
+            return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders, **orders_context)
         form_type = request.form.get('form_type')
         if form_type == 'info':
             username = request.form.get('username', '').strip()
@@ -2545,39 +4490,41 @@ def profile():
                     flash(err, 'error')
                 user.update({'username': username, 'email': email, 'first_name': first_name, 'last_name': last_name,
                                 'phone': phone, 'city': city, 'address': address})
-                return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders)
+                return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders, **orders_context)
             cur.execute("""
                 UPDATE users SET username=%s, email=%s, first_name=%s, last_name=%s, phone=%s, city=%s, address=%s
                 WHERE id=%s
             """, (username, email, first_name, last_name, phone, city, address, user_id))
             mysql.connection.commit()
+            invalidate_user_profile(user_id)
             session['username'] = username
             flash('Profile updated successfully.', 'success')
-            cur.execute("SELECT id, username, email, password_hash, first_name, last_name, phone, city, address, is_active FROM users WHERE id = %s", (user_id,))
-            row = cur.fetchone()
-            user.update({'username': row[1], 'email': row[2], 'first_name': row[4], 'last_name': row[5], 'phone': row[6], 'city': row[7], 'address': row[8]})
-            return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders)
+            user = dict(get_current_user() or user)
+            return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders, **orders_context)
         elif form_type == 'password':
             current_password = request.form.get('current_password', '')
             new_password = request.form.get('new_password', '')
             confirm_password = request.form.get('confirm_password', '')
-            if not verify_password(current_password, user['password_hash']):
+            # The password hash is never cached - read it only when it's needed
+            cur.execute("SELECT password_hash FROM users WHERE id = %s", (user_id,))
+            hash_row = cur.fetchone()
+            if not hash_row or not verify_password(current_password, hash_row[0]):
                 flash('Current password is incorrect.', 'error')
-                return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders)
+                return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders, **orders_context)
             ok, msg = validate_password(new_password)
             if not ok:
                 flash(msg, 'error')
-                return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders)
+                return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders, **orders_context)
             if new_password != confirm_password:
                 flash('New passwords do not match.', 'error')
-                return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders)
+                return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders, **orders_context)
             new_hash = hash_password(new_password)
             cur.execute("UPDATE users SET password_hash=%s WHERE id=%s", (new_hash, user_id))
             mysql.connection.commit()
             flash('Password updated successfully.', 'success')
-            return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders)
+            return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders, **orders_context)
     cur.close()
-    return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders)
+    return render_template('profile.html', user=user, categories=categories, cart_items=cart_items, wishlist_items=wishlist_items, user_orders=user_orders, **orders_context)
 
 
 @app.post('/orders/cancel/<int:order_id>')
@@ -2585,7 +4532,8 @@ def profile():
 def cancel_order(order_id):
     try:
         cur = mysql.connection.cursor()
-        cur.execute("SELECT user_id, status, delivered FROM orders WHERE id=%s", (order_id,))
+        # Locked so two cancels of the same order can't both restore its stock
+        cur.execute("SELECT user_id, status, delivered FROM orders WHERE id=%s FOR UPDATE", (order_id,))
         row = cur.fetchone()
         if not row:
             flash('Order not found.', 'error')
@@ -2603,21 +4551,20 @@ def cancel_order(order_id):
         
         # Fetch order items to restore stock
         cur.execute("""
-            SELECT product_id, quantity, VARIATIONS 
+            SELECT product_id, quantity, VARIATIONS, img_var_id, dropdown_var_id 
             FROM order_items 
             WHERE order_id = %s
         """, (order_id,))
-        order_items = cur.fetchall()
+        lines = []
+        for product_id, quantity, variations, img_var_id, dropdown_var_id in cur.fetchall():
+            line = {'product_id': product_id, 'quantity': quantity or 0, 'variations': variations or ''}
+            if img_var_id or dropdown_var_id:
+                line.update(img_var_id=img_var_id, dropdown_var_id=dropdown_var_id)
+            lines.append(line)
         
-        # Restore stock for each item using smart hierarchy
-        for item in order_items:
-            product_id = item[0]
-            quantity = int(item[1]) if item[1] else 0
-            variations = item[2] if len(item) > 2 and item[2] else ''
-            
-            if quantity > 0:
-                stock_level = restore_stock_smartly(cur, product_id, quantity, variations)
-                print(f"ORDER CANCEL: Stock restored to {stock_level} level for product_id={product_id}, qty={quantity}")
+        # Restore stock for the whole order (older items without variation ids are resolved from VARIATIONS)
+        restored = restore_order_stock(cur, lines)
+        print(f"ORDER CANCEL: Stock restored for order #{order_id}: {restored}")
         
         # Update order status, payment status, and delivered to cancelled
         cur.execute("""
@@ -2654,6 +4601,16 @@ def debug_products():
         print(f"Error in /api/debug/products: {e}")
         return jsonify(error='server_error'), 500
 
+@app.get('/api/debug/db-pool')
+def debug_db_pool():
+    """Connection pool counters for sizing MYSQL_POOL_SIZE / MYSQL_POOL_MAX_OVERFLOW"""
+    return jsonify(db_pool.stats())
+
+@app.get('/api/debug/http-clients')
+def debug_http_clients():
+    """Per-provider outbound HTTP counters and circuit breaker state (this worker only)"""
+    return jsonify({name: client.stats() for name, client in HTTP_CLIENTS.items()})
+
 @app.get('/api/product/<int:product_id>')
 def api_product(product_id):
     try:
@@ -2691,157 +4648,27 @@ def api_product(product_id):
         cur.close()
         return jsonify(error='not_found'), 404
     except Exception as e:
-        print(f"/api/product error: {e}")
-        return jsonify(error='server_error'), 500
-
-@app.route('/')
-def home():
-    try:
-        cur = get_db_cursor()
-        if not cur:
-            return "Database connection failed. Please check if MySQL is running and accessible.", 500
-        # Get all categories for sidebar
-        cur.execute("SELECT * FROM categories")
-        categories_data = cur.fetchall()
-        categories = [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
-        
-        # Get curated product sections
-        products_sections = {}
-        
-        # 1. Top Selling - 8 products (prioritize rated products, then show any products)
-        cur.execute("""
-            SELECT * FROM products 
-            WHERE stock > 0
-            ORDER BY COALESCE(rate, 0) DESC, id DESC
-            LIMIT 8
-        """)
-        top_selling_data = cur.fetchall()
-        top_selling = []
-        for prod in top_selling_data:
-            product_with_discount = get_product_with_discount(prod)
-            if product_with_discount:
-                top_selling.append(product_with_discount)
-        
-        # Always show Top Selling section, even if no rated products
-        if top_selling:
-            products_sections['top_selling'] = {
-                'name': 'Top Selling',
-                'products': top_selling,
-                'order': 1
-            }
-        
-        # 2. New Arrivals - 8 newest products
-        cur.execute("""
-            SELECT * FROM products 
-            WHERE stock > 0
-            ORDER BY id DESC
-            LIMIT 8
-        """)
-        new_arrivals_data = cur.fetchall()
-        new_arrivals = []
-        for prod in new_arrivals_data:
-            product_with_discount = get_product_with_discount(prod)
-            if product_with_discount:
-                new_arrivals.append(product_with_discount)
-        if new_arrivals:
-            products_sections['new_arrivals'] = {
-                'name': 'New Arrivals',
-                'products': new_arrivals,
-                'order': 2
-            }
-        
-        # 3. On Sale - 8 products with highest discount
-        cur.execute("""
-            SELECT * FROM products 
-            WHERE discount > 0
-            ORDER BY discount DESC
-            LIMIT 8
-        """)
-        on_sale_data = cur.fetchall()
-        on_sale = []
-        for prod in on_sale_data:
-            product_with_discount = get_product_with_discount(prod)
-            if product_with_discount:
-                on_sale.append(product_with_discount)
-        if on_sale:
-            products_sections['on_sale'] = {
-                'name': 'On Sale',
-                'products': on_sale,
-                'order': 3
-            }
-        
-        # 4. Explore More - 12 random products from different categories
-        random_products = []
-        try:
-            # Get 12 random products, prioritizing diversity across categories
-            cur.execute("""
-                SELECT p.*, 
-                       @cat_rank := IF(@current_cat = p.category_id, @cat_rank + 1, 1) AS cat_rank,
-                       @current_cat := p.category_id
-                FROM products p
-                CROSS JOIN (SELECT @cat_rank := 0, @current_cat := NULL) vars
-                ORDER BY RAND()
-            """)
-            seen_categories = set()
-            for row in cur.fetchall():
-                if len(random_products) >= 12:
-                    break
-                cat_id = row[4]  # category_id is at index 4
-                # Prefer products from categories we haven't seen yet
-                if cat_id not in seen_categories or len(random_products) < 12:
-                    prod_obj = get_product_with_discount(row)
-                    if prod_obj:
-                        random_products.append(prod_obj)
-                        seen_categories.add(cat_id)
-        except Exception:
-            random_products = []
-        
-        if random_products:
-            products_sections['explore_more'] = {
-                'name': 'Explore More',
-                'products': random_products,
-                'order': 99
-            }
+        print(f"/api/product error: {e}")
+        return jsonify(error='server_error'), 500
+
+@app.route('/')
+def home():
+    try:
+        cur = get_db_cursor()
+        if not cur:
+            return "Database connection failed. Please check if MySQL is running and accessible.", 500
+        # Sidebar categories and curated sections come prebuilt (see get_home_sections)
+        home_data = get_home_sections() or {}
+        categories = home_data.get('categories', [])
+        products_sections = dict(home_data.get('products_sections', []))
+        explore_more = explore_more_section(home_data.get('explore_pool'))
+        if explore_more:
+            products_sections['explore_more'] = explore_more
         
         # Get cart items using standardized function
-        cart_items = build_cart_items_from_session(cur, session.get('cart', {}))
+        cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
         # Build a safe 'user' object for the template to avoid UndefinedError
-        user = None
-        try:
-            if 'user_id' in session:
-                cur.execute(
-                    "SELECT id, username, email, first_name, last_name, phone, city, address FROM users WHERE id = %s",
-                    (session['user_id'],)
-                )
-                row = cur.fetchone()
-                if row:
-                    user = {
-                        'id': row[0],
-                        'username': row[1],
-                        'email': row[2],
-                        'first_name': row[3],
-                        'last_name': row[4],
-                        'phone': row[5],
-                        'city': row[6],
-                        'address': row[7],
-                    }
-        except Exception:
-            # Non-fatal: if user lookup fails, fall back to empty defaults
-            user = None
-        if user is None:
-            user = {
-                'id': None,
-                'username': '',
-                'email': '',
-                'first_name': '',
-                'last_name': '',
-                'phone': '',
-                'city': '',
-                'address': '',
-            }
-        
-        # Sort sections by order field
-        products_sections = dict(sorted(products_sections.items(), key=lambda x: x[1].get('order', 999)))
+        user = get_current_user() or dict(ANONYMOUS_USER)
         
         cur.close()
         return render_template("home.html", categories=categories, products_sections=products_sections, cart_items=cart_items, user=user)
@@ -2849,18 +4676,76 @@ def home():
         print(f"Error in /home: {e}")
         flash(f"Error loading homepage: {e}", 'error')
         # Avoid redirect loop by rendering a minimal safe page
-        safe_user = {
-            'id': None,
-            'username': '',
-            'email': '',
-            'first_name': '',
-            'last_name': '',
-            'phone': '',
-            'city': '',
-            'address': '',
-        }
+        safe_user = dict(ANONYMOUS_USER)
         return render_template("home.html", categories=[], products_by_cat={}, products_sections={}, cart_items=[], user=safe_user), 500
 
+# Sort orders for /viewall: (sort column, direction). Every order is tie-broken on id so keyset
+# (?after=) pages never skip or repeat rows that share a price or rating.
+VIEWALL_SORTS = {
+    'newest': ('id', 'DESC'),
+    'oldest': ('id', 'ASC'),
+    'price_low': ('price', 'ASC'),
+    'price_high': ('price', 'DESC'),
+    # rating_sort is rate stored as an exact DECIMAL (migration 0009), so cursor equality is exact
+    # and (category_id, rating_sort, id) serves the sort; price likewise has (category_id, price, id)
+    'rating': ('rating_sort', 'DESC'),
+}
+VIEWALL_COUNT_TTL = 300
+
+
+def viewall_order_by(sort_by):
+    column, direction = VIEWALL_SORTS.get(sort_by, VIEWALL_SORTS['newest'])
+    if column == 'id':
+        return f"id {direction}"
+    return f"{column} {direction}, id {direction}"
+
+
+def encode_viewall_cursor(sort_by, prod):
+    """Opaque ?after= token for the row a page ended on: sort order, sort key and id"""
+    column = VIEWALL_SORTS.get(sort_by, VIEWALL_SORTS['newest'])[0]
+    if column == 'id':
+        key = None
+    elif column == 'price':
+        key = str(prod[2])
+    else:
+        key = f"{float(prod[8]) if len(prod) > 8 and prod[8] is not None else 0.0:.4f}"
+    raw = json.dumps([sort_by, key, prod[0]], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_viewall_cursor(token, sort_by):
+    """Returns (sort key, id) or None if the token is malformed or was issued for another sort order"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        token_sort, key, last_id = json.loads(raw)
+        if token_sort != sort_by:
+            return None
+        return key, int(last_id)
+    except Exception:
+        return None
+
+
+def viewall_seek_clause(sort_by, cursor):
+    """WHERE fragment and params selecting the rows strictly after the cursor in the given order"""
+    column, direction = VIEWALL_SORTS.get(sort_by, VIEWALL_SORTS['newest'])
+    key, last_id = cursor
+    op = '<' if direction == 'DESC' else '>'
+    if column == 'id':
+        return f" AND id {op} %s", [last_id]
+    return f" AND ({column} {op} %s OR ({column} = %s AND id {op} %s))", [key, key, last_id]
+
+
+def get_viewall_count(cur, where_clause, where_params, category_id):
+    """COUNT(*) for a filter set, cached briefly so deep keyset paging doesn't recount every request"""
+    digest = hashlib.md5(json.dumps([where_clause, where_params], default=str).encode()).hexdigest()
+    
+    def load():
+        cur.execute(f"SELECT COUNT(*) FROM products WHERE {where_clause}", where_params)
+        return cur.fetchone()[0]
+    
+    return get_or_compute(f"viewall_count:{digest}", load, VIEWALL_COUNT_TTL, tags=[category_cache_tag(category_id)])
+
+
 @app.route('/viewall')
 def viewall():
     category_id = request.args.get('category')
@@ -2871,6 +4756,12 @@ def viewall():
     min_price = request.args.get('min_price', type=float)
     max_price = request.args.get('max_price', type=float)
     selected_sizes = request.args.getlist('size')  # Multiple sizes
+    # Keyset mode (opt-in): ?after=<token> (empty for the first page) seeks instead of OFFSET
+    after = request.args.get('after')
+    cursor_mode = after is not None
+    wants_json = request.args.get('format') == 'json'
+    if sort_by not in VIEWALL_SORTS:
+        sort_by = 'newest'
     
     if not category_id:
         flash('Category not specified', 'error')
@@ -2888,12 +4779,10 @@ def viewall():
             where_clause = "(category_id IS NULL OR category_id = 0 OR category_id NOT IN (SELECT id FROM categories))"
             where_params = []
         else:
-            cur.execute("SELECT * FROM categories WHERE id = %s", (category_id,))
-            category_data = cur.fetchone()
-            if not category_data:
+            category = next((c for c in get_cached_categories() if str(c['id']) == str(category_id)), None)
+            if not category:
                 flash('Category not found', 'error')
                 return redirect(url_for('home'))
-            category = {'id': category_data[0], 'name': category_data[1]}
             
             # Build WHERE clause for filters
             where_clause = "category_id = %s"
@@ -2911,45 +4800,47 @@ def viewall():
             where_clause += " AND price <= %s"
             where_params.append(max_price)
         
-        # Get total count for pagination
-        cur.execute(f"SELECT COUNT(*) FROM products WHERE {where_clause}", where_params)
-        total_products = cur.fetchone()[0]
-        
-        # Calculate pagination
-        total_pages = (total_products + per_page - 1) // per_page  # Ceiling division
-        offset = (page - 1) * per_page
-        
-        # Build ORDER BY clause
-        order_by = "id DESC"  # default: newest
-        if sort_by == 'oldest':
-            order_by = "id ASC"
-        elif sort_by == 'price_low':
-            order_by = "price ASC"
-        elif sort_by == 'price_high':
-            order_by = "price DESC"
-        elif sort_by == 'rating':
-            order_by = "rate DESC"
-        
-        # Get base products
-        cur.execute(f"SELECT * FROM products WHERE {where_clause} ORDER BY {order_by} LIMIT %s OFFSET %s", 
-                   where_params + [per_page, offset])
-        products_data_raw = cur.fetchall()
-        
-        # Filter by size if specified (via variations)
-        products_data = []
-        for prod in products_data_raw:
-            prod_id = prod[0]
+        # Size filter (via variations) - applied in SQL so count and pages agree.
+        # Columns use a case-insensitive collation, so no LOWER() that would defeat idx_dropdown_prod_attr.
+        if selected_sizes:
+            where_clause += (
+                " AND EXISTS (SELECT 1 FROM dropdown_variation dv WHERE dv.prod_id = products.id"
+                " AND dv.attr_name = 'size' AND dv.attr_value IN (" + ",".join(['%s'] * len(selected_sizes)) + "))"
+            )
+            where_params.extend(selected_sizes)
+        
+        order_by = viewall_order_by(sort_by)
+        next_cursor = None
+        
+        if cursor_mode:
+            # Seek past the last row of the previous page; count comes from a short-lived cache
+            total_products = get_viewall_count(cur, where_clause, where_params, category_id)
+            total_pages = 0
+            page_clause, page_params = where_clause, list(where_params)
+            cursor = decode_viewall_cursor(after, sort_by) if after else None
+            if cursor:
+                seek_clause, seek_params = viewall_seek_clause(sort_by, cursor)
+                page_clause += seek_clause
+                page_params += seek_params
+            cur.execute(f"SELECT * FROM products WHERE {page_clause} ORDER BY {order_by} LIMIT %s",
+                       page_params + [per_page + 1])
+            products_data = cur.fetchall()
+            if len(products_data) > per_page:
+                products_data = products_data[:per_page]
+                next_cursor = encode_viewall_cursor(sort_by, products_data[-1])
+        else:
+            # Get total count for pagination
+            cur.execute(f"SELECT COUNT(*) FROM products WHERE {where_clause}", where_params)
+            total_products = cur.fetchone()[0]
             
-            # Check size filter
-            if selected_sizes:
-                cur.execute(
-                    "SELECT COUNT(*) FROM dropdown_variation WHERE prod_id = %s AND LOWER(attr_name) = 'size' AND LOWER(attr_value) IN (" + ",".join(['%s'] * len(selected_sizes)) + ")",
-                    [prod_id] + [s.lower() for s in selected_sizes]
-                )
-                if cur.fetchone()[0] == 0:
-                    continue
+            # Calculate pagination
+            total_pages = (total_products + per_page - 1) // per_page  # Ceiling division
+            offset = (page - 1) * per_page
             
-            products_data.append(prod)
+            # Get base products
+            cur.execute(f"SELECT * FROM products WHERE {where_clause} ORDER BY {order_by} LIMIT %s OFFSET %s", 
+                       where_params + [per_page, offset])
+            products_data = cur.fetchall()
         products = []
         for prod in products_data:
             original_price = float(prod[2]) if prod[2] is not None else 0.0
@@ -2968,12 +4859,21 @@ def viewall():
                 'discount': discount,
                 'rate': float(prod[8]) if len(prod) > 8 and prod[8] is not None else 0.0
             })
-        cur.execute("SELECT * FROM categories")
-        categories_data = cur.fetchall()
-        categories = [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
+        
+        if cursor_mode and wants_json:
+            cur.close()
+            return jsonify({
+                'success': True,
+                'products': products,
+                'next_cursor': next_cursor,
+                'has_more': next_cursor is not None,
+                'total_products': total_products
+            })
+        
+        categories = get_cached_categories()
         
         # Get cart items using standardized function
-        cart_items = build_cart_items_from_session(cur, session.get('cart', {}))
+        cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
         
         # Get available sizes for this category
         if category_id == 'uncategorized':
@@ -3004,6 +4904,8 @@ def viewall():
                               current_page=page,
                               total_pages=total_pages,
                               total_products=total_products,
+                              cursor_mode=cursor_mode,
+                              next_cursor=next_cursor,
                               sort_by=sort_by,
                               show_out_of_stock=show_out_of_stock,
                               min_price=min_price,
@@ -3019,7 +4921,7 @@ def viewall():
 
 @app.route('/add-to-cart', methods=['GET'])
 def add_to_cart():
-    """Simple, reliable add-to-cart functionality using Flask sessions"""
+    """Simple, reliable add-to-cart functionality using the cart service"""
     try:
         # Get parameters
         product_id = request.args.get('product_id')
@@ -3036,10 +4938,6 @@ def add_to_cart():
             flash('Product ID not specified', 'error')
             return redirect(url_for('home'))
         
-        # Initialize session cart
-        if 'cart' not in session:
-            session['cart'] = {}
-        
         # Get product info
         cur = mysql.connection.cursor()
         cur.execute("SELECT * FROM products WHERE id = %s", (product_id,))
@@ -3090,57 +4988,39 @@ def add_to_cart():
             cur.close()
             return redirect(request.referrer or url_for('home'))
         
-        # Add to cart with stock validation
-        if cart_key in session['cart']:
-            current_qty = session['cart'][cart_key]['quantity']
-            new_total_qty = current_qty + requested_quantity
-            
-            if new_total_qty <= actual_stock:
-                session['cart'][cart_key]['quantity'] = new_total_qty
-                # Show stock warning if getting close to limit
-                remaining = actual_stock - new_total_qty
-                if remaining <= 0:
-                    flash(f'Added to cart. No more {product["name"]} available in stock!', 'warning')
-                elif remaining <= 2:
-                    flash(f'Added to cart. Only {remaining} left in stock!', 'warning')
-                else:
-                    flash(f'Added {requested_quantity} to cart', 'success')
-            else:
-                # Can't add full requested quantity, add what we can
-                max_can_add = actual_stock - current_qty
-                if max_can_add > 0:
-                    session['cart'][cart_key]['quantity'] = actual_stock
-                    flash(f'Only {max_can_add} more available in stock. Added {max_can_add} to cart.', 'warning')
-                else:
-                    flash(f'Cannot add more - only {actual_stock} available in stock', 'error')
-                    cur.close()
-                    return redirect(request.referrer or url_for('home'))
+        # Add to cart with stock validation (the increment itself is atomic and clamped to stock)
+        current_qty = get_cart_from_redis().get(cart_key, {}).get('quantity', 0)
+        if current_qty >= actual_stock:
+            flash(f'Cannot add more - only {actual_stock} available in stock', 'error')
+            cur.close()
+            return redirect(request.referrer or url_for('home'))
+        
+        line = {
+            'product_id': product_id,
+            'name': product['name'],
+            'price': product['price'],
+            'variations': variation_display,
+            'img_var_id': img_var_id,
+            'dropdown_var_id': dropdown_var_id
+        }
+        new_total_qty = add_cart_line(cart_key, line, requested_quantity, max_quantity=actual_stock)
+        added = new_total_qty - current_qty
+        
+        # Debug logging
+        print(f"STORED IN CART: cart_key={cart_key}, variations={variation_display}, img_var_id={img_var_id}")
+        
+        # Show appropriate message
+        if added < requested_quantity:
+            flash(f'Only {added} more available in stock. Added {added} to cart.', 'warning')
+        elif current_qty and actual_stock - new_total_qty <= 0:
+            flash(f'Added to cart. No more {product["name"]} available in stock!', 'warning')
+        elif current_qty and actual_stock - new_total_qty <= 2:
+            flash(f'Added to cart. Only {actual_stock - new_total_qty} left in stock!', 'warning')
+        elif added > 1:
+            flash(f'Added {added} items to cart', 'success')
         else:
-            # Validate requested quantity doesn't exceed stock
-            final_quantity = min(requested_quantity, actual_stock)
-            
-            session['cart'][cart_key] = {
-                'product_id': product_id,
-                'name': product['name'],
-                'price': product['price'],
-                'quantity': final_quantity,
-                'variations': variation_display,
-                'img_var_id': img_var_id,
-                'dropdown_var_id': dropdown_var_id
-            }
-            
-            # Debug logging
-            print(f"STORED IN CART: cart_key={cart_key}, variations={variation_display}, img_var_id={img_var_id}")
-            
-            # Show appropriate message
-            if final_quantity < requested_quantity:
-                flash(f'Only {final_quantity} available in stock. Added {final_quantity} to cart.', 'warning')
-            elif final_quantity > 1:
-                flash(f'Added {final_quantity} items to cart', 'success')
-            else:
-                flash('Product added to cart', 'success')
+            flash('Product added to cart', 'success')
         
-        session.modified = True
         cur.close()
         
         # Success message already shown above based on quantity
@@ -3152,8 +5032,7 @@ def add_to_cart():
         
         # Handle AJAX requests
         if request.args.get('ajax') == '1':
-            cart_count = sum(item['quantity'] for item in session['cart'].values())
-            return jsonify(success=True, cart_count=cart_count, message='Product added to cart')
+            return jsonify(success=True, cart_count=cart_item_count(), message='Product added to cart')
         
         # Regular redirect
         redirect_url = request.args.get('redirect')
@@ -3172,13 +5051,10 @@ def addtocart():
     """Cart page using Flask sessions"""
     try:
         cur = mysql.connection.cursor()
-        cur.execute("SELECT * FROM categories")
-        categories_data = cur.fetchall()
-        categories = [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
+        categories = get_cached_categories()
         
-        # Get cart from session using standardized function
-        current_cart = session.get('cart', {})
-        cart_items = build_cart_items_from_session(cur, current_cart)
+        # Get cart using standardized function
+        cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
         
         # Calculate total
         total = 0
@@ -3198,8 +5074,7 @@ def addtocart():
 def get_cart():
     """Simple cart API using Flask sessions - fetch variation images from database"""
     try:
-        # Get cart from session
-        cart_data = session.get('cart', {})
+        cart_data = get_cart_from_redis()
         cart_items = []
         cur = mysql.connection.cursor()
         
@@ -3382,7 +5257,7 @@ def get_dropdown_variations():
 
 @app.route('/update-cart', methods=['GET', 'POST'])
 def update_cart():
-    """Update cart quantities using Flask sessions"""
+    """Update cart quantities using the cart service"""
     try:
         cart_key = request.args.get('product_id') if request.method == 'GET' else request.form.get('product_id')
         action = request.args.get('action') if request.method == 'GET' else request.form.get('action')
@@ -3392,11 +5267,7 @@ def update_cart():
         # Debug logging (simplified)
         print(f"UPDATE CART: {request.method} - cart_key={cart_key}, action={action}, quantity={quantity}")
         
-        # Get cart from session
-        if 'cart' not in session:
-            session['cart'] = {}
-        
-        current_cart = session['cart']
+        current_cart = get_cart_from_redis()
         
         if not cart_key:
             print(f"ERROR: No cart_key provided")
@@ -3416,6 +5287,7 @@ def update_cart():
         product_name = cart_item.get('name', 'Product')
         
         if action == 'remove':
+            remove_cart_line(cart_key)
             current_cart.pop(cart_key, None)
             success_message = f'{product_name} removed from cart'
             flash(success_message, 'success')
@@ -3456,6 +5328,7 @@ def update_cart():
             
             # Enforce stock limits
             actual_qty = max(1, min(requested_qty, max_stock))
+            set_cart_line_quantity(cart_key, actual_qty)
             current_cart[cart_key]['quantity'] = actual_qty
             
             if requested_qty > max_stock:
@@ -3472,10 +5345,6 @@ def update_cart():
             if request.args.get('ajax') == '1' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
                 return jsonify(success=False, error=error_message)
         
-        # Save to session
-        session['cart'] = current_cart
-        session.modified = True
-        
         # Handle AJAX requests (only if explicitly marked as AJAX)
         if request.args.get('ajax') == '1' or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             cart_count = sum(item['quantity'] for item in current_cart.values())
@@ -3662,9 +5531,6 @@ def remove_from_wishlist():
 def wishlist_add_to_cart(product_id):
     """Add product from wishlist to cart"""
     try:
-        if 'cart' not in session:
-            session['cart'] = {}
-        
         cur = mysql.connection.cursor()
         cur.execute("SELECT * FROM products WHERE id = %s", (product_id,))
         product_data = cur.fetchone()
@@ -3675,24 +5541,12 @@ def wishlist_add_to_cart(product_id):
             return redirect(url_for('profile'))
         
         product = get_product_with_discount(product_data)
-        product_id_str = str(product_id)
-        
-        if product_id_str in session['cart']:
-            session['cart'][product_id_str]['quantity'] += 1
-        else:
-            session['cart'][product_id_str] = {
-                'product_id': product_id,
-                'name': product['name'],
-                'price': product['price'],
-                'original_price': product.get('original_price', product['price']),
-                'discount': product.get('discount', 0),
-                'image': product['image'],
-                'quantity': 1,
-                'stock': product.get('stock', 999),
-                'variations': ''
-            }
-        
-        session.modified = True
+        add_cart_line(str(product_id), {
+            'product_id': product_id,
+            'name': product['name'],
+            'price': product['price'],
+            'variations': ''
+        }, 1)
         cur.close()
         flash(f"{product['name']} added to cart!", 'success')
         return redirect(url_for('profile') + '#wishlist')
@@ -3705,43 +5559,29 @@ def wishlist_add_to_cart(product_id):
 def checkout():
     cur = None
     cur = mysql.connection.cursor()
-    cur.execute("SELECT * FROM categories")
-    categories_data = cur.fetchall()
-    categories = [{'id': cat[0], 'name': cat[1]} for cat in categories_data]
+    categories = get_cached_categories()
     
     # Fetch logged-in user data for auto-fill
     user_data = None
-    if 'user_id' in session:
-        cur.execute("SELECT first_name, last_name, email, phone, address, city FROM users WHERE id = %s", (session['user_id'],))
-        user_row = cur.fetchone()
-        if user_row:
-            # Combine first_name and last_name for full_name
-            full_name = f"{user_row[0] or ''} {user_row[1] or ''}".strip()
-            user_data = {
-                'full_name': full_name if full_name else None,
-                'email': user_row[2],
-                'phone': user_row[3],
-                'address': user_row[4],
-                'city': user_row[5]
-            }
+    current_user = get_current_user()
+    if current_user:
+        # Combine first_name and last_name for full_name
+        full_name = f"{current_user['first_name'] or ''} {current_user['last_name'] or ''}".strip()
+        user_data = {
+            'full_name': full_name if full_name else None,
+            'email': current_user['email'],
+            'phone': current_user['phone'],
+            'address': current_user['address'],
+            'city': current_user['city']
+        }
     
     # Get cart items using standardized function
-    cart_items = build_cart_items_from_session(cur, session.get('cart', {}))
+    cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
     
-    # Calculate total and add discount info
+    # Calculate total (original_price/discount already attached by the cart hydrator)
     total = 0.0
     for item in cart_items:
-        # Fetch discount info for each item
-        actual_product_id = item['product_id']
-        cur.execute("SELECT * FROM products WHERE id = %s", (actual_product_id,))
-        product_data = cur.fetchone()
-        if product_data:
-            product = get_product_with_discount(product_data)
-            if product:
-                item['original_price'] = product['original_price']
-                item['discount'] = product['discount']
-                item['is_new'] = False
-                total += item['price'] * item['quantity']
+        total += item['price'] * item['quantity']
     delivery_fee = 1500
     tax_rate = 0.18
     tax_amount = total * tax_rate
@@ -3762,6 +5602,18 @@ def checkout():
             provider = request.form.get('provider', 'MTN').strip().lower()  # Default to MTN
             momo_number = request.form.get('momo_number', '').strip()
             guest_email = request.form.get('guest_email', '').strip().lower() if 'user_id' not in session else None
+            order_key = cod_order_key(request.form.get('order_token', '').strip()) if payment_method == 'cod' else None
+            replayed_order_id = cached_order_for_key(order_key) if order_key else None
+            if replayed_order_id:
+                # This checkout form was already submitted and its order placed
+                cur.close()
+                return render_template('checkout.html',
+                                       categories=categories,
+                                       cart_items=[],
+                                       total=0,
+                                       user_data=user_data,
+                                       show_success_modal=True,
+                                       order_id=replayed_order_id)
             if not cart_items or total <= 0:
                 flash('Your cart is empty', 'error')
             else:
@@ -3867,64 +5719,22 @@ def checkout():
                             session.modified = True
                             
                             if payment_method == 'cod':
-                                # For Cash on Delivery, validate email BEFORE creating order
+                                # For Cash on Delivery, check the email (locally, no test send) BEFORE creating order
                                 order_email = user_data['email'] if user_data else guest_email
                                 
                                 if not order_email:
                                     flash('Email address is required to place an order', 'error')
-                                elif not validate_email_sendable(order_email):
+                                elif not is_email_deliverable(order_email):
                                     flash(f'The email address "{order_email}" is invalid or cannot receive emails. Please check and try again.', 'error')
                                 else:
                                     # Email is valid - create order
                                     try:
-                                        # Create the order directly
-                                        from datetime import datetime
-                                        cur = mysql.connection.cursor()
-                                        
-                                        # Insert order - match database schema exactly
-                                        cur.execute("""
-                                            INSERT INTO orders (user_id, full_name, address_line, city, 
-                                                              delivery_phone, provider, momo_number, notes, latitude, 
-                                                              longitude, total_amount, payment_status, status, 
-                                                              created_at)
-                                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                                        """, (
-                                            user_id, full_name, address_line, city,
-                                            delivery_phone, 'COD', None, notes, latitude,
-                                            longitude, total, 'pending', 'pending',
-                                            datetime.now()
-                                        ))
-                                        
-                                        order_id = cur.lastrowid
-                                        
-                                        # Insert order items - match database schema exactly
-                                        for item in cart_items:
-                                            subtotal = item['quantity'] * item['price']
-                                            variations = item.get('variations', '')
-                                            cur.execute("""
-                                                INSERT INTO order_items (order_id, product_id, product_name, price, quantity, subtotal, VARIATIONS)
-                                                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                                            """, (order_id, item['product_id'], item['name'], item['price'], item['quantity'], subtotal, variations))
-                                            
-                                            # DEDUCT STOCK from appropriate level (triggers will cascade)
-                                            stock_level = deduct_stock_smartly(cur, item['product_id'], int(item['quantity']), variations)
-                                            print(f"CHECKOUT COD: Stock deducted from {stock_level} level for {item['name']}")
-                                        
-                                        mysql.connection.commit()
-                                        
-                                        # Send order confirmation email
-                                        order_email = user_data['email'] if user_data else guest_email
-                                        print(f"[DEBUG] COD Order email: user_data={bool(user_data)}, guest_email={guest_email}, final_email={order_email}")
-                                        if order_email:
-                                            print(f"[EMAIL] Sending COD order confirmation to {order_email}")
-                                            send_order_confirmation_email(order_email, order_id, full_name, total, cart_items)
-                                        else:
-                                            print(f"[WARNING] No email found for COD order {order_id}")
-                                        
+                                        order_data = dict(session['pending_order'], provider='COD', momo_number=None)
+                                        order_id = place_cod_order(cur, order_key, order_data, order_email)
                                         cur.close()
                                         
                                         # Clear cart and pending order
-                                        session['cart'] = {}
+                                        clear_cart_from_redis()
                                         session.pop('pending_order', None)
                                         session.modified = True
                                         
@@ -3937,11 +5747,23 @@ def checkout():
                                                              show_success_modal=True,
                                                              order_id=order_id)
                                         
+                                    except InsufficientStockError as e:
+                                        print(f"COD order rejected: {e}")
+                                        flash('Some items in your cart are no longer in stock. Please review your cart.', 'error')
                                     except Exception as e:
                                         print(f"Error creating COD order: {e}")
                                         flash('Error creating order. Please try again.', 'error')
                             else:
-                                # Mobile Money payment
+                                # Mobile Money payment - payment_worker.py confirms it and creates the order
+                                order_email = user_data['email'] if user_data else guest_email
+                                create_payment_intent(cur, payment_result['ref'], external_id, session['pending_order'],
+                                                      final_total, email=order_email,
+                                                      cart_key=get_redis_cart_key() if REDIS_AVAILABLE else None)
+                                mysql.connection.commit()
+                                # Status checks use MTN's reference id, not our externalId
+                                session['payment_ref'] = payment_result['ref']
+                                publish_new_payment_intent(payment_result['ref'], user_id)
+                                wake_payment_reconciler()
                                 payment_initiated = True
                                 payment_message = f'Payment requested! Check your phone ({original_momo_number}) to approve.'
                                 flash(payment_message, 'success')
@@ -3953,139 +5775,23 @@ def checkout():
                     except Exception as e:
                         print(f"Payment initiation error: {e}")
                         flash('Error initiating payment. Try again.', 'error')
-    if payment_ref and payment_initiated:
-        payment_status = PayClass.verifymomo(payment_ref)
-        if payment_status.get('status') == 'SUCCESSFUL':
-            # Payment successful - NOW create the order
-            pending_order = session.get('pending_order')
-            if pending_order:
-                try:
-                    # Create order in database
-                    cur.execute(
-                        "INSERT INTO orders (user_id, guest_email, full_name, address_line, city, delivery_phone, provider, momo_number, notes, latitude, longitude, total_amount, status, momo_transaction_id, payment_status) "
-                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                        (
-                            pending_order['user_id'],
-                            pending_order['guest_email'],
-                            pending_order['full_name'],
-                            pending_order['address_line'],
-                            pending_order['city'],
-                            pending_order['delivery_phone'],
-                            pending_order['provider'],
-                            pending_order['momo_number'],
-                            pending_order['notes'],
-                            pending_order['latitude'],
-                            pending_order['longitude'],
-                            pending_order['total_amount'],
-                            'SUCCESSFUL',
-                            payment_ref,
-                            'paid'
-                        )
-                    )
-                    order_id = cur.lastrowid
-                    
-                    # Insert order items and deduct stock
-                    for item in pending_order['cart_items']:
-                        subtotal = item['price'] * item['quantity']
-                        # Use actual product_id for database operations
-                        product_id_for_db = item.get('product_id', item['id'])
-                        variations = item.get('variations', '')
-                        product_name_with_variations = item['name']
-                        
-                        print(f"Saving order item:")
-                        print(f"   Product: {product_name_with_variations}")
-                        print(f"   Variations RAW: '{variations}'")
-                        print(f"   Variations TYPE: {type(variations)}")
-                        print(f"   Full item dict: {item}")
-                        
-                        cur.execute(
-                            "INSERT INTO order_items (order_id, product_id, product_name, price, quantity, subtotal, VARIATIONS) "
-                            "VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                            (order_id, product_id_for_db, product_name_with_variations, item['price'], item['quantity'], subtotal, variations)
-                        )
-                        
-                        # DEDUCT STOCK from appropriate level (triggers will cascade)
-                        stock_level = deduct_stock_smartly(cur, product_id_for_db, int(item['quantity']), variations)
-                        print(f"MTN CHECKOUT: Stock deducted from {stock_level} level for {product_name_with_variations}")
-                    
-                    # Log payment record
-                    try:
-                        raw = json.dumps({'verify': payment_status})
-                        cur.execute(
-                            """
-                            INSERT INTO payments (order_id, momo_transaction_id, amount, currency, status, provider, payer_number, raw_response)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                            """,
-                            (
-                                order_id,
-                                payment_ref,
-                                float(pending_order['total_amount']),
-                                pending_order['currency'],
-                                'SUCCESSFUL',
-                                pending_order['provider'],
-                                pending_order['momo_number'],
-                                raw
-                            )
-                        )
-                    except Exception as _:
-                        pass
-                    
-                    mysql.connection.commit()
-                    
-                    # Clear cart and session data
-                    session['cart'] = {}
-                    session.pop('payment_ref', None)
-                    session.pop('pending_order', None)
-                    session.pop('provider', None)
-                    session.pop('momo_number', None)
-                    session.pop('currency', None)
-                    session.pop('final_total', None)
-                    session.modified = True
-                    
-                    payment_message = f'Payment successful! Order #{order_id} confirmed.'
-                    flash(payment_message, 'success')
-                    payment_initiated = True
-                except Exception as e:
-                    print(f"Error creating order after payment: {e}")
-                    mysql.connection.rollback()
-                    flash('Payment succeeded but order creation failed. Please contact support.', 'error')
-            else:
-                flash('Payment succeeded but order data was lost. Please contact support.', 'error')
-        elif payment_status.get('status') in ['FAILED', 'REJECTED', 'EXPIRED']:
-            # Payment failed - DO NOT create order, just clean up session
-            try:
-                # Only log the failed payment attempt (no order created)
-                raw = json.dumps({'verify': payment_status})
-                cur.execute(
-                    """
-                    INSERT INTO payments (order_id, momo_transaction_id, amount, currency, status, provider, payer_number, raw_response)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (
-                        None,  # No order_id since order was not created
-                        payment_ref,
-                        float(session.get('final_total', 0.0)),
-                        session.get('currency', 'RWF'),
-                        payment_status['status'],
-                        session.get('provider'),
-                        session.get('momo_number'),
-                        raw
-                    )
-                )
-                mysql.connection.commit()
-            except Exception as _:
-                pass
-            
-            # Clean up session but keep cart so user can retry
-            session.pop('payment_ref', None)
-            session.pop('pending_order', None)
-            session.pop('provider', None)
-            session.pop('momo_number', None)
-            session.pop('currency', None)
-            session.pop('final_total', None)
-            session.modified = True
-            flash(f"Payment {payment_status['status'].lower()}: {payment_status.get('reason', 'Unknown error')}", 'error')
-            payment_initiated = False
+    if payment_ref and not payment_initiated:
+        # A mobile money payment started earlier: report its outcome once the worker has resolved it
+        try:
+            intent = get_payment_intent(cur, payment_ref)
+        except Exception as e:
+            print(f"Payment intent lookup error: {e}")
+            intent = None
+        if intent and intent['status'] != 'PENDING':
+            view = payment_intent_view(intent)
+            if intent['status'] == 'SUCCESSFUL':
+                clear_cart_from_redis()
+                cart_items = []
+            pop_payment_session()
+            flash(view['message'], 'success' if intent['status'] == 'SUCCESSFUL' else 'error')
+        elif intent:
+            payment_initiated = True
+            payment_message = 'Waiting for you to approve the payment on your phone.'
     if cur:
         cur.close()
     return render_template('checkout.html',
@@ -4098,6 +5804,7 @@ def checkout():
                             payment_initiated=payment_initiated,
                             payment_message=payment_message,
                             payment_ref=payment_ref,
+                            order_token=uuid.uuid4().hex,
                             user_data=user_data)
 
 """
@@ -4105,6 +5812,7 @@ Minimal payment endpoint to start fresh
 """
 
 @app.route('/pay/simple', methods=['POST'])
+@rate_limited('checkout', 10, 10 * 60)
 def pay_simple():
     try:
         if not validate_csrf():
@@ -4118,7 +5826,7 @@ def pay_simple():
         cur = mysql.connection.cursor()
         cart_items = []
         total = 0.0
-        for cart_key, item in session.get('cart', {}).items():
+        for cart_key, item in get_cart_from_redis().items():
             # Extract actual product_id from cart item (for items with variations)
             actual_product_id = item.get('product_id', cart_key.split('_')[0] if '_' in cart_key else cart_key)
             cur.execute("SELECT id, name, price, stock FROM products WHERE id = %s", (actual_product_id,))
@@ -4138,7 +5846,9 @@ def pay_simple():
                         'name': row[1], 
                         'price': float(row[2]), 
                         'quantity': qty,
-                        'variations': variations_value
+                        'variations': variations_value,
+                        'img_var_id': item.get('img_var_id', ''),
+                        'dropdown_var_id': item.get('dropdown_var_id', '')
                     })
                     total += float(item['price']) * qty
 
@@ -4159,6 +5869,7 @@ def pay_simple():
         provider = request.form.get('provider', 'MTN').strip().lower()
         user_momo = request.form.get('momo_number', '').strip()  # preserve what user typed
         notes = request.form.get('notes', '').strip()
+        guest_email = request.form.get('guest_email', '').strip().lower() if 'user_id' not in session else None
 
         # Sandbox phone handling (map Rwandan local to MTN sandbox MSISDN)
         # Build API MSISDN separately, keep user_momo for DB
@@ -4185,6 +5896,7 @@ def pay_simple():
         
         order_data = {
             'user_id': session.get('user_id'),
+            'guest_email': guest_email,
             'full_name': full_name,
             'address_line': address_line,
             'city': city,
@@ -4211,149 +5923,24 @@ def pay_simple():
         print(f"/pay/simple initiation: amount={final_total}, phone={momo_number}, resp={callPay}")
 
         if callPay.get('response') in (200, 202):
-            # Payment initiated successfully
-            verify = PayClass.verifymomo(callPay.get('ref'))
-            print(f"/pay/simple verify: {verify}")
-
-            if isinstance(verify, dict) and verify.get('status') == 'SUCCESSFUL':
-                # Payment SUCCESSFUL - NOW create the order
-                ref = callPay.get('ref')
-                try:
-                    cur = mysql.connection.cursor()
-                    # Create order in database
-                    cur.execute(
-                        """
-                        INSERT INTO orders (user_id, full_name, address_line, city, delivery_phone, provider, momo_number, notes, latitude, longitude, total_amount, status, momo_transaction_id, payment_status)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        """,
-                        (order_data['user_id'], order_data['full_name'], order_data['address_line'], order_data['city'], 
-                         order_data['delivery_phone'], order_data['provider'], order_data['momo_number'], order_data['notes'], 
-                         order_data['latitude'], order_data['longitude'], order_data['total_amount'], 'paid', ref, 'paid')
-                    )
-                    order_id = cur.lastrowid
-                    
-                    # Insert order items and decrement stock
-                    for ci in order_data['cart_items']:
-                        subtotal = float(ci['price']) * int(ci['quantity'])
-                        variations = ci.get('variations', '')
-                        product_id_for_db = ci.get('product_id', ci['id'])
-                        product_name = ci['name']
-                        
-                        print(f"/pay/simple - Saving order item:")
-                        print(f"   Product: {product_name}")
-                        print(f"   Variations: '{variations}'")
-                        
-                        cur.execute(
-                            """
-                            INSERT INTO order_items (order_id, product_id, product_name, price, quantity, subtotal, VARIATIONS)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)
-                            """,
-                            (order_id, product_id_for_db, product_name, float(ci['price']), int(ci['quantity']), subtotal, variations)
-                        )
-                        
-                        # DEDUCT STOCK from appropriate level (triggers will cascade)
-                        stock_level = deduct_stock_smartly(cur, product_id_for_db, int(ci['quantity']), variations)
-                        print(f"MTN PAYMENT: Stock deducted from {stock_level} level for {product_name}")
-                    
-                    # Log payment record
-                    raw = json.dumps({'init': callPay, 'verify': verify})
-                    cur.execute(
-                        """
-                        INSERT INTO payments (order_id, momo_transaction_id, amount, currency, status, provider, payer_number, raw_response)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                        """,
-                        (order_id, ref, order_data['total_amount'], order_data['currency'], 'SUCCESSFUL', order_data['provider'], order_data['momo_number'], raw)
-                    )
-                    payment_id = cur.lastrowid
-                    
-                    mysql.connection.commit()
-                    
-                    # Send order confirmation email
-                    user_email = None
-                    if order_data['user_id']:
-                        cur.execute("SELECT email, first_name FROM users WHERE id = %s", (order_data['user_id'],))
-                        user_row = cur.fetchone()
-                        if user_row:
-                            user_email = user_row[0]
-                            user_first_name = user_row[1]
-                    
-                    cur.close()
-                    
-                    if user_email:
-                        items_html = ''.join([f"<li>{ci['name']} x {ci['quantity']} - RWF {ci['price']:,.0f}</li>" for ci in order_data['cart_items']])
-                        order_email_html = f"""
-                        <html>
-                          <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-                            <div style="max-width: 600px; margin: 0 auto; padding: 20px; border: 1px solid #ddd; border-radius: 8px;">
-                              <h2 style="color: #2e4d2c;">Order Confirmation - Order #{order_id}</h2>
-                              <p>Hi {user_first_name},</p>
-                              <p>Your payment was successful! Here are your order details:</p>
-                              <h3>Order Items:</h3>
-                              <ul>{items_html}</ul>
-                              <p><strong>Total Amount:</strong> RWF {order_data['total_amount']:,.2f}</p>
-                              <p><strong>Delivery Address:</strong> {order_data['address_line']}, {order_data['city']}</p>
-                              <p><strong>Delivery Phone:</strong> {order_data['delivery_phone']}</p>
-                              <p style="margin-top: 30px; font-size: 0.9em; color: #666;">Thank you for shopping with us!</p>
-                              <p style="font-size: 0.9em; color: #666;">- eMarket Team</p>
-                            </div>
-                          </body>
-                        </html>
-                        """
-                        send_email(user_email, f'Order Confirmation - Order #{order_id}', order_email_html)
-                    
-                    # Clear cart on success
-                    session['cart'] = {}
-                    session.modified = True
-                    
-                    return jsonify({
-                        'status': 'successful',
-                        'message': 'Order has been sent! Wait for a call from admin.',
-                        'details': verify,
-                        'order_id': order_id,
-                        'payment_id': payment_id
-                    }), 200
-                except Exception as e:
-                    print(f"Error creating order after payment success: {e}")
-                    mysql.connection.rollback()
-                    return jsonify({
-                        'status': 'error',
-                        'message': 'Payment succeeded but order creation failed. Contact support.',
-                        'details': verify
-                    }), 500
-                    
-            elif isinstance(verify, dict) and verify.get('status') in ('FAILED', 'REJECTED', 'EXPIRED'):
-                # Payment FAILED - DO NOT create order
-                ref = callPay.get('ref')
-                try:
-                    cur = mysql.connection.cursor()
-                    # Only log the failed payment attempt (no order created)
-                    raw = json.dumps({'init': callPay, 'verify': verify})
-                    cur.execute(
-                        """
-                        INSERT INTO payments (order_id, momo_transaction_id, amount, currency, status, provider, payer_number, raw_response)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                        """,
-                        (None, ref, order_data['total_amount'], order_data['currency'], verify.get('status'), order_data['provider'], order_data['momo_number'], raw)
-                    )
-                    mysql.connection.commit()
-                    cur.close()
-                except Exception as e:
-                    print(f"Error logging failed payment: {e}")
-                    
-                return jsonify({
-                    'status': 'failed',
-                    'message': 'Payment failed. Please try again.',
-                    'details': verify
-                }), 200
-            else:
-                # Payment PENDING - store in session, don't create order yet
-                ref = callPay.get('ref')
-                return jsonify({
-                    'status': 'pending',
-                    'message': 'Payment initiated. Please approve on your phone.',
-                    'ref': ref,
-                    'details': verify
-                }), 200
+            # Payment requested - payment_worker.py confirms it and creates the order
+            ref = callPay.get('ref')
+            current_user = get_current_user()
+            order_email = current_user['email'] if current_user else order_data['guest_email']
+            create_payment_intent(cur, ref, external_id, order_data, final_total, email=order_email,
+                                  cart_key=get_redis_cart_key() if REDIS_AVAILABLE else None)
+            mysql.connection.commit()
+            cur.close()
+            session['payment_ref'] = ref
+            publish_new_payment_intent(ref, order_data['user_id'])
+            wake_payment_reconciler()
+            return jsonify({
+                'status': 'pending',
+                'message': 'Payment initiated. Please approve on your phone.',
+                'ref': ref,
+                'status_url': url_for('payment_status', ref=ref),
+                'stream_url': url_for('payment_status_stream', ref=ref)
+            }), 200
         else:
             # Payment initiation FAILED - DO NOT create order
             try:
@@ -4387,17 +5974,132 @@ def pay_simple():
         print(f"Full traceback: {traceback.format_exc()}")
         return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
 
+def pop_payment_session():
+    for key in ('payment_ref', 'pending_order', 'provider', 'momo_number', 'currency', 'final_total'):
+        session.pop(key, None)
+    session.modified = True
+
+
+def load_visible_payment_view(ref):
+    """Browser view of the payment `ref` if it belongs to the current shopper, else None.
+    Read from the view resolve_payment_intent() publishes to Redis; MySQL only when that is missing."""
+    entry = None
+    if REDIS_AVAILABLE:
+        try:
+            data = redis_client.get(PAYMENT_VIEW_KEY + ref)
+            entry = json.loads(data) if data else None
+        except Exception as e:
+            print(f"[PAYMENTS] Status view read error for {ref}: {e}")
+    if entry is None:
+        cur = mysql.connection.cursor()
+        try:
+            intent = get_payment_intent(cur, ref)
+        finally:
+            cur.close()
+        if not intent:
+            return None
+        entry = {'user_id': intent['user_id'], 'view': payment_intent_view(intent)}
+    if session.get('payment_ref') != ref and (not session.get('user_id') or entry['user_id'] != session.get('user_id')):
+        return None
+    return entry['view']
+
+
+@app.route('/pay/status/<ref>')
+def payment_status(ref):
+    """Outcome of a mobile money payment, as published by the reconciler (never calls MTN)"""
+    view = load_visible_payment_view(ref)
+    if not view:
+        return jsonify({'status': 'error', 'message': 'Payment not found'}), 404
+    if view['status'] != 'pending' and session.get('payment_ref') == ref:
+        if view['status'] == 'successful':
+            # Covers session-stored carts, which the worker cannot reach
+            clear_cart_from_redis()
+        pop_payment_session()
+    return jsonify(view)
+
+
+@app.route('/pay/status/<ref>/stream')
+def payment_status_stream(ref):
+    """Server-Sent Events: the payment's current status, then its outcome as soon as it is published"""
+    if not REDIS_AVAILABLE:
+        return jsonify({'status': 'error', 'message': 'Streaming unavailable, poll the status URL'}), 503
+    view = load_visible_payment_view(ref)
+    if not view:
+        return jsonify({'status': 'error', 'message': 'Payment not found'}), 404
+    if view['status'] != 'pending':
+        return Response(sse_event(view), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    if not _payment_stream_slots.acquire(blocking=False):
+        return jsonify({'status': 'error', 'message': 'Too many open streams, poll the status URL'}), 503
+
+    try:
+        waiter = payment_status_dispatcher.subscribe(ref)
+        # Re-read after subscribing so an outcome published in between is not missed
+        view = load_visible_payment_view(ref) or view
+        # Hand any pooled DB connection back now rather than when the stream closes
+        mysql.teardown(None)
+    except Exception:
+        _payment_stream_slots.release()
+        raise
+
+    def generate():
+        current = view
+        try:
+            yield "retry: 3000\n\n"
+            yield sse_event(current)
+            deadline = time.time() + PAYMENT_STREAM_SECONDS
+            while current['status'] == 'pending':
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    current = waiter.get(timeout=min(15, remaining))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield sse_event(current)
+        finally:
+            payment_status_dispatcher.unsubscribe(ref, waiter)
+            _payment_stream_slots.release()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/payments/momo/callback/<ref>', methods=['PUT', 'POST'])
+def momo_payment_callback(ref):
+    """MTN request-to-pay callback: a hint to re-check this payment now (its body is not trusted)"""
+    try:
+        cur = mysql.connection.cursor()
+        try:
+            expedited = expedite_payment_intent(cur, ref)
+            mysql.connection.commit()
+        finally:
+            cur.close()
+        if expedited:
+            wake_payment_reconciler()
+    except Exception as e:
+        print(f"[PAYMENTS] Callback error for {ref}: {e}")
+    return '', 200
+
+
 @app.route('/pay/cod', methods=['POST'])
+@rate_limited('checkout', 10, 10 * 60)
 def pay_cod():
     try:
         if not validate_csrf():
             return jsonify({'status': 'error', 'message': 'Invalid session'}), 400
 
+        order_key = cod_order_key(request.form.get('order_token', '').strip())
+        replayed_order_id = cached_order_for_key(order_key)
+        if replayed_order_id:
+            # This checkout form was already submitted and its order placed
+            return jsonify({'status': 'successful', 'message': 'Order placed successfully! You will pay cash on delivery.', 'order_id': replayed_order_id}), 200
+
         # Build cart server-side
         cur = mysql.connection.cursor()
         cart_items = []
         total = 0.0
-        for cart_key, item in session.get('cart', {}).items():
+        for cart_key, item in get_cart_from_redis().items():
             # Extract actual product_id from cart item
             actual_product_id = item.get('product_id', cart_key.split('_')[0] if '_' in cart_key else cart_key)
             cur.execute("SELECT id, name, price, stock, discount FROM products WHERE id = %s", (actual_product_id,))
@@ -4415,7 +6117,9 @@ def pay_cod():
                         'name': row[1], 
                         'price': discounted_price, 
                         'quantity': qty,
-                        'variations': item.get('variations', '')
+                        'variations': item.get('variations', ''),
+                        'img_var_id': item.get('img_var_id', ''),
+                        'dropdown_var_id': item.get('dropdown_var_id', '')
                     })
                     total += discounted_price * qty
 
@@ -4442,71 +6146,41 @@ def pay_cod():
         print(f"DEBUG: lat_raw = '{lat_raw}', lng_raw = '{lng_raw}'")
         print(f"DEBUG: latitude = {latitude}, longitude = {longitude}")
 
-        # Create order - SIMPLE!
+        # Get user email for the confirmation
+        if session.get('user_id'):
+            cur.execute("SELECT email FROM users WHERE id = %s", (session.get('user_id'),))
+            user_row = cur.fetchone()
+            user_email = user_row[0] if user_row else None
+        else:
+            user_email = request.form.get('guest_email', '').strip()
+
+        order_data = {
+            'user_id': session.get('user_id'),
+            'guest_email': user_email if not session.get('user_id') else None,
+            'full_name': full_name,
+            'address_line': address_line,
+            'city': city,
+            'delivery_phone': delivery_phone,
+            'provider': 'COD',
+            'momo_number': None,
+            'notes': notes,
+            'latitude': latitude,
+            'longitude': longitude,
+            'total_amount': float(total),
+            'cart_items': cart_items
+        }
         try:
-            print(f"DEBUG: Creating COD order for user_id: {session.get('user_id')}")
-            print(f"DEBUG: Order details - name: {full_name}, phone: {delivery_phone}, total: {total}")
-            
-            # Insert into orders table
-            cur.execute(
-                """
-                INSERT INTO orders (user_id, full_name, address_line, city, delivery_phone, provider, momo_number, notes, latitude, longitude, total_amount, status, momo_transaction_id, payment_status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (session.get('user_id'), full_name, address_line, city, delivery_phone, 'NONE', None, notes, latitude, longitude, float(total), 'pending', None, 'pending')
-            )
-            order_id = cur.lastrowid
-            print(f"DEBUG: Order created with ID: {order_id}")
-            
-            # Insert into order_items table
-            for ci in cart_items:
-                subtotal = float(ci['price']) * int(ci['quantity'])
-                variations = ci.get('variations', '')
-                print(f"DEBUG: Adding item - {ci['name']}, qty: {ci['quantity']}, price: {ci['price']}, variations: {variations}")
-                cur.execute(
-                    """
-                    INSERT INTO order_items (order_id, product_id, product_name, price, quantity, subtotal, VARIATIONS)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (order_id, ci['id'], ci['name'], float(ci['price']), int(ci['quantity']), subtotal, variations)
-                )
-                
-                # DEDUCT STOCK from appropriate level (triggers will cascade)
-                stock_level = deduct_stock_smartly(cur, ci['id'], int(ci['quantity']), variations)
-                print(f"COD ORDER: Stock deducted from {stock_level} level for {ci['name']}")
-            
-            print("[DEBUG] About to get user email")
-            # Get user email BEFORE committing
-            user_email = None
-            if session.get('user_id'):
-                # Get logged-in user's email
-                cur.execute("SELECT email FROM users WHERE id = %s", (session.get('user_id'),))
-                user_row = cur.fetchone()
-                user_email = user_row[0] if user_row else None
-            else:
-                # Get guest email from form
-                user_email = request.form.get('guest_email', '').strip()
-            
-            mysql.connection.commit()
+            order_id = place_cod_order(cur, order_key, order_data, user_email)
             cur.close()
-            
-            # Send order confirmation email (after cursor is closed)
-            print(f"[DEBUG] Guest email from form: {user_email}")
-            print(f"[DEBUG] Final user_email: {user_email}")
-            if user_email:
-                print(f"[EMAIL] Sending order confirmation to {user_email}")
-                result = send_order_confirmation_email(user_email, order_id, full_name, total, cart_items)
-                print(f"[EMAIL] Send result: {result}")
-            else:
-                print(f"[WARNING] No email address found for order {order_id}")
-            print("DEBUG: COD order created successfully!")
+        except InsufficientStockError as e:
+            print(f"[ORDERS] COD order rejected: {e}")
+            cur.close()
+            return jsonify({'status': 'failed', 'message': 'Some items in your cart are no longer in stock. Please review your cart.'}), 409
         except Exception as e:
             print(f"[ERROR] COD order error: {e}")
-            print(f"[ERROR] COD order error type: {type(e)}")
             import traceback
             traceback.print_exc()
             try:
-                mysql.connection.rollback()
                 cur.close()
             except:
                 pass
@@ -4514,7 +6188,7 @@ def pay_cod():
 
         # Clear cart and respond
         print("[DEBUG] Clearing cart and responding with success")
-        session['cart'] = {}
+        clear_cart_from_redis()
         session.modified = True
         return jsonify({'status': 'successful', 'message': 'Order placed successfully! You will pay cash on delivery.', 'order_id': order_id}), 200
     except Exception as e:
@@ -4666,21 +6340,13 @@ def product_detail(product_id):
 
     # Load categories for sidebar
     try:
-        cur.execute("SELECT id, name FROM categories ORDER BY name")
-        categories = [{'id': r[0], 'name': r[1]} for r in cur.fetchall()]
+        categories = sorted(get_cached_categories(), key=lambda c: c['name'] or '')
     except Exception:
         categories = []
 
     # Get random related products from same category
     if product['category_id']:
-        cur.execute("SELECT * FROM products WHERE category_id = %s AND id != %s ORDER BY RAND() LIMIT 12",
-                    (product['category_id'], product_id))
-        related_products = []
-        for row in cur.fetchall():
-            # Use discount helper function for related products
-            product_with_discount = get_product_with_discount(row)
-            if product_with_discount:
-                related_products.append(product_with_discount)
+        related_products = sample_category_products(cur, product['category_id'], 12, exclude_id=product['id'])
     else:
         related_products = []
     
@@ -4712,40 +6378,7 @@ def product_detail(product_id):
         reviews = []
 
     # Build cart items for sidebar
-    cart_items = []
-    for cart_key, item in session.get('cart', {}).items():
-        # Extract actual product_id from cart item
-        actual_product_id = item.get('product_id', cart_key.split('_')[0] if '_' in cart_key else cart_key)
-        img_var_id = item.get('img_var_id', '')
-        cur.execute("SELECT * FROM products WHERE id = %s", (actual_product_id,))
-        product_data = cur.fetchone()
-        if product_data:
-            product_obj = get_product_with_discount(product_data)
-            if product_obj:
-                item['quantity'] = min(item['quantity'], product_obj['stock'])
-                if item['quantity'] > 0:
-                    # Fetch image from database based on variation
-                    image_url = product_obj['image']
-                    if img_var_id and str(img_var_id).strip():
-                        try:
-                            cur.execute("SELECT img_url FROM image_variations WHERE id = %s", (img_var_id,))
-                            result = cur.fetchone()
-                            if result and result[0]:
-                                image_url = resolve_image_url(result[0])
-                        except Exception:
-                            pass
-                    
-                    cart_items.append({
-                        'id': cart_key,  # Use cart_key which includes variations
-                        'product_id': actual_product_id,
-                        'name': item['name'],
-                        'price': item['price'],
-                        'image': image_url,
-                        'quantity': item['quantity'],
-                        'stock': product_obj['stock'],
-                        'variations': item.get('variations', ''),
-                        'is_new': False
-                    })
+    cart_items = build_cart_items_from_session(cur, get_cart_from_redis())
     
     cur.close()
     
@@ -4790,6 +6423,7 @@ def add_review():
         avg_row = cur.fetchone()
         avg_rating = float(avg_row[0]) if avg_row and avg_row[0] is not None else 0.0
         cur.execute("UPDATE products SET rate = %s WHERE id = %s", (round(avg_rating, 1), product_id))
+        note_product_changed(cur, product_id)
         mysql.connection.commit()
         cur.close()
 
@@ -4831,6 +6465,7 @@ def add_test_discounts():
         
         for product_id, discount in discounts:
             cur.execute("UPDATE products SET discount = %s WHERE id = %s", (discount, product_id))
+            note_product_changed(cur, product_id)
         
         mysql.connection.commit()
         cur.close()
@@ -4842,7 +6477,7 @@ def add_test_discounts():
 @app.route('/clear-cart')
 def clear_cart():
     """Clear the cart to test with fresh discount items"""
-    session['cart'] = {}
+    clear_cart_from_redis()
     session.modified = True
     return "Cart cleared! Now add some products with discounts to see the discount system in action."
 
@@ -4869,7 +6504,7 @@ def geocode():
             print(f"[OpenStreetMap] Attempt {attempt}/3: Searching '{search_query}'")
             
             headers = {'User-Agent': 'eMarket/1.0 (ecommerce app)'}
-            response = requests.get(osm_url, headers=headers, timeout=10)
+            response = geocode_http.get(osm_url, headers=headers, timeout=10)
             
             print(f"[OpenStreetMap] Response status: {response.status_code}")
             
@@ -4885,7 +6520,7 @@ def geocode():
         # OpenStreetMap didn't find results, trying alternative OSM data source (Photon)
         print(f"[OpenStreetMap] No results from primary OSM API. Trying Photon (alternative OSM index)...")
         photon_url = f"https://photon.komoot.io/api/?q={requests.utils.quote(query)}&limit=10"
-        response = requests.get(photon_url, timeout=10)
+        response = geocode_http.get(photon_url, timeout=10)
         
         print(f"[Photon/OSM] Response status: {response.status_code}")
         
@@ -4946,8 +6581,7 @@ def test_momo():
             }
             
             # Just test connectivity without actual payment
-            import requests
-            response = requests.head(url, headers=headers, timeout=10)
+            response = momo_http.request('HEAD', url, headers=headers, timeout=10)
             api_reachable = response.status_code in [200, 400, 401, 405]  # Any response means API is reachable
             
             return jsonify({
@@ -4987,7 +6621,6 @@ def test_payment_setup():
             PayClass.initialize_api_user()
             
             # Test basic connectivity
-            import requests
             test_url = f"{PayClass.accurl}/collection/v1_0/requesttopay"
             headers = {
                 'X-Target-Environment': PayClass.environment_mode,
@@ -4996,7 +6629,7 @@ def test_payment_setup():
             }
             
             try:
-                response = requests.head(test_url, headers=headers, timeout=10)
+                response = momo_http.request('HEAD', test_url, headers=headers, timeout=10)
                 connectivity_status = f"HTTP {response.status_code}"
                 connectivity_ok = response.status_code in [200, 400, 401, 405]
             except requests.exceptions.ConnectionError:
@@ -5039,7 +6672,7 @@ def test_payment_setup():
 
 @app.route('/api/send-promotional-email', methods=['POST'])
 def api_send_promotional_email():
-    """API endpoint to send promotional emails to all users"""
+    """API endpoint to send promotional emails to all users (queues a campaign)"""
     if not session.get('user_id'):
         return jsonify({'error': 'Unauthorized'}), 401
     
@@ -5054,41 +6687,63 @@ def api_send_promotional_email():
         discount_percent = data.get('discount_percent')
         valid_until = data.get('valid_until')
         
-        # Get all user emails
-        cur = mysql.connection.cursor()
-        cur.execute("SELECT email FROM users WHERE is_active = TRUE")
-        users = cur.fetchall()
-        cur.close()
-        
-        recipient_emails = [user[0] for user in users]
+        html_content = render_promotional_email(promo_title, promo_description, promo_code, discount_percent, valid_until)
         
-        if not recipient_emails:
-            return jsonify({'error': 'No active users to send emails to'}), 400
-        
-        # Send promotional email
-        success = send_promotional_email(
-            recipient_emails,
-            subject,
-            promo_title,
-            promo_description,
-            promo_code,
-            discount_percent,
-            valid_until
-        )
+        cur = mysql.connection.cursor()
+        try:
+            campaign_id = create_email_campaign(cur, subject, html_content, session.get('user_id'))
+            if campaign_id is None:
+                return jsonify({'error': 'No active users to send emails to'}), 400
+            mysql.connection.commit()
+            campaign = get_email_campaign(cur, campaign_id)
+        finally:
+            cur.close()
         
-        if success:
-            return jsonify({
-                'status': 'success',
-                'message': f'Promotional email sent to {len(recipient_emails)} users',
-                'recipients_count': len(recipient_emails)
-            }), 200
-        else:
-            return jsonify({'error': 'Failed to send some emails'}), 500
+        return jsonify({
+            'status': 'queued',
+            'message': f"Promotional email queued for {campaign['total_recipients']} users",
+            'recipients_count': campaign['total_recipients'],
+            'campaign': campaign
+        }), 202
             
     except Exception as e:
         print(f"[ERROR] Promotional email error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/campaigns/<int:campaign_id>')
+def api_campaign_status(campaign_id):
+    """Progress of a promotional campaign"""
+    if not session.get('user_id'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    cur = mysql.connection.cursor()
+    try:
+        campaign = get_email_campaign(cur, campaign_id)
+    finally:
+        cur.close()
+    if not campaign:
+        return jsonify({'error': 'Campaign not found'}), 404
+    return jsonify(campaign)
+
+@app.route('/api/campaigns/<int:campaign_id>/<action>', methods=['POST'])
+def api_campaign_action(campaign_id, action):
+    """Pause or resume a promotional campaign"""
+    if not session.get('user_id'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    if action not in ('pause', 'resume'):
+        return jsonify({'error': 'Unknown action'}), 404
+    cur = mysql.connection.cursor()
+    try:
+        changed = set_email_campaign_status(cur, campaign_id, 'paused' if action == 'pause' else 'queued')
+        mysql.connection.commit()
+        campaign = get_email_campaign(cur, campaign_id)
+    finally:
+        cur.close()
+    if not campaign:
+        return jsonify({'error': 'Campaign not found'}), 404
+    if not changed:
+        return jsonify({'error': f"Cannot {action} a {campaign['status']} campaign", 'campaign': campaign}), 409
+    return jsonify(campaign)
+
 @app.route('/api/send-order-status-email', methods=['POST'])
 def api_send_order_status_email():
     """API endpoint to send order status update emails"""
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Brevo Stub Server
+Local stand-in for the Brevo transactional email API, for exercising the outbox worker and
+campaigns without sending real mail or spending quota. Accepts POST /v3/smtp/email (single
+recipient or messageVersions batch), logs it and answers like Brevo does.
+
+Usage:
+    python brevo_stub_server.py [--port 8025] [--fail-rate 0.1] [--latency 0.2]
+
+Then run the app / email_worker.py with:
+    BREVO_API_URL=http://localhost:8025/v3
+    BREVO_API_KEY=anything
+"""
+
+import argparse
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+
+stats = {'requests': 0, 'recipients': 0, 'failed': 0}
+stats_lock = Lock()
+
+
+class BrevoStubHandler(BaseHTTPRequestHandler):
+    fail_rate = 0.0
+    latency = 0.0
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with stats_lock:
+                return self._reply(200, dict(stats))
+        self._reply(404, {'code': 'not_found'})
+
+    def do_POST(self):
+        if self.path != '/v3/smtp/email':
+            return self._reply(404, {'code': 'not_found'})
+        if not self.headers.get('api-key'):
+            return self._reply(401, {'code': 'unauthorized', 'message': 'Key not found'})
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            return self._reply(400, {'code': 'bad_request', 'message': 'Invalid JSON'})
+
+        versions = data.get('messageVersions') or [{'to': data.get('to') or []}]
+        recipients = [to.get('email', '') for version in versions for to in version.get('to') or []]
+        if not recipients or not data.get('subject') or not data.get('htmlContent'):
+            return self._reply(400, {'code': 'missing_parameter', 'message': 'to, subject and htmlContent are required'})
+        if len(versions) > 1000:
+            return self._reply(400, {'code': 'invalid_parameter', 'message': 'messageVersions is limited to 1000'})
+        bad = [email for email in recipients if '@' not in email]
+        if bad:
+            return self._reply(400, {'code': 'invalid_parameter', 'message': f'email is not valid: {bad[0]}'})
+
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            with stats_lock:
+                stats['failed'] += 1
+            return self._reply(random.choice([429, 500, 503]), {'code': 'temporary_failure'})
+
+        with stats_lock:
+            stats['requests'] += 1
+            stats['recipients'] += len(recipients)
+        message_ids = [f"<{uuid.uuid4().hex}@stub.brevo>" for _ in versions]
+        if 'messageVersions' in data:
+            return self._reply(201, {'messageIds': message_ids})
+        return self._reply(201, {'messageId': message_ids[0]})
+
+    def log_message(self, format, *args):
+        print(f"[BREVO STUB] {self.address_string()} {format % args}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of calls answered with 429/5xx')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every accepted call')
+    args = parser.parse_args()
+
+    BrevoStubHandler.fail_rate = args.fail_rate
+    BrevoStubHandler.latency = args.latency
+    server = ThreadingHTTPServer(('0.0.0.0', args.port), BrevoStubHandler)
+    print(f"[BREVO STUB] Listening on http://localhost:{args.port}/v3 (stats at /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
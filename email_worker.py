@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Email Outbox Worker
+Drains the email_outbox table that app.send_email() writes to. Runs as its own process
+(see Procfile / render.yaml), never inside the web workers.
+
+    - claims due rows with a lease, so several workers can run side by side and rows held by a
+      crashed worker are picked up again once the lease expires
+    - delivers them on a fixed-size thread pool, with a per-provider concurrency cap
+    - failed retryable sends go back to pending with exponential backoff (+ jitter);
+      permanent failures and rows out of attempts are dead-lettered (status = 'dead')
+    - runs queued email_campaigns one chunk at a time through the provider's batch endpoint,
+      checkpointing after every chunk so campaigns can be paused, resumed or interrupted safely
+
+Usage:
+    python email_worker.py
+
+Settings come from the same environment as app.py, plus the EMAIL_* variables in .env.example.
+"""
+
+import os
+import random
+import signal
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Event, Lock, Thread
+
+from app import (EMAIL_BATCH_PROVIDERS, EMAIL_CAMPAIGN_BATCH_SIZE, EMAIL_OUTBOX_WAKEUP_KEY, EMAIL_PROVIDERS,
+                 REDIS_AVAILABLE, EmailDeliveryError, db_pool, mark_email_undeliverable, queue_emails,
+                 redis_client)
+
+WORKER_CONCURRENCY = int(os.environ.get('EMAIL_WORKER_CONCURRENCY', 4))
+MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 6))
+RETRY_BASE_SECONDS = int(os.environ.get('EMAIL_RETRY_BASE_SECONDS', 30))
+RETRY_MAX_SECONDS = int(os.environ.get('EMAIL_RETRY_MAX_SECONDS', 3600))
+POLL_INTERVAL = int(os.environ.get('EMAIL_WORKER_POLL_INTERVAL', 5))
+CLAIM_LEASE_SECONDS = int(os.environ.get('EMAIL_CLAIM_LEASE_SECONDS', 300))
+RETENTION_DAYS = int(os.environ.get('EMAIL_OUTBOX_RETENTION_DAYS', 14))
+
+# Cap concurrent calls per provider (EMAIL_BREVO_CONCURRENCY, ...); never more than the pool itself
+provider_slots = {
+    name: BoundedSemaphore(min(WORKER_CONCURRENCY, int(os.environ.get(f'EMAIL_{name.upper()}_CONCURRENCY', 2))))
+    for name in EMAIL_PROVIDERS
+}
+
+stop_event = Event()
+_in_flight = 0
+_in_flight_lock = Lock()
+
+
+def claim_batch(limit):
+    """Lease up to `limit` due rows to this worker and return them"""
+    token = uuid.uuid4().hex
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            # Single UPDATE ... LIMIT is atomic, so concurrent workers never claim the same row.
+            # attempts is counted at claim time: a message that crashes the worker still runs out of attempts.
+            cur.execute("""
+                UPDATE email_outbox
+                SET status = 'sending', claim_token = %s, attempts = attempts + 1,
+                    locked_until = NOW() + INTERVAL %s SECOND
+                WHERE (status = 'pending' AND next_attempt_at <= NOW())
+                   OR (status = 'sending' AND locked_until < NOW())
+                ORDER BY next_attempt_at, id
+                LIMIT %s
+            """, (token, CLAIM_LEASE_SECONDS, limit))
+            conn.commit()
+            if not cur.rowcount:
+                return []
+            cur.execute("""
+                SELECT id, provider, recipient, subject, html_content, attempts
+                FROM email_outbox WHERE claim_token = %s
+            """, (token,))
+            columns = ('id', 'provider', 'recipient', 'subject', 'html_content', 'attempts')
+            return [dict(zip(columns, row), claim_token=token) for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+
+def retry_delay(attempts):
+    """Exponential backoff with full jitter, capped at RETRY_MAX_SECONDS"""
+    return random.uniform(RETRY_BASE_SECONDS, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1)))
+
+
+def finish(row, status, error=None, delay=0):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                UPDATE email_outbox
+                SET status = %s, last_error = %s, claim_token = NULL, locked_until = NULL,
+                    next_attempt_at = NOW() + INTERVAL %s SECOND,
+                    sent_at = IF(%s = 'sent', NOW(), sent_at)
+                WHERE id = %s AND claim_token = %s
+            """, (status, error, int(delay), status, row['id'], row['claim_token']))
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def deliver(row):
+    """Send one claimed row and record the outcome"""
+    global _in_flight
+    try:
+        provider = EMAIL_PROVIDERS.get(row['provider'])
+        if provider is None:
+            print(f"[OUTBOX] #{row['id']} dead: unknown provider {row['provider']!r}")
+            finish(row, 'dead', f"Unknown provider {row['provider']!r}")
+            return
+        try:
+            with provider_slots[row['provider']]:
+                provider(row['recipient'], row['subject'], row['html_content'])
+        except EmailDeliveryError as e:
+            if e.retryable and row['attempts'] < MAX_ATTEMPTS:
+                delay = retry_delay(row['attempts'])
+                print(f"[OUTBOX] #{row['id']} attempt {row['attempts']} failed, retrying in {delay:.0f}s: {e}")
+                finish(row, 'pending', str(e), delay)
+            else:
+                print(f"[OUTBOX] #{row['id']} dead after {row['attempts']} attempt(s): {e}")
+                finish(row, 'dead', str(e))
+                if e.recipient_rejected:
+                    # Checkout's is_email_deliverable() will refuse this address from now on
+                    mark_email_undeliverable(row['recipient'], str(e))
+            return
+        finish(row, 'sent')
+        print(f"[OK] Email #{row['id']} sent to {row['recipient']} via {row['provider']}")
+    except Exception as e:
+        # DB trouble while recording the outcome: the lease expires and the row is claimed again
+        print(f"[OUTBOX] #{row['id']} error: {e}")
+    finally:
+        with _in_flight_lock:
+            _in_flight -= 1
+
+
+def purge_sent():
+    """Drop delivered rows past the retention window (dead rows are kept for inspection)"""
+    try:
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("""
+                    DELETE FROM email_outbox
+                    WHERE status = 'sent' AND sent_at < NOW() - INTERVAL %s DAY
+                    LIMIT 5000
+                """, (RETENTION_DAYS,))
+                conn.commit()
+                if cur.rowcount:
+                    print(f"[OUTBOX] Purged {cur.rowcount} sent row(s)")
+            finally:
+                cur.close()
+    except Exception as e:
+        print(f"[OUTBOX] Purge failed: {e}")
+
+
+def claim_campaign():
+    """Lease the oldest queued campaign (or one abandoned by a dead worker) to this worker"""
+    token = uuid.uuid4().hex
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                UPDATE email_campaigns
+                SET status = 'running', claim_token = %s, locked_until = NOW() + INTERVAL %s SECOND,
+                    started_at = COALESCE(started_at, NOW()), last_error = NULL
+                WHERE status = 'queued' OR (status = 'running' AND locked_until < NOW())
+                ORDER BY id
+                LIMIT 1
+            """, (token, CLAIM_LEASE_SECONDS))
+            conn.commit()
+            if not cur.rowcount:
+                return None
+            cur.execute("""
+                SELECT id, subject, html_content, provider, last_user_id
+                FROM email_campaigns WHERE claim_token = %s
+            """, (token,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            columns = ('id', 'subject', 'html_content', 'provider', 'last_user_id')
+            return dict(zip(columns, row), claim_token=token)
+        finally:
+            cur.close()
+
+
+def update_campaign(campaign, sql, params=()):
+    """Run an UPDATE on the campaign only while this worker still holds it; returns False if it lost the claim"""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"UPDATE email_campaigns SET {sql} WHERE id = %s AND claim_token = %s",
+                        tuple(params) + (campaign['id'], campaign['claim_token']))
+            conn.commit()
+            return cur.rowcount == 1
+        finally:
+            cur.close()
+
+
+def next_campaign_chunk(campaign, after_user_id):
+    """Return (still_running, [(user_id, email), ...]) for the next chunk past the cursor"""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT status FROM email_campaigns WHERE id = %s AND claim_token = %s",
+                        (campaign['id'], campaign['claim_token']))
+            row = cur.fetchone()
+            if not row or row[0] != 'running':
+                return False, []
+            cur.execute("""
+                SELECT id, email FROM users
+                WHERE is_active = TRUE AND id > %s
+                ORDER BY id
+                LIMIT %s
+            """, (after_user_id, EMAIL_CAMPAIGN_BATCH_SIZE))
+            return True, list(cur.fetchall())
+        finally:
+            # End the read snapshot so the next status check sees a pause
+            conn.commit()
+            cur.close()
+
+
+def send_campaign_chunk(campaign, send_batch, emails):
+    """
+    Deliver one chunk. Returns (sent, handed_to_outbox); raises EmailDeliveryError once retries run out.
+    A batch the provider rejects outright is split into individual outbox messages.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            send_batch(emails, campaign['subject'], campaign['html_content'])
+            return len(emails), 0
+        except EmailDeliveryError as e:
+            if not e.retryable:
+                print(f"[CAMPAIGN] #{campaign['id']} batch rejected, queueing {len(emails)} individually: {e}")
+                return 0, queue_emails([(email, campaign['subject'], campaign['html_content']) for email in emails],
+                                       provider=campaign['provider'])
+            if attempt >= MAX_ATTEMPTS or stop_event.is_set():
+                raise
+            # Keep well inside the lease so nobody else picks the campaign up while we back off
+            delay = min(retry_delay(attempt), CLAIM_LEASE_SECONDS / 3)
+            print(f"[CAMPAIGN] #{campaign['id']} batch attempt {attempt} failed, retrying in {delay:.0f}s: {e}")
+            stop_event.wait(delay)
+
+
+def run_campaign(campaign):
+    send_batch = EMAIL_BATCH_PROVIDERS.get(campaign['provider'])
+    if send_batch is None:
+        update_campaign(campaign, "status = 'paused', claim_token = NULL, last_error = %s",
+                        (f"No batch sender for provider {campaign['provider']!r}",))
+        return
+    cursor = campaign['last_user_id']
+    print(f"[CAMPAIGN] #{campaign['id']} running from user id {cursor}")
+
+    while not stop_event.is_set():
+        running, chunk = next_campaign_chunk(campaign, cursor)
+        if not running:
+            print(f"[CAMPAIGN] #{campaign['id']} paused at user id {cursor}")
+            return
+        if not chunk:
+            update_campaign(campaign, "status = 'completed', completed_at = NOW(), claim_token = NULL, locked_until = NULL")
+            print(f"[CAMPAIGN] #{campaign['id']} completed")
+            return
+
+        try:
+            sent, handed_off = send_campaign_chunk(campaign, send_batch, [email for _, email in chunk])
+        except EmailDeliveryError as e:
+            update_campaign(campaign, "status = 'paused', claim_token = NULL, locked_until = NULL, last_error = %s", (str(e),))
+            print(f"[CAMPAIGN] #{campaign['id']} paused after repeated failures: {e}")
+            return
+
+        # Checkpoint after every chunk (and renew the lease); a crash re-sends at most this one chunk
+        if not update_campaign(campaign, """
+                last_user_id = %s, sent_count = sent_count + %s, outbox_count = outbox_count + %s,
+                locked_until = NOW() + INTERVAL %s SECOND
+            """, (chunk[-1][0], sent, handed_off, CLAIM_LEASE_SECONDS)):
+            print(f"[CAMPAIGN] #{campaign['id']} claimed elsewhere, stopping")
+            return
+        cursor = chunk[-1][0]
+
+    # Shutting down: hand the campaign straight back instead of waiting for the lease to expire
+    update_campaign(campaign, "status = 'queued', claim_token = NULL, locked_until = NULL")
+
+
+def campaign_loop():
+    while not stop_event.is_set():
+        try:
+            campaign = claim_campaign()
+            if campaign:
+                run_campaign(campaign)
+                continue
+        except Exception as e:
+            print(f"[CAMPAIGN] Error: {e}")
+        stop_event.wait(POLL_INTERVAL)
+
+
+def wait_for_work():
+    """Sleep until send_email() nudges the wakeup list or the poll interval passes"""
+    if REDIS_AVAILABLE:
+        try:
+            # Stay under redis_client's 5s socket timeout
+            redis_client.blpop(EMAIL_OUTBOX_WAKEUP_KEY, timeout=max(1, min(POLL_INTERVAL, 4)))
+            return
+        except Exception as e:
+            print(f"[OUTBOX] Wakeup wait error: {e}")
+    stop_event.wait(POLL_INTERVAL)
+
+
+def run():
+    global _in_flight
+    print(f"[OUTBOX] Worker started: {WORKER_CONCURRENCY} thread(s), providers {sorted(EMAIL_PROVIDERS)}")
+    executor = ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY, thread_name_prefix='email-outbox')
+    campaigns = Thread(target=campaign_loop, name='email-campaigns')
+    campaigns.start()
+    last_purge = 0
+    try:
+        while not stop_event.is_set():
+            with _in_flight_lock:
+                free = WORKER_CONCURRENCY - _in_flight
+            if free <= 0:
+                stop_event.wait(0.2)
+                continue
+
+            try:
+                rows = claim_batch(free)
+            except Exception as e:
+                print(f"[OUTBOX] Claim failed: {e}")
+                stop_event.wait(POLL_INTERVAL)
+                continue
+
+            for row in rows:
+                with _in_flight_lock:
+                    _in_flight += 1
+                executor.submit(deliver, row)
+
+            if time.time() - last_purge > 3600:
+                purge_sent()
+                last_purge = time.time()
+
+            if not rows:
+                wait_for_work()
+    finally:
+        # Let in-flight sends finish; anything still leased is reclaimed by the next worker
+        stop_event.set()
+        executor.shutdown(wait=True)
+        campaigns.join()
+        print("[OUTBOX] Worker stopped")
+
+
+def _handle_stop(signum, frame):
+    print(f"[OUTBOX] Signal {signum} received, finishing in-flight emails...")
+    stop_event.set()
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, _handle_stop)
+    signal.signal(signal.SIGINT, _handle_stop)
+    run()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Schema Migration Runner
+Applies the versioned migrations in migrations/ to the MySQL database, once, at deploy time.
+The web app itself never runs DDL.
+
+Usage:
+    python migrate.py             # apply all pending migrations
+    python migrate.py --status    # list applied / pending migrations
+
+Migration files are named NNNN_description.sql or NNNN_description.py:
+    - .sql files hold one or more statements separated by ';' at the end of a line
+    - .py files define upgrade(cur) and may use the helpers below for idempotent checks
+
+Connection settings come from the same environment variables as app.py
+(MYSQL_HOST, MYSQL_PORT, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DB).
+"""
+
+import importlib.util
+import os
+import re
+import sys
+from pathlib import Path
+
+import MySQLdb
+from dotenv import load_dotenv
+
+MIGRATIONS_DIR = Path(__file__).parent / 'migrations'
+MIGRATION_FILE_RE = re.compile(r'^(\d{4})_([a-z0-9_]+)\.(sql|py)$')
+LOCK_NAME = 'ecommerce_schema_migrations'
+
+
+def get_connection():
+    """Open a dedicated connection (no pool - this runs once, outside the web workers)"""
+    load_dotenv()
+    kwargs = {
+        'host': os.environ.get('MYSQL_HOST', 'localhost'),
+        'user': os.environ.get('MYSQL_USER', 'root'),
+        'db': os.environ.get('MYSQL_DB', 'ecommerce'),
+        'port': int(os.environ.get('MYSQL_PORT', 3306)),
+        'charset': 'utf8mb4',
+        'connect_timeout': 10,
+    }
+    password = os.environ.get('MYSQL_PASSWORD', '')
+    if password:
+        kwargs['passwd'] = password
+    return MySQLdb.connect(**kwargs)
+
+
+# Helpers for idempotent .py migrations (MySQL has no ADD COLUMN IF NOT EXISTS)
+def table_exists(cur, table):
+    cur.execute(
+        "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    return cur.fetchone()[0] > 0
+
+
+def column_exists(cur, table, column):
+    cur.execute(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (table, column)
+    )
+    return cur.fetchone()[0] > 0
+
+
+def index_exists(cur, table, index):
+    cur.execute(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+        (table, index)
+    )
+    return cur.fetchone()[0] > 0
+
+
+def constraint_exists(cur, table, constraint):
+    cur.execute(
+        "SELECT COUNT(*) FROM information_schema.TABLE_CONSTRAINTS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND CONSTRAINT_NAME = %s",
+        (table, constraint)
+    )
+    return cur.fetchone()[0] > 0
+
+
+def discover_migrations():
+    """Return [(version, name, path)] sorted by version"""
+    migrations = []
+    seen = {}
+    for path in sorted(MIGRATIONS_DIR.iterdir()):
+        match = MIGRATION_FILE_RE.match(path.name)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in seen:
+            raise RuntimeError(f"Duplicate migration version {version}: {seen[version]} and {path.name}")
+        seen[version] = path.name
+        migrations.append((version, match.group(2), path))
+    return migrations
+
+
+def split_sql(text):
+    """Split a .sql migration into statements on ';' at end of line, skipping '--' comments"""
+    statements = []
+    current = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith('--'):
+            continue
+        current.append(line)
+        if stripped.endswith(';'):
+            statements.append('\n'.join(current).rstrip().rstrip(';'))
+            current = []
+    if current:
+        statements.append('\n'.join(current))
+    return statements
+
+
+def ensure_version_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+
+
+def applied_versions(cur):
+    cur.execute("SELECT version FROM schema_version")
+    return {row[0] for row in cur.fetchall()}
+
+
+def apply_migration(connection, version, name, path):
+    cur = connection.cursor()
+    try:
+        if path.suffix == '.sql':
+            for statement in split_sql(path.read_text(encoding='utf-8')):
+                cur.execute(statement)
+        else:
+            spec = importlib.util.spec_from_file_location(f"migration_{version:04d}", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            module.upgrade(cur)
+        cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (version, name))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def main(argv):
+    show_status = '--status' in argv
+    connection = get_connection()
+    cur = connection.cursor()
+    try:
+        # Serialize concurrent deploys (several instances starting at once)
+        cur.execute("SELECT GET_LOCK(%s, 120)", (LOCK_NAME,))
+        if cur.fetchone()[0] != 1:
+            print("✗ Could not acquire migration lock (another migration is running)")
+            return False
+
+        ensure_version_table(cur)
+        connection.commit()
+        done = applied_versions(cur)
+        migrations = discover_migrations()
+
+        if show_status:
+            for version, name, _ in migrations:
+                state = 'applied' if version in done else 'pending'
+                print(f"{version:04d} {name:<40} {state}")
+            return True
+
+        pending = [m for m in migrations if m[0] not in done]
+        if not pending:
+            print("✓ Schema is up to date")
+            return True
+
+        for version, name, path in pending:
+            print(f"Applying {path.name}...")
+            apply_migration(connection, version, name, path)
+            print(f"      ✓ Applied")
+        print(f"✓ {len(pending)} migration(s) applied")
+        return True
+    except Exception as err:
+        print(f"\n✗ Migration failed: {err}")
+        return False
+    finally:
+        try:
+            cur.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+            cur.close()
+        except Exception:
+            pass
+        connection.close()
+
+
+if __name__ == '__main__':
+    success = main(sys.argv[1:])
+    sys.exit(0 if success else 1)
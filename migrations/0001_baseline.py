@@ -0,0 +1,143 @@
+"""
+Baseline schema - what ensure_db_initialized() used to create on the first request of every worker.
+Written to be safe on databases that already have some or all of it.
+"""
+
+from migrate import column_exists, constraint_exists, index_exists
+
+
+def upgrade(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            email VARCHAR(120) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            first_name VARCHAR(50) NOT NULL,
+            last_name VARCHAR(50) NOT NULL,
+            phone VARCHAR(20) NOT NULL,
+            city VARCHAR(100) NOT NULL,
+            address VARCHAR(255),
+            is_active BOOLEAN DEFAULT TRUE,
+            failed_login_attempts INT DEFAULT 0,
+            locked_until DATETIME NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS categories (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(100) NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            price DECIMAL(10,2) NOT NULL,
+            image VARCHAR(255),
+            category_id INT,
+            stock INT DEFAULT 0,
+            FOREIGN KEY (category_id) REFERENCES categories(id) ON DELETE SET NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    # Optional columns, added at the end to avoid breaking index-based reads
+    if not column_exists(cur, 'products', 'description'):
+        cur.execute("ALTER TABLE products ADD COLUMN description TEXT NULL AFTER stock")
+    if not column_exists(cur, 'products', 'discount'):
+        cur.execute("ALTER TABLE products ADD COLUMN discount DECIMAL(5,2) DEFAULT 0.00 AFTER description")
+    # OAuth columns for Google login
+    if not column_exists(cur, 'users', 'oauth_provider'):
+        cur.execute("ALTER TABLE users ADD COLUMN oauth_provider VARCHAR(50) NULL AFTER created_at")
+    if not column_exists(cur, 'users', 'oauth_id'):
+        cur.execute("ALTER TABLE users ADD COLUMN oauth_id VARCHAR(255) NULL AFTER oauth_provider")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NULL,
+            guest_email VARCHAR(120) NULL,
+            full_name VARCHAR(120) NOT NULL,
+            address_line VARCHAR(255) NOT NULL,
+            city VARCHAR(100) NOT NULL,
+            delivery_phone VARCHAR(20) NOT NULL,
+            provider VARCHAR(20),
+            momo_number VARCHAR(20),
+            notes VARCHAR(255),
+            latitude DECIMAL(10,7) NULL,
+            longitude DECIMAL(10,7) NULL,
+            total_amount DECIMAL(10,2) NOT NULL,
+            status VARCHAR(30) DEFAULT 'PENDING',
+            momo_transaction_id VARCHAR(36),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            order_id INT NOT NULL,
+            product_id INT,
+            product_name VARCHAR(255) NOT NULL,
+            price DECIMAL(10,2) NOT NULL,
+            quantity INT NOT NULL,
+            subtotal DECIMAL(10,2) NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
+            FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE SET NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    # Payments table for transaction logging
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            order_id INT NULL,
+            momo_transaction_id VARCHAR(64),
+            amount DECIMAL(10,2) NOT NULL,
+            currency VARCHAR(10) NOT NULL,
+            status VARCHAR(30) NOT NULL,
+            provider VARCHAR(30) NULL,
+            payer_number VARCHAR(32) NULL,
+            raw_response TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX (order_id),
+            INDEX (momo_transaction_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS wishlist (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            product_id INT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+            FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE,
+            UNIQUE KEY unique_wishlist (user_id, product_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+    # Password reset tokens (forgot/reset password flow)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS password_resets (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            email VARCHAR(255) NOT NULL,
+            reset_code VARCHAR(255) NOT NULL UNIQUE,
+            used BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+            INDEX idx_reset_code (reset_code),
+            INDEX idx_user_id (user_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+
+    # Uniqueness, map-picker columns and FK constraints
+    if not index_exists(cur, 'orders', 'uniq_orders_momo'):
+        cur.execute("ALTER TABLE orders ADD UNIQUE KEY uniq_orders_momo (momo_transaction_id)")
+    if not column_exists(cur, 'orders', 'latitude'):
+        cur.execute("ALTER TABLE orders ADD COLUMN latitude DECIMAL(10,7) NULL AFTER notes")
+    if not column_exists(cur, 'orders', 'longitude'):
+        cur.execute("ALTER TABLE orders ADD COLUMN longitude DECIMAL(10,7) NULL AFTER latitude")
+    if not index_exists(cur, 'payments', 'uniq_payments_momo'):
+        cur.execute("ALTER TABLE payments ADD UNIQUE KEY uniq_payments_momo (momo_transaction_id)")
+    if not constraint_exists(cur, 'payments', 'fk_payments_order'):
+        cur.execute("ALTER TABLE payments ADD CONSTRAINT fk_payments_order FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE SET NULL")
@@ -0,0 +1,13 @@
+"""
+Index backing the size facet on /viewall (EXISTS on prod_id + attr_name + attr_value).
+Skipped when the table is missing; older databases may lack the uniq_full_combo key that would otherwise cover it.
+"""
+
+from migrate import index_exists, table_exists
+
+
+def upgrade(cur):
+    if not table_exists(cur, 'dropdown_variation'):
+        return
+    if not index_exists(cur, 'dropdown_variation', 'idx_dropdown_prod_attr'):
+        cur.execute("ALTER TABLE dropdown_variation ADD INDEX idx_dropdown_prod_attr (prod_id, attr_name, attr_value)")
@@ -0,0 +1,30 @@
+"""
+Durable email outbox drained by email_worker.py.
+status: pending -> sending -> sent, or back to pending with a later next_attempt_at, or dead after too many attempts.
+"""
+
+from migrate import table_exists
+
+
+def upgrade(cur):
+    if table_exists(cur, 'email_outbox'):
+        return
+    cur.execute("""
+        CREATE TABLE email_outbox (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            provider VARCHAR(30) NOT NULL DEFAULT 'brevo',
+            recipient VARCHAR(255) NOT NULL,
+            subject VARCHAR(255) NOT NULL,
+            html_content MEDIUMTEXT NOT NULL,
+            status ENUM('pending', 'sending', 'sent', 'dead') NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            claim_token CHAR(32) NULL,
+            locked_until DATETIME NULL,
+            last_error TEXT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME NULL,
+            INDEX idx_outbox_due (status, next_attempt_at),
+            INDEX idx_outbox_claim (claim_token)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
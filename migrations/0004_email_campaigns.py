@@ -0,0 +1,32 @@
+"""
+Promotional campaigns sent in chunks by email_worker.py.
+last_user_id is the keyset cursor into users (id order); status: queued -> running -> completed, paused <-> queued.
+"""
+
+from migrate import table_exists
+
+
+def upgrade(cur):
+    if table_exists(cur, 'email_campaigns'):
+        return
+    cur.execute("""
+        CREATE TABLE email_campaigns (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            subject VARCHAR(255) NOT NULL,
+            html_content MEDIUMTEXT NOT NULL,
+            provider VARCHAR(30) NOT NULL DEFAULT 'brevo',
+            status ENUM('queued', 'running', 'paused', 'completed') NOT NULL DEFAULT 'queued',
+            total_recipients INT NOT NULL DEFAULT 0,
+            sent_count INT NOT NULL DEFAULT 0,
+            outbox_count INT NOT NULL DEFAULT 0,
+            last_user_id INT NOT NULL DEFAULT 0,
+            claim_token CHAR(32) NULL,
+            locked_until DATETIME NULL,
+            last_error TEXT NULL,
+            created_by INT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME NULL,
+            completed_at DATETIME NULL,
+            INDEX idx_campaign_status (status, locked_until)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
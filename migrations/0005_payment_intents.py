@@ -0,0 +1,38 @@
+"""
+Mobile money payments awaiting confirmation, reconciled by payment_worker.py.
+The order is only created (from order_payload) once MTN reports the request-to-pay SUCCESSFUL.
+"""
+
+from migrate import table_exists
+
+
+def upgrade(cur):
+    if table_exists(cur, 'payment_intents'):
+        return
+    cur.execute("""
+        CREATE TABLE payment_intents (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            reference CHAR(36) NOT NULL,
+            external_id VARCHAR(64) NOT NULL,
+            user_id INT NULL,
+            email VARCHAR(255) NULL,
+            amount DECIMAL(10,2) NOT NULL,
+            currency VARCHAR(10) NOT NULL,
+            provider VARCHAR(30) NULL,
+            payer_number VARCHAR(32) NULL,
+            cart_key VARCHAR(100) NULL,
+            order_payload MEDIUMTEXT NOT NULL,
+            status ENUM('PENDING', 'SUCCESSFUL', 'FAILED', 'REJECTED', 'EXPIRED', 'ORDER_FAILED') NOT NULL DEFAULT 'PENDING',
+            reason VARCHAR(255) NULL,
+            order_id INT NULL,
+            checks INT NOT NULL DEFAULT 0,
+            next_check_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL,
+            claim_token CHAR(32) NULL,
+            locked_until DATETIME NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            resolved_at DATETIME NULL,
+            UNIQUE KEY uniq_payment_intent_reference (reference),
+            INDEX idx_payment_intent_due (status, next_check_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
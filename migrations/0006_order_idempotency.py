@@ -0,0 +1,14 @@
+"""
+Idempotency key on orders, so create_order() can hand back the existing order when a checkout
+is retried (double click, replayed request, concurrent verify) instead of inserting it twice.
+Keys are "momo:<reference>" for paid payment intents and "cod:<order_token>" for COD checkouts.
+"""
+
+from migrate import column_exists, index_exists
+
+
+def upgrade(cur):
+    if not column_exists(cur, 'orders', 'idempotency_key'):
+        cur.execute("ALTER TABLE orders ADD COLUMN idempotency_key VARCHAR(64) NULL AFTER momo_transaction_id")
+    if not index_exists(cur, 'orders', 'uniq_orders_idempotency'):
+        cur.execute("ALTER TABLE orders ADD UNIQUE KEY uniq_orders_idempotency (idempotency_key)")
@@ -0,0 +1,14 @@
+"""
+The exact variation rows an order line took its stock from, so the stock engine can deduct and
+restore a whole order with set-based UPDATEs. NULL for product-level lines and for items saved
+before these columns existed (those are resolved from VARIATIONS when cancelled).
+"""
+
+from migrate import column_exists
+
+
+def upgrade(cur):
+    if not column_exists(cur, 'order_items', 'img_var_id'):
+        cur.execute("ALTER TABLE order_items ADD COLUMN img_var_id INT NULL AFTER VARIATIONS")
+    if not column_exists(cur, 'order_items', 'dropdown_var_id'):
+        cur.execute("ALTER TABLE order_items ADD COLUMN dropdown_var_id INT NULL AFTER img_var_id")
@@ -0,0 +1,19 @@
+"""
+UNVERIFIED status for payment intents MTN never gave a definite answer for (see payment_worker.py).
+They are left for support instead of being expired, since the shopper may have approved them.
+"""
+
+
+def upgrade(cur):
+    cur.execute("""
+        SELECT COLUMN_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'payment_intents' AND COLUMN_NAME = 'status'
+    """)
+    row = cur.fetchone()
+    if row is None or 'UNVERIFIED' in row[0]:
+        return
+    cur.execute("""
+        ALTER TABLE payment_intents MODIFY status
+            ENUM('PENDING', 'SUCCESSFUL', 'FAILED', 'REJECTED', 'EXPIRED', 'ORDER_FAILED', 'UNVERIFIED')
+            NOT NULL DEFAULT 'PENDING'
+    """)
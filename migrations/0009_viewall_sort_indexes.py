@@ -0,0 +1,23 @@
+"""
+Indexes backing the /viewall keyset pages within a category, so each page reads its rows in index
+order instead of filesorting the whole category: (category_id, price, id) for the price sorts and
+(category_id, rating_sort, id) for the rating sort. rate is a nullable FLOAT, so the rating sort
+uses rating_sort, a stored copy normalised to an exact DECIMAL, which is what the ?after= cursor
+compares against. It is generated at the end of the table to keep index-based reads working.
+"""
+
+from migrate import column_exists, index_exists
+
+
+def upgrade(cur):
+    if not index_exists(cur, 'products', 'idx_products_category_price'):
+        cur.execute("ALTER TABLE products ADD INDEX idx_products_category_price (category_id, price, id)")
+    if not column_exists(cur, 'products', 'rate'):
+        return
+    if not column_exists(cur, 'products', 'rating_sort'):
+        cur.execute("""
+            ALTER TABLE products ADD COLUMN rating_sort DECIMAL(10,4)
+            AS (CAST(COALESCE(rate, 0) AS DECIMAL(10,4))) STORED NOT NULL
+        """)
+    if not index_exists(cur, 'products', 'idx_products_category_rating'):
+        cur.execute("ALTER TABLE products ADD INDEX idx_products_category_rating (category_id, rating_sort, id)")
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+MTN MoMo Stub Server
+Local stand-in for the MTN MoMo collection API, for exercising checkout, payment_worker.py and the
+callback endpoint without the sandbox. Implements the calls PayClass makes: API user/key creation,
+tokens, request-to-pay and its status, plus the optional X-Callback-Url callback.
+
+Outcome by payer number (like MTN's sandbox test numbers), anything else succeeds:
+    46733123450 FAILED    46733123451 REJECTED    46733123452 EXPIRED    46733123453 stays PENDING
+
+Usage:
+    python momo_stub_server.py [--port 8026] [--approve-after 5]
+
+Then run the app / payment_worker.py with:
+    MOMO_API_URL=http://localhost:8026
+    MOMO_COLLECTIONS_SUBKEY=anything  MOMO_API_USER=anything  MOMO_API_KEY=anything
+"""
+
+import argparse
+import json
+import re
+import secrets
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Timer
+from urllib.request import Request, urlopen
+
+OUTCOMES = {
+    '46733123450': ('FAILED', 'INTERNAL_PROCESSING_ERROR'),
+    '46733123451': ('REJECTED', 'APPROVAL_REJECTED'),
+    '46733123452': ('EXPIRED', 'EXPIRED'),
+    '46733123453': ('PENDING', None),
+}
+STATUS_PATH = re.compile(r'^/collection/v1_0/requesttopay/([0-9a-fA-F-]{36})$')
+APIKEY_PATH = re.compile(r'^/v1_0/apiuser/([0-9a-fA-F-]{36})/apikey$')
+
+state = {'tokens': set(), 'payments': {}, 'stats': {'tokens': 0, 'requests': 0, 'status_checks': 0, 'callbacks': 0}}
+state_lock = Lock()
+
+
+def send_callback(url, payment):
+    try:
+        body = json.dumps(payment).encode()
+        urlopen(Request(url, data=body, method='PUT', headers={'Content-Type': 'application/json'}), timeout=5)
+        with state_lock:
+            state['stats']['callbacks'] += 1
+    except Exception as e:
+        print(f"[MOMO STUB] Callback to {url} failed: {e}")
+
+
+class MomoStubHandler(BaseHTTPRequestHandler):
+    approve_after = 5.0
+
+    def _reply(self, status, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        if payload is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        return json.loads(raw) if raw else {}
+
+    def _authorized(self):
+        token = self.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        with state_lock:
+            return token in state['tokens']
+
+    def _payment_view(self, ref):
+        with state_lock:
+            payment = state['payments'].get(ref)
+            if payment is None:
+                return None
+            view = dict(payment['body'])
+        status, reason = payment['outcome']
+        if status != 'PENDING' and time.time() - payment['created'] < self.approve_after:
+            status, reason = 'PENDING', None
+        view['status'] = status
+        if status == 'SUCCESSFUL':
+            view['financialTransactionId'] = payment['financial_id']
+        if reason:
+            view['reason'] = reason
+        return view
+
+    def do_POST(self):
+        if not self.headers.get('Ocp-Apim-Subscription-Key'):
+            return self._reply(401, {'statusCode': 401, 'message': 'Missing subscription key'})
+
+        if self.path == '/v1_0/apiuser':
+            return self._reply(201)
+        if APIKEY_PATH.match(self.path):
+            return self._reply(201, {'apiKey': secrets.token_hex(16)})
+
+        if self.path == '/collection/token/':
+            if not self.headers.get('Authorization', '').startswith('Basic '):
+                return self._reply(401, {'error': 'login_failed'})
+            token = secrets.token_urlsafe(32)
+            with state_lock:
+                state['tokens'].add(token)
+                state['stats']['tokens'] += 1
+            return self._reply(200, {'access_token': token, 'token_type': 'access_token', 'expires_in': 3600})
+
+        if self.path == '/collection/v1_0/requesttopay':
+            if not self._authorized():
+                return self._reply(401, {'statusCode': 401, 'message': 'Access token is missing or invalid'})
+            ref = self.headers.get('X-Reference-Id', '')
+            try:
+                body = self._body()
+                msisdn = body['payer']['partyId']
+            except (ValueError, KeyError, TypeError):
+                return self._reply(400, {'code': 'INVALID_REQUEST', 'message': 'Malformed request-to-pay'})
+            outcome = OUTCOMES.get(msisdn, ('SUCCESSFUL', None))
+            with state_lock:
+                if ref in state['payments']:
+                    return self._reply(409, {'code': 'RESOURCE_ALREADY_EXIST', 'message': 'Duplicated reference id'})
+                state['payments'][ref] = {
+                    'body': body, 'outcome': outcome, 'created': time.time(),
+                    'financial_id': str(uuid.uuid4().int)[:9],
+                }
+                state['stats']['requests'] += 1
+            callback_url = self.headers.get('X-Callback-Url')
+            if callback_url and outcome[0] != 'PENDING':
+                Timer(self.approve_after + 0.1, lambda: send_callback(callback_url, self._payment_view(ref))).start()
+            return self._reply(202)
+
+        self._reply(404, {'code': 'NOT_FOUND'})
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with state_lock:
+                return self._reply(200, dict(state['stats'], payments=len(state['payments'])))
+        match = STATUS_PATH.match(self.path)
+        if not match:
+            return self._reply(404, {'code': 'NOT_FOUND'})
+        if not self._authorized():
+            return self._reply(401, {'statusCode': 401, 'message': 'Access token is missing or invalid'})
+        with state_lock:
+            state['stats']['status_checks'] += 1
+        view = self._payment_view(match.group(1))
+        if view is None:
+            return self._reply(404, {'code': 'RESOURCE_NOT_FOUND', 'message': 'Requested resource was not found.'})
+        self._reply(200, view)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        print(f"[MOMO STUB] {self.address_string()} {format % args}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8026)
+    parser.add_argument('--approve-after', type=float, default=5.0,
+                        help='seconds a request-to-pay stays PENDING before its outcome is reported')
+    args = parser.parse_args()
+
+    MomoStubHandler.approve_after = args.approve_after
+    server = ThreadingHTTPServer(('0.0.0.0', args.port), MomoStubHandler)
+    print(f"[MOMO STUB] Listening on http://localhost:{args.port} (stats at /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Payment Reconciliation Worker
+Confirms mobile money payments recorded in payment_intents by app.py and creates their orders.
+Runs as its own process (see Procfile / render.yaml), never inside the web workers.
+
+    - claims due PENDING intents with a lease, so several workers can run side by side
+    - asks MTN for each one's status; SUCCESSFUL creates the order (exactly once), FAILED/REJECTED
+      closes the intent, anything else is checked again later with backoff
+    - intents MTN still reports PENDING after PAYMENT_INTENT_TIMEOUT are closed as EXPIRED; while MTN
+      can't be reached they keep being checked, and are parked as UNVERIFIED for support only
+      PAYMENT_UNVERIFIED_AFTER seconds past the timeout
+    - MTN callbacks and new intents wake the worker through Redis instead of waiting for the next poll
+
+Usage:
+    python payment_worker.py
+
+Settings come from the same environment as app.py, plus the PAYMENT_* variables in .env.example.
+"""
+
+import os
+import signal
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+
+from app import (MOMO_FAILED_STATUSES, PAYMENT_UNVERIFIED_AFTER, PAYMENT_WAKEUP_KEY, REDIS_AVAILABLE, PayClass,
+                 db_pool, park_unverified_payment_intent, payment_poll_delay, redis_client, resolve_payment_intent)
+
+WORKER_CONCURRENCY = int(os.environ.get('PAYMENT_WORKER_CONCURRENCY', 4))
+POLL_INTERVAL = int(os.environ.get('PAYMENT_WORKER_POLL_INTERVAL', 2))
+CLAIM_LEASE_SECONDS = 60
+
+stop_event = Event()
+_in_flight = 0
+_in_flight_lock = Lock()
+
+
+def claim_due(limit):
+    """Lease up to `limit` pending intents whose next check is due"""
+    token = uuid.uuid4().hex
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                UPDATE payment_intents
+                SET claim_token = %s, locked_until = NOW() + INTERVAL %s SECOND, checks = checks + 1
+                WHERE status = 'PENDING' AND next_check_at <= NOW()
+                  AND (claim_token IS NULL OR locked_until < NOW())
+                ORDER BY next_check_at
+                LIMIT %s
+            """, (token, CLAIM_LEASE_SECONDS, limit))
+            conn.commit()
+            if not cur.rowcount:
+                return []
+            cur.execute("""
+                SELECT id, reference, checks, TIMESTAMPDIFF(SECOND, expires_at, NOW())
+                FROM payment_intents WHERE claim_token = %s
+            """, (token,))
+            return [{'id': row[0], 'reference': row[1], 'checks': row[2], 'overdue': int(row[3]), 'claim_token': token}
+                    for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+
+def reschedule(intent):
+    delay = payment_poll_delay(intent['checks'])
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                UPDATE payment_intents
+                SET next_check_at = NOW() + INTERVAL %s SECOND, claim_token = NULL, locked_until = NULL
+                WHERE id = %s AND claim_token = %s AND status = 'PENDING'
+            """, (int(delay), intent['id'], intent['claim_token']))
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def check(intent):
+    """Ask MTN about one claimed intent and act on the answer"""
+    global _in_flight
+    try:
+        verify = PayClass.verifymomo(intent['reference'])
+        status = verify.get('status') if isinstance(verify, dict) else None
+        if status == 'SUCCESSFUL' or status in MOMO_FAILED_STATUSES:
+            resolve_payment_intent(intent['reference'], verify)
+        elif status == 'PENDING' and intent['overdue'] > 0:
+            # MTN definitely has no approval yet and the shopper's time is up
+            resolve_payment_intent(intent['reference'], {
+                'status': 'EXPIRED',
+                'reason': 'Payment was not approved in time',
+                'last_check': verify
+            })
+        elif status != 'PENDING' and intent['overdue'] > PAYMENT_UNVERIFIED_AFTER:
+            # Never got a definite answer; the shopper may have paid, so hand it to support
+            park_unverified_payment_intent(intent['reference'], (verify or {}).get('reason'))
+        else:
+            # PENDING, or MTN unreachable (ERROR) - try again later, even past the timeout
+            if status != 'PENDING' and intent['overdue'] > 0:
+                print(f"[PAYMENTS] {intent['reference']} past its timeout but MTN gave no answer: {verify}")
+            reschedule(intent)
+    except Exception as e:
+        # The lease expires and the intent is claimed again
+        print(f"[PAYMENTS] Check failed for {intent['reference']}: {e}")
+    finally:
+        with _in_flight_lock:
+            _in_flight -= 1
+
+
+def wait_for_work():
+    """Sleep until a new intent or callback nudges the wakeup list, or the poll interval passes"""
+    if REDIS_AVAILABLE:
+        try:
+            # Stay under redis_client's 5s socket timeout
+            redis_client.blpop(PAYMENT_WAKEUP_KEY, timeout=max(1, min(POLL_INTERVAL, 4)))
+            return
+        except Exception as e:
+            print(f"[PAYMENTS] Wakeup wait error: {e}")
+    stop_event.wait(POLL_INTERVAL)
+
+
+def run():
+    global _in_flight
+    print(f"[PAYMENTS] Worker started: {WORKER_CONCURRENCY} thread(s)")
+    executor = ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY, thread_name_prefix='payments')
+    try:
+        while not stop_event.is_set():
+            with _in_flight_lock:
+                free = WORKER_CONCURRENCY - _in_flight
+            if free <= 0:
+                stop_event.wait(0.2)
+                continue
+
+            try:
+                intents = claim_due(free)
+            except Exception as e:
+                print(f"[PAYMENTS] Claim failed: {e}")
+                stop_event.wait(POLL_INTERVAL)
+                continue
+
+            for intent in intents:
+                with _in_flight_lock:
+                    _in_flight += 1
+                executor.submit(check, intent)
+
+            if not intents:
+                wait_for_work()
+    finally:
+        executor.shutdown(wait=True)
+        print("[PAYMENTS] Worker stopped")
+
+
+def _handle_stop(signum, frame):
+    print(f"[PAYMENTS] Signal {signum} received, finishing in-flight checks...")
+    stop_event.set()
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, _handle_stop)
+    signal.signal(signal.SIGINT, _handle_stop)
+    run()